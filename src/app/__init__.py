@@ -53,4 +53,11 @@ for folder in [app.config['UPLOAD_FOLDER'], 'app/%s' % app.config['DOWNLOAD_FOLD
     mkdir_if_not_exists(app.config['APP_FOLDER'], folder)
 
 
+from . import geo_tools
+geo_tools.configure(app.config)
+
+from . import thumbnails
+thumbnails.cache.configure(app.config)
+app.jinja_env.globals.update(sprite_frames=thumbnails.SPRITE_FRAMES)
+
 from .views import *
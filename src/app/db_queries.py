@@ -1,13 +1,70 @@
 import os
 import re
+import json
+import base64
 import logging
-from sqlalchemy import or_, and_, exc, func
-from .models import MediaFiles, Locations, Users, Tags, db_session, to_dict, get_time_str
+from collections import OrderedDict
+from sqlalchemy import or_, and_, exc, func, tuple_, literal, literal_column
+from sqlalchemy.dialects.postgresql import insert, DOUBLE_PRECISION
+from .models import MediaFiles, Locations, Users, Tags, ScanJobs, ScanIssues, DuplicateFiles, \
+    db_session, to_dict, get_time_str
 from . import geo_tools
 
 
+class IngestCache:
+    """
+    A process-local write-through cache of known tags and locations used while ingesting media files,
+    so that repeated tags and places never reach the database:
+    - tags is a set of tag names (lower case);
+    - locations is a dictionary mapping (city, country) tuples in lower case to location ids.
+    The cache is filled in when tags/locations are created or found, and it is warmed up with all
+    tags/locations at the start of a scan. It is cleared when tags/locations are updated or removed.
+    """
+
+    def __init__(self):
+        self.tags = set()
+        self.locations = {}
+
+    def warm_up(self):
+        """Load all tags and locations from the database into the cache."""
+        tags = {row.tag.lower() for row in get_all_tags()}
+        locations = {(row.city.lower(), (row.country or '').lower()): row.id
+                     for row in get_all_locations()}
+        self.tags, self.locations = tags, locations
+        logging.info('Ingest cache warmed up: %s tags, %s locations.' % (len(tags), len(locations)))
+
+    def clear(self):
+        """Forget all cached tags and locations."""
+        self.tags, self.locations = set(), {}
+
+
+ingest_cache = IngestCache()
+
+# Orders of search results (see get_all_mediafiles()) by names: tuples (sort key, descending).
+# Ties are broken by id, so every order is stable, and it is backed by an index on (sort key, id),
+# see models.SCHEMA_UPGRADES. The 'shuffle' order is a random key stored along with every media file,
+# results start at the key given by the seed and wrap around (see get_page()), so it is reproducible too.
+# The 'relevance' order ranks matches of the full-text search (or falls back to 'newest' if there are none),
+# it is not backed by an index, but it only sorts rows matched by the full-text index.
+SORT_ORDERS = OrderedDict([('shuffle', (MediaFiles.shuffle_key, False)),
+                           ('relevance', (None, True)),
+                           ('newest', (MediaFiles.created, True)),
+                           ('oldest', (MediaFiles.created, False)),
+                           ('year', (func.coalesce(MediaFiles.year, literal_column('0')), True)),
+                           ('added', (MediaFiles.id, True)),
+                           ('visits', (MediaFiles.visits, True))])
+# A key of the PostgreSQL advisory lock serializing claims of conversions into MP4 (see claim_transcode()):
+TRANSCODE_LOCK_KEY = 20200602
+# Fields searched by search_in_* params: tuples (column, weight of its words in MediaFiles.search_vector):
+SEARCH_FIELDS = OrderedDict([('search_in_path', (MediaFiles.path, 'D')),
+                             ('search_in_title', (MediaFiles.title, 'A')),
+                             ('search_in_description', (MediaFiles.description, 'B')),
+                             ('search_in_comment', (MediaFiles.comment, 'C'))])
+
+
 def remove_previously_scanned(path):
-    """Remove DB entries of all media files prefixed with the given path."""
+    """Remove DB entries of all media files (and of their skipped copies) prefixed with the given path."""
+    db_session.query(DuplicateFiles).filter(DuplicateFiles.path.like(f'{path}%')).delete(synchronize_session=False)
     query = db_session.query(MediaFiles) \
         .filter(MediaFiles.path.like(f'{path}%'))
     query.delete(synchronize_session='fetch')
@@ -15,6 +72,446 @@ def remove_previously_scanned(path):
     return query.count()
 
 
+def get_registered_files(path):
+    """
+    Retrieve id, size, last modification time, content hash and perceptual hash
+    of all media files prefixed with the given path.
+
+    :return: a dictionary where keys are paths and values are rows with attributes id, size, mtime, checksum, phash.
+    """
+    query = db_session.query(MediaFiles.path, MediaFiles.id, MediaFiles.size, MediaFiles.mtime,
+                             MediaFiles.checksum, MediaFiles.phash) \
+        .filter(MediaFiles.path.like(f'{path}%'))
+    logging.debug('Query executed: %s' % query)
+    return {row.path: row for row in query}
+
+
+def remove_mediafiles(mediafile_ids, chunk_size=1000):
+    """Remove entries from 'mediafiles' table by the given ids, return the number of removed entries."""
+    count = 0
+    for i in range(0, len(mediafile_ids), chunk_size):
+        count += db_session.query(MediaFiles) \
+            .filter(MediaFiles.id.in_(mediafile_ids[i:i + chunk_size])) \
+            .delete(synchronize_session=False)
+    db_session.commit()
+    return count
+
+
+def find_mediafiles_by_checksums(checksums):
+    """
+    Retrieve ids and paths of media files by hashes of their content.
+
+    :param checksums: an iterable of content hashes.
+    :return: a dictionary mapping found content hashes to tuples (id, path) - of the oldest entry if there are several.
+    """
+    checksums = {checksum for checksum in checksums if checksum}
+    if not checksums:
+        return {}
+    query = db_session.query(MediaFiles.checksum, MediaFiles.id, MediaFiles.path) \
+        .filter(MediaFiles.checksum.in_(checksums)).order_by(MediaFiles.id.desc())
+    logging.debug('Query executed: %s' % query)
+    return {row.checksum: (row.id, row.path) for row in query}
+
+
+def upsert_duplicate_files(infos):
+    """
+    Register copies of media files (i.e. files whose content is registered under another path) at once.
+    Note: the transaction is not committed here.
+
+    :param infos: a list of dictionaries of metadata values (see helpers.read_mediafile()).
+    :return: a number of registered copies.
+    """
+    originals = find_mediafiles_by_checksums(info['checksum'] for info in infos)
+    values = [{'path': info['path'], 'checksum': info['checksum'], 'size': info['size'], 'mtime': info['mtime'],
+               'mediafile_id': originals[info['checksum']][0]}
+              for info in infos if info['checksum'] in originals]
+    if values:
+        statement = insert(DuplicateFiles.__table__).values(values)
+        db_session.execute(statement.on_conflict_do_update(
+            index_elements=['path'], set_={column: statement.excluded[column]
+                                           for column in ['checksum', 'size', 'mtime', 'mediafile_id']}))
+    return len(values)
+
+
+def get_duplicate_files(path):
+    """
+    Retrieve id, size and last modification time of all skipped copies of media files prefixed with the given path.
+
+    :return: a dictionary where keys are paths and values are rows with attributes id, size, mtime.
+    """
+    query = db_session.query(DuplicateFiles.path, DuplicateFiles.id, DuplicateFiles.size, DuplicateFiles.mtime) \
+        .filter(DuplicateFiles.path.like(f'{path}%'))
+    logging.debug('Query executed: %s' % query)
+    return {row.path: row for row in query}
+
+
+def find_duplicate_files_of(mediafile_ids, chunk_size=1000):
+    """
+    Retrieve skipped copies of the given media files (the oldest copies first).
+
+    :return: a list of rows with attributes id, path, size, mtime, mediafile_id.
+    """
+    copies = []
+    for i in range(0, len(mediafile_ids), chunk_size):
+        query = db_session.query(DuplicateFiles.id, DuplicateFiles.path, DuplicateFiles.size, DuplicateFiles.mtime,
+                                 DuplicateFiles.mediafile_id) \
+            .filter(DuplicateFiles.mediafile_id.in_(mediafile_ids[i:i + chunk_size])).order_by(DuplicateFiles.id)
+        logging.debug('Query executed: %s' % query)
+        copies.extend(query.all())
+    return copies
+
+
+def remove_duplicate_files(duplicate_ids):
+    """Remove entries from 'duplicate_files' table by the given ids, return the number of removed entries."""
+    count = 0
+    if duplicate_ids:
+        count = db_session.query(DuplicateFiles).filter(DuplicateFiles.id.in_(duplicate_ids)) \
+            .delete(synchronize_session=False)
+    db_session.commit()
+    return count
+
+
+def get_perceptual_hashes():
+    """Retrieve ids and perceptual hashes of all photos having them (see similarity.py)."""
+    query = db_session.query(MediaFiles.id, MediaFiles.phash).filter(MediaFiles.phash.isnot(None))
+    logging.debug('Query executed: %s' % query)
+    return query.yield_per(10000)
+
+
+def get_visible_paths(mediafile_ids, user_id):
+    """
+    Retrieve paths of the given media files which are public or owned by the given user.
+
+    :return: a dictionary mapping ids to paths.
+    """
+    if not mediafile_ids:
+        return {}
+    query = db_session.query(MediaFiles.id, MediaFiles.path) \
+        .filter(MediaFiles.id.in_(mediafile_ids), MediaFiles.user_id.in_({0, int(user_id)}))
+    logging.debug('Query executed: %s' % query)
+    return dict(query.all())
+
+
+def get_visible_mediafile(path, user_id):
+    """
+    Retrieve the media file registered under the given path if it is public or owned by the given user.
+
+    :return: a row with attributes id, user_id, checksum, size, mtime, or None if there is no such media file.
+    """
+    query = db_session.query(MediaFiles.id, MediaFiles.user_id, MediaFiles.checksum, MediaFiles.size,
+                             MediaFiles.mtime) \
+        .filter(MediaFiles.path == path, MediaFiles.user_id.in_({0, int(user_id)}))
+    logging.debug('Query executed: %s' % query)
+    return query.first()
+
+
+def get_visible_mediafile_by_checksum(checksum, user_id):
+    """
+    Retrieve a media file with the given content hash if it is public or owned by the given user
+    (a public one if there are both).
+
+    :return: a row with attributes id, user_id, path, or None if there is no such media file.
+    """
+    query = db_session.query(MediaFiles.id, MediaFiles.user_id, MediaFiles.path) \
+        .filter(MediaFiles.checksum == checksum, MediaFiles.user_id.in_({0, int(user_id)})) \
+        .order_by(MediaFiles.user_id.asc(), MediaFiles.id.asc())
+    logging.debug('Query executed: %s' % query)
+    return query.first()
+
+
+def get_duplicates():
+    """
+    Retrieve groups of files having the same content: media files sharing a content hash
+    (e.g. uploaded twice) and copies of media files skipped by scans.
+
+    :return: a list of dictionaries {'checksum': <hash>, 'size': <bytes>, 'wasted': <bytes taken by copies>,
+             'files': [{'id': <mediafile id>, 'path': <path>, 'registered': <False for skipped copies>}, ...]},
+             groups wasting more space go first.
+    """
+    shared = db_session.query(MediaFiles.checksum).filter(MediaFiles.checksum.isnot(None)) \
+        .group_by(MediaFiles.checksum).having(func.count(MediaFiles.id) > 1)
+    copied = db_session.query(DuplicateFiles.checksum)
+    entries = db_session.query(MediaFiles.checksum, MediaFiles.id, MediaFiles.path, MediaFiles.size) \
+        .filter(MediaFiles.checksum.in_(shared.union(copied))).order_by(MediaFiles.id)
+    logging.debug('Query executed: %s' % entries)
+    copies = db_session.query(DuplicateFiles.checksum, DuplicateFiles.mediafile_id, DuplicateFiles.path,
+                              DuplicateFiles.size).order_by(DuplicateFiles.path)
+    logging.debug('Query executed: %s' % copies)
+    groups = OrderedDict()
+    for rows, registered in [(entries, True), (copies, False)]:
+        for checksum, mediafile_id, path, size in rows:
+            group = groups.setdefault(checksum, {'checksum': checksum, 'size': size or 0, 'files': []})
+            group['files'].append({'id': mediafile_id, 'path': path, 'registered': registered})
+    for group in groups.values():
+        group['wasted'] = group['size'] * (len(group['files']) - 1)
+    return sorted((group for group in groups.values() if len(group['files']) > 1),
+                  key=lambda group: group['wasted'], reverse=True)
+
+
+def update_mediafiles_values(values, commit=True):
+    """
+    Update given values for several entries in 'mediafiles' table, values is a list of dicts with ids.
+    The transaction is not committed if commit is False (e.g. to be committed along with other changes of a batch).
+    """
+    db_session.bulk_update_mappings(MediaFiles, values)
+    if commit:
+        db_session.commit()
+    return len(values)
+
+
+def claim_transcode(stale_time, limit):
+    """
+    Take the next entry waiting for conversion into MP4 (or the one whose conversion has been interrupted,
+    i.e. running since before stale_time) and mark it as running, unless the limit of conversions running
+    at once is reached. Claims of concurrent workers (in other threads or processes) are serialized
+    by an advisory lock, so every entry is converted only once and the limit holds for all processes.
+
+    :param stale_time: a string of date & time (in the format of get_time_str()).
+    :param limit: a maximum number of conversions running at once.
+    :return: an instance of MediaFiles() class, or None if there is nothing to convert (or the limit is reached).
+    """
+    db_session.query(func.pg_advisory_xact_lock(TRANSCODE_LOCK_KEY)).scalar()
+    running = db_session.query(func.count(MediaFiles.id)) \
+        .filter(MediaFiles.transcode == 'running', MediaFiles.updated >= stale_time).scalar()
+    if running >= limit:
+        db_session.commit()
+        return None
+    query = db_session.query(MediaFiles) \
+        .filter(or_(MediaFiles.transcode == 'pending',
+                    and_(MediaFiles.transcode == 'running', MediaFiles.updated < stale_time))) \
+        .order_by(MediaFiles.id).limit(1).with_for_update(skip_locked=True)
+    logging.debug('Query executed: %s' % query)
+    entry = query.first()
+    if entry:
+        entry.transcode = 'running'
+        entry.updated = get_time_str()
+    db_session.commit()
+    return entry
+
+
+def get_transcode_counts():
+    """Return a dictionary of numbers of entries by their conversion state: pending, running and failed."""
+    query = db_session.query(MediaFiles.transcode, func.count(MediaFiles.id)) \
+        .filter(MediaFiles.transcode != '').group_by(MediaFiles.transcode)
+    logging.debug('Query executed: %s' % query)
+    return dict({'pending': 0, 'running': 0, 'failed': 0}, **dict(query.all()))
+
+
+def claim_geocodes(stale_time, limit):
+    """
+    Take entries waiting for detection of their location by coords (or the ones whose detection has been
+    interrupted, i.e. running since before stale_time) and mark them as running. Entries locked by concurrent
+    workers (in other threads or processes) are skipped, so every entry is geocoded only once.
+
+    :param stale_time: a string of date & time (in the format of get_time_str()).
+    :param limit: a maximum number of entries to take.
+    :return: a list of tuples (id, coords), empty if there is nothing to geocode.
+    """
+    query = db_session.query(MediaFiles.id, MediaFiles.coords) \
+        .filter(or_(MediaFiles.geocode == 'pending',
+                    and_(MediaFiles.geocode == 'running', MediaFiles.updated < stale_time))) \
+        .order_by(MediaFiles.id).limit(limit).with_for_update(skip_locked=True)
+    logging.debug('Query executed: %s' % query)
+    entries = query.all()
+    if entries:
+        db_session.query(MediaFiles).filter(MediaFiles.id.in_([row.id for row in entries])) \
+            .update({'geocode': 'running', 'updated': get_time_str()}, synchronize_session=False)
+    db_session.commit()
+    return entries
+
+
+def set_geocoded_location(mediafile_ids, location_id):
+    """
+    Set the location detected by coords for the given entries at once, entries changed meanwhile
+    (e.g. edited by user) are left intact. Entries without location (id=0) are marked as 'failed'.
+    Note: the transaction is not committed here.
+
+    :return: a number of updated entries.
+    """
+    query = db_session.query(MediaFiles) \
+        .filter(MediaFiles.id.in_(mediafile_ids), MediaFiles.geocode == 'running')
+    return query.update({'location_id': location_id, 'geocode': '' if location_id else 'failed'},
+                        synchronize_session=False)
+
+
+def get_geocode_counts():
+    """Return a dictionary of numbers of entries by their geocoding state: pending, running and failed."""
+    query = db_session.query(MediaFiles.geocode, func.count(MediaFiles.id)) \
+        .filter(MediaFiles.geocode != '').group_by(MediaFiles.geocode)
+    logging.debug('Query executed: %s' % query)
+    return dict({'pending': 0, 'running': 0, 'failed': 0}, **dict(query.all()))
+
+
+def get_unlocated_places():
+    """Retrieve ids and cities of locations which coordinates are not known (e.g. added by scans)."""
+    query = db_session.query(Locations.id, Locations.city) \
+        .filter(Locations.latitude.is_(None), Locations.id != 0).order_by(Locations.id)
+    logging.debug('Query executed: %s' % query)
+    return query.all()
+
+
+def set_location_coords(location_id, latitude, longitude):
+    """Set coordinates of the location, return False if they are taken by another location."""
+    try:
+        db_session.query(Locations).filter_by(id=location_id) \
+            .update({'latitude': latitude, 'longitude': longitude})
+        db_session.commit()
+    except exc.IntegrityError as err:
+        db_session.rollback()
+        logging.warning('Cannot set coordinates of location #%s due to %s.' % (location_id, err))
+        return False
+    return True
+
+
+def upsert_tags(names):
+    """
+    Create entries in 'tags' table for all given tag names at once, existing tags are skipped.
+    Note: the transaction is not committed here.
+    """
+    names = {name.strip().lower() for name in names} - ingest_cache.tags
+    values = [{'tag': name} for name in names if name]
+    if values:
+        db_session.execute(insert(Tags.__table__).values(values).on_conflict_do_nothing())
+        ingest_cache.tags.update(names)
+    return len(values)
+
+
+def find_locations(places):
+    """
+    Retrieve ids of locations by cities and countries (case-insensitive).
+
+    :param places: an iterable of 2-tuples (city, country) in lower case.
+    :return: a dictionary mapping found (city, country) tuples to location ids.
+    """
+    places = set(places)
+    query = db_session.query(Locations.id, func.lower(Locations.city), func.lower(Locations.country)) \
+        .filter(func.lower(Locations.city).in_({city for city, country in places}))
+    logging.debug('Query executed: %s' % query)
+    return {(city, country): location_id for location_id, city, country in query
+            if (city, country) in places}
+
+
+def upsert_locations(places):
+    """
+    Find or create entries in 'locations' table for all given places at once.
+    New locations are created without coordinates - they are detected by city names later,
+    by the geocoding queue (see geocoder.py), so that lookups never block scans.
+    Note: the transaction is not committed here.
+
+    :param places: an iterable of 3-tuples (city, country, code), places without city are skipped.
+    :return: a dictionary mapping (city, country) tuples in lower case to location ids.
+    """
+    codes = {(city.strip().lower(), (country or '').strip().lower()): (code or '').strip().upper()
+             for city, country, code in places if city and city.strip()}
+    known = {key: ingest_cache.locations[key] for key in codes if key in ingest_cache.locations}
+    missing = set(codes) - set(known)
+    if not missing:
+        return known
+    found = find_locations(missing)
+    values = [{'city': city, 'country': country, 'code': codes[(city, country)], 'latitude': None, 'longitude': None}
+              for city, country in missing - set(found)]
+    if values:
+        db_session.execute(insert(Locations.__table__).values(values).on_conflict_do_nothing())
+        found = find_locations(missing)
+    ingest_cache.locations.update(found)
+    known.update(found)
+    return known
+
+
+def insert_mediafiles(entries):
+    """
+    Create entries in 'mediafiles' table with one multi-row INSERT, entries with existing paths are skipped.
+    Note: the transaction is not committed here.
+
+    :param entries: a list of MediaFiles() instances (not added to the DB session).
+    :return: a set of paths of created entries.
+    """
+    if not entries:
+        return set()
+    columns = [column for column in MediaFiles.__table__.columns.keys() if column != 'id']
+    statement = insert(MediaFiles.__table__) \
+        .values([to_dict(entry, columns) for entry in entries]) \
+        .on_conflict_do_nothing(index_elements=['path']) \
+        .returning(MediaFiles.path)
+    return {row[0] for row in db_session.execute(statement)}
+
+
+def create_scan_job(folder):
+    """Create an entry in 'scan_jobs' table for a scan of the given folder."""
+    job = ScanJobs(folder)
+    db_session.add(job)
+    db_session.commit()
+    return job
+
+
+def claim_scan_job(folder, updated_after):
+    """
+    Create an entry in 'scan_jobs' table for a scan of the given folder, unless a running scan job of the folder
+    made a checkpoint after the given time. The check and the insert are serialized by an advisory lock
+    on the folder (held until commit), so concurrent requests in different processes never start two scans.
+
+    :return: a tuple (job, created), created is False if the running job is returned.
+    """
+    db_session.query(func.pg_advisory_xact_lock(func.hashtext(folder))).scalar()
+    job = get_running_scan_job(folder, updated_after)
+    if job:
+        db_session.commit()
+        return job, False
+    return create_scan_job(folder), True
+
+
+def get_scan_job(job_id=None, as_dict=False):
+    """Retrieve a scan job by id, or the most recent scan job if id is not given."""
+    query = db_session.query(ScanJobs)
+    query = query.filter_by(id=job_id) if job_id else query.order_by(ScanJobs.id.desc())
+    logging.debug('Query executed: %s' % query)
+    data = query.first()
+    if as_dict:
+        columns = ScanJobs.__table__.columns.keys()
+        data = to_dict(data, columns)
+    return data
+
+
+def update_scan_job(job_id, values, issues=None):
+    """
+    Update given values of the entry in 'scan_jobs' table
+    and create entries in 'scan_issues' table for the given list of tuples (path, reason) at once.
+    Return the actual status of the scan job.
+    """
+    db_session.query(ScanJobs).filter_by(id=job_id).update(dict(values, updated=get_time_str()))
+    if issues:
+        db_session.execute(ScanIssues.__table__.insert(),
+                           [{'job_id': job_id, 'path': path, 'reason': reason} for path, reason in issues])
+    db_session.commit()
+    return db_session.query(ScanJobs.status).filter_by(id=job_id).scalar()
+
+
+def get_running_scan_job(folder, updated_after):
+    """Retrieve a running scan job of the given folder which made a checkpoint after the given time."""
+    query = db_session.query(ScanJobs) \
+        .filter(ScanJobs.folder == folder, ScanJobs.status == 'running', ScanJobs.updated >= updated_after) \
+        .order_by(ScanJobs.id.desc())
+    logging.debug('Query executed: %s' % query)
+    return query.first()
+
+
+def cancel_scan_job(job_id):
+    """Request cancellation of the running scan job, return True if the job was running."""
+    count = db_session.query(ScanJobs).filter_by(id=job_id, status='running') \
+        .update({'status': 'cancelling'})
+    db_session.commit()
+    return count > 0
+
+
+def get_scan_issues(job_id, page, per_page):
+    """Retrieve a page of paths of files declined or failed during the given scan job."""
+    query = db_session.query(ScanIssues.path, ScanIssues.reason) \
+        .filter(ScanIssues.job_id == job_id) \
+        .order_by(ScanIssues.id.asc())
+    logging.debug('Query executed: %s' % query)
+    return query.limit(per_page).offset((page - 1) * per_page).all()
+
+
 def is_path_registered(path):
     """Verify if the given path already exists in the database and return a corresponding boolean."""
     result = db_session.query(MediaFiles).filter_by(path=path).all()
@@ -139,14 +636,13 @@ def get_all_mediafiles(user_id, params=None, fields=None):
     matching = params.get('tags_matching')
     if entry:
         other_matches = []
-        if params.get('search_in_path'):
-            other_matches.append(MediaFiles.path.contains(entry))
-        if params.get('search_in_title'):
-            other_matches.append(MediaFiles.title.contains(entry))
-        if params.get('search_in_description'):
-            other_matches.append(MediaFiles.description.contains(entry))
-        if params.get('search_in_comment'):
-            other_matches.append(MediaFiles.comment.contains(entry))
+        search_query = get_search_query(params)
+        if search_query is not None:
+            other_matches.append(MediaFiles.search_vector.op('@@')(search_query))
+        # Substrings (e.g. inside words or across separators like 'photos/2019') are matched using trigram indexes:
+        for name, (column, weight) in SEARCH_FIELDS.items():
+            if params.get(name):
+                other_matches.append(column.contains(entry))
         query = query.filter(or_(*other_matches))
         # Note: tags filtering is applied if no other terms are selected
         if params.get('search_in_tags') and not other_matches:
@@ -157,11 +653,150 @@ def get_all_mediafiles(user_id, params=None, fields=None):
                 query = query.filter(and_(*tag_matches))
             else:
                 query = query.filter(or_(*tag_matches))
-    query = query.add_columns(*fields).order_by(func.random())
+    sort_key, descending = get_sort_key(params)
+    query = query.add_columns(*fields).add_columns(sort_key.label('sort_key'))
+    if is_shuffled(params):  # from the start given by the seed to the end, then wrapping around
+        query = query.order_by((sort_key < literal(get_shuffle_start(params))).asc(), sort_key.asc(),
+                               MediaFiles.id.asc())
+    elif descending:
+        query = query.order_by(sort_key.desc(), MediaFiles.id.desc())
+    else:
+        query = query.order_by(sort_key.asc(), MediaFiles.id.asc())
     logging.debug('Query executed: %s' % query)
     return query
 
 
+def count_by_places(query):
+    """
+    Count media files found by the search query (see get_all_mediafiles()) per place in one aggregate query,
+    instead of fetching all the found rows to count them.
+
+    :param query: a query returned by get_all_mediafiles().
+    :return: a list of dicts {'code': <country code>, 'city': <city>, 'coords': <coords>, 'count': <count>}
+             where coords are taken from one of the media files taken in the city.
+    """
+    query = query.order_by(None) \
+                 .with_entities(Locations.code, Locations.city,
+                                func.max(MediaFiles.coords).label('coords'),
+                                func.count(MediaFiles.id).label('count')) \
+                 .group_by(Locations.code, Locations.city)
+    logging.debug('Query executed: %s' % query)
+    return [row._asdict() for row in query.all()]
+
+
+def get_search_query(params):
+    """
+    Build the full-text search query of params['search'] in fields selected by search_in_* params (see SEARCH_FIELDS):
+    every word of the entry must be a prefix of a word in any of the selected fields (case-insensitive).
+
+    :return: a tsquery expression, or None if there are no words in the entry or no fields are selected.
+    """
+    words = re.findall(r'[^\W_]+', params.get('search', ''))
+    weights = ''.join(weight for name, (column, weight) in SEARCH_FIELDS.items() if params.get(name))
+    if not words or not weights:
+        return None
+    return func.to_tsquery('simple', ' & '.join('%s:*%s' % (word, weights) for word in words))
+
+
+def is_shuffled(params):
+    """Check if media files search results are to be shuffled (by default, see SORT_ORDERS)."""
+    return params.get('sort') not in SORT_ORDERS or params.get('sort') == 'shuffle'
+
+
+def get_shuffle_start(params):
+    """Get the shuffle key shuffled search results start at: params['seed'] is a number from 0 to 10^9."""
+    seed = params.get('seed', '')
+    return int(seed) / 1000000000.0 if seed.isdigit() else 0.0
+
+
+def get_sort_key(params):
+    """
+    Get the sort key of media files search results by params['sort'] - one of SORT_ORDERS keys ('shuffle' by default).
+    The relevance is a rank of the full-text search match (double precision, to be compared exactly in cursors).
+
+    :return: a tuple (sort key, descending).
+    """
+    sort_key, descending = SORT_ORDERS.get(params.get('sort'), SORT_ORDERS['shuffle'])
+    if params.get('sort') == 'relevance':
+        search_query = get_search_query(params)
+        if search_query is None:
+            return SORT_ORDERS['newest']
+        sort_key = func.ts_rank(MediaFiles.search_vector, search_query).cast(DOUBLE_PRECISION)
+    return sort_key, descending
+
+
+def encode_cursor(row):
+    """Make a cursor pointing to the given row of media files search results (see seek_after())."""
+    return base64.urlsafe_b64encode(json.dumps([row.sort_key, row.id]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Get a tuple (sort key value, id) of the row the cursor points to, or None if the cursor is malformed."""
+    try:
+        value, mediafile_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return value, int(mediafile_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def seek_after(query, params, cursor):
+    """
+    Filter the query of media files search results (see get_all_mediafiles()) to rows following the row
+    the cursor points to - keyset pagination: the next page is found by the index on (sort key, id)
+    instead of skipping all rows of previous pages, so every page costs the same.
+
+    :param query: a query returned by get_all_mediafiles() for the same params.
+    :param params: a dictionary of search parameters.
+    :param cursor: a string returned by encode_cursor().
+    :return: the filtered query, or None if the cursor is malformed.
+    """
+    position = decode_cursor(cursor)
+    if position is None:
+        return None
+    value, mediafile_id = position
+    sort_key, descending = get_sort_key(params)
+    if descending:
+        return query.filter(tuple_(sort_key, MediaFiles.id) < tuple_(literal(value), literal(mediafile_id)))
+    return query.filter(tuple_(sort_key, MediaFiles.id) > tuple_(literal(value), literal(mediafile_id)))
+
+
+def get_page(query, params, page, per_page, cursor=None):
+    """
+    Fetch rows of the page of media files search results.
+    The page following the row the cursor points to is found by keyset pagination (see seek_after()),
+    other pages are found by skipping rows of previous pages. Shuffled results are fetched in two ranges
+    of the shuffle key - from the start given by the seed up to the end, then from the beginning up to the start -
+    so that the first and next pages are found by the index on (shuffle key, id) as well.
+
+    :param query: a query returned by get_all_mediafiles() for the same params.
+    :param params: a dictionary of search parameters.
+    :param page: a page number (pages start from 1).
+    :param per_page: a number of rows per page.
+    :param cursor: a string returned by encode_cursor() for the last row of the previous page (None if unknown).
+    :return: a list of rows.
+    """
+    position = decode_cursor(cursor) if cursor and page > 1 else None
+    if not is_shuffled(params) or position is None and page > 1:
+        items_query = seek_after(query, params, cursor) if position else None
+        if items_query is None:
+            items_query = query.offset((page - 1) * per_page)
+        return items_query.limit(per_page).all()
+    key, start = MediaFiles.shuffle_key, literal(get_shuffle_start(params))
+    query = query.order_by(None).order_by(key.asc(), MediaFiles.id.asc())
+    if position is None:
+        ranges = [query.filter(key >= start), query.filter(key < start)]
+    elif position[0] >= get_shuffle_start(params):
+        ranges = [seek_after(query.filter(key >= start), params, cursor), query.filter(key < start)]
+    else:
+        ranges = [seek_after(query.filter(key < start), params, cursor)]
+    items = []
+    for items_query in ranges:
+        items += items_query.limit(per_page - len(items)).all()
+        if len(items) >= per_page:
+            break
+    return items
+
+
 def get_all_tags(fields=None):
     """Construct a query to retrieve given fields of all entries from table 'tags'."""
     fields = fields or [Tags.id, Tags.tag]
@@ -277,7 +912,9 @@ def create_mediafile(user_id, media_object):
     media_file = MediaFiles(user_id or 0, media_object.path, media_object.duration,
                             media_object.title, media_object.description, media_object.comment,
                             media_object.tags, media_object.coords, media_object.location_id or 0,
-                            media_object.year or 0, media_object.created, media_object.size)
+                            media_object.year or 0, media_object.created, media_object.size,
+                            media_object.mtime, media_object.transcode or '', media_object.geocode or '',
+                            media_object.checksum, media_object.phash)
     try:
         db_session.add(media_file)
         db_session.commit()
@@ -295,13 +932,17 @@ def create_mediafile(user_id, media_object):
 def create_tag(name):
     """Create an entry in 'tags' table."""
     name = name.strip().lower()
+    if name in ingest_cache.tags:
+        return 'Tag "%s" has not been added - already exists.' % name, 'warning', None
     tag = Tags(name)
     try:
         db_session.add(tag)
         db_session.commit()
     except exc.IntegrityError as err:
         db_session.rollback()
+        ingest_cache.tags.add(name)
         return 'Tag "%s" has not been added - already exists: %s.' % (name, err), 'warning', None
+    ingest_cache.tags.add(name)
     return 'Tag "%s" has been added.' % name, 'success', tag
 
 
@@ -323,6 +964,10 @@ def create_location(city, country, code, latitude=None, longitude=None):
     country = country.strip().lower() if country else ''
     code = code.strip().upper() if code else ''
     if city:
+        if (city, country) in ingest_cache.locations:
+            location = get_location(ingest_cache.locations[(city, country)])
+            return 'Location "%s, %s" has not been added - already exists.' \
+                   % (city, country), 'warning', location
         try:
             if not (isinstance(latitude, float) and isinstance(longitude, float)):
                 latitude, longitude = geo_tools.get_coords(city)
@@ -337,6 +982,7 @@ def create_location(city, country, code, latitude=None, longitude=None):
     else:
         return 'Location "%s, %s" has not been added - bad values.' \
                % (city, country), 'warning', None
+    ingest_cache.locations[(city, country)] = location.id
     return 'Location "%s, %s [%s] (%s, %s)" has been added.' \
            % (city, country, code, latitude, longitude), 'success', location
 
@@ -363,6 +1009,7 @@ def update_mediafile(request_form, mediafile_id):
               'location_id': request_form.get('location_id'),
               'year': request_form.get('year'),
               'created': request_form.get('created'),
+              'geocode': '',  # location chosen by user is never overridden by the geocoding queue
               'updated': get_time_str()}
     return update_mediafile_values(mediafile_id, values)   # tuple of success message and style
 
@@ -372,6 +1019,7 @@ def update_tag(request_form, tag_id):
     values = {'tag': request_form.get('tag').lower()}
     db_session.query(Tags).filter_by(id=tag_id).update(values)
     db_session.commit()
+    ingest_cache.clear()
     return 'Updated tag #%s: %s.' % (tag_id, values['tag']), 'success'
 
 
@@ -390,6 +1038,7 @@ def update_location(request_form, location_id):
               'city': request_form.get('city'), 'country': request_form.get('country')}
     db_session.query(Locations).filter_by(id=location_id).update(values)
     db_session.commit()
+    ingest_cache.clear()
     return 'Updated location #%s: %s, %s.' \
            % (location_id, values['city'].title(), values['country'].title()), 'success'
 
@@ -407,6 +1056,7 @@ def remove_tag(tag_id):
     tag = Tags.query.get(tag_id)
     db_session.delete(tag)
     db_session.commit()
+    ingest_cache.clear()
     return 'Tag #%s (%s) has been deleted.' % (tag_id, tag.tag), 'success'
 
 
@@ -434,5 +1084,6 @@ def remove_location(location_id):
         return msg, 'warning'
     db_session.delete(location)
     db_session.commit()
+    ingest_cache.clear()
     return 'Location #%s (%s, %s) has been deleted.' \
            % (location_id, location.city.title(), location.country.title()), 'success'
@@ -86,6 +86,30 @@ class SettingsForm(Form):
     items_per_page = DecimalField('Items per page', [validators.NumberRange(1, 100)],
                                   default=app.config['ITEMS_PER_PAGE'], places=0,
                                   render_kw={'size': 10})
+    scan_photo_workers = DecimalField('Photo scan workers (0 - per CPU core)',
+                                      [validators.NumberRange(0, 64)],
+                                      default=app.config['SCAN_PHOTO_WORKERS'], places=0,
+                                      render_kw={'size': 10})
+    scan_video_workers = DecimalField('Video scan workers', [validators.NumberRange(1, 16)],
+                                      default=app.config['SCAN_VIDEO_WORKERS'], places=0,
+                                      render_kw={'size': 10})
+    transcode_workers = DecimalField('Video transcoding workers', [validators.NumberRange(1, 16)],
+                                     default=app.config['TRANSCODE_WORKERS'], places=0,
+                                     render_kw={'size': 10})
+    geonames_file = StringField('GeoNames Dump Location', render_kw={'size': 70})
+    nominatim_fallback = SelectField('Nominatim Fallback', choices=[('no', 'No'), ('yes', 'Yes')])
+    geocode_precision = DecimalField('Geocoding cache precision (decimal digits)', [validators.NumberRange(0, 6)],
+                                     default=app.config['GEOCODE_PRECISION'], places=0,
+                                     render_kw={'size': 10})
+    geocode_cache_ttl = DecimalField('Geocoding cache TTL (days)', [validators.NumberRange(1, 3650)],
+                                     default=app.config['GEOCODE_CACHE_TTL'], places=0,
+                                     render_kw={'size': 10})
+    perceptual_hash = SelectField('Perceptual Hashes of Photos', choices=[('no', 'No'), ('yes', 'Yes')])
+    thumbnail_cache_size = DecimalField('Thumbnails cache size (MB)', [validators.NumberRange(16, 1048576)],
+                                        default=app.config['THUMBNAIL_CACHE_SIZE'], places=0,
+                                        render_kw={'size': 10})
+    video_sprites = SelectField('Sprite Sheets of Videos', choices=[('no', 'No'), ('yes', 'Yes')])
+    media_delivery = SelectField('Media Delivery', choices=[('flask', 'Flask'), ('nginx', 'nginx (X-Accel-Redirect)')])
 
 
 class UploadForm(Form):
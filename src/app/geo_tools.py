@@ -1,18 +1,321 @@
+import os
+import math
+import time
+import json
+import sqlite3
 import logging
+import threading
+from collections import OrderedDict
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderQueryError
+from .data import COUNTRIES
+
+
+# Settings of geo lookups, see configure():
+SETTINGS = {'GEONAMES_FILE': '', 'NOMINATIM_FALLBACK': False,
+            'GEOCODE_CACHE_FILE': '', 'GEOCODE_PRECISION': 3, 'GEOCODE_CACHE_TTL': 30}
+# A size (in degrees) of cells of the gazetteer grid index:
+CELL_SIZE = 0.5
+# A maximum distance (in kilometers) to the nearest populated place to consider coordinates belong to it:
+MAX_DISTANCE = 100
+EARTH_RADIUS = 6371.0
+# A minimum interval (in seconds) between requests to Nominatim, as required by its usage policy:
+NOMINATIM_INTERVAL = 1.0
+
+
+class Gazetteer:
+    """
+    An offline reverse geocoder based on a GeoNames dump of populated places (e.g. cities15000.txt from
+    https://download.geonames.org/export/dump/ - tab-separated values: geonameid, name, asciiname,
+    alternatenames, latitude, longitude, feature class, feature code, country code, ..., population, ...).
+    Places are indexed by a grid of CELL_SIZE x CELL_SIZE degrees, so the nearest place to the given
+    coordinates is found among places of a few neighbouring cells only.
+    The dump is loaded on first lookup (or explicitly by load() - e.g. before worker processes are forked,
+    so that they share the loaded index).
+    """
+
+    def __init__(self):
+        self.path = None  # a path of the loaded dump
+        self.cells = {}  # lists of tuples (latitude, longitude, name, code) by cell coordinates
+        self.names = {}  # tuples (latitude, longitude, name, code) of the most populated places by lower case names
+        self.countries = {item['code'].lower(): item['name'] for item in COUNTRIES}
+        self.lock = threading.Lock()
+
+    def load(self, path=None):
+        """Load the dump of populated places from the given path (or from the configured one) unless loaded."""
+        path = path or SETTINGS['GEONAMES_FILE']
+        if path == self.path:
+            return bool(self.cells)
+        with self.lock:  # concurrent lookups wait for the dump to be loaded once
+            if path != self.path:
+                self.cells, self.names = self._read(path)
+                self.path = path
+        return bool(self.cells)
+
+    def _read(self, path):
+        """Read the dump into a grid index and an index of names, return both (empty if there is no dump)."""
+        cells, names, populations = {}, {}, {}
+        if not path or not os.path.isfile(path):
+            if path:
+                logging.warning('GeoNames dump "%s" is not found, offline geocoding is disabled.' % path)
+            return cells, names
+        with open(path, encoding='utf-8') as stream:
+            for line in stream:
+                fields = line.rstrip('\n').split('\t')
+                try:
+                    latitude, longitude = float(fields[4]), float(fields[5])
+                    population = int(fields[14] or 0)
+                except (IndexError, ValueError):
+                    continue
+                place = (latitude, longitude, fields[1], fields[8].lower())
+                cells.setdefault(self.cell(latitude, longitude), []).append(place)
+                key = fields[1].lower()
+                if population >= populations.get(key, -1):
+                    populations[key] = population
+                    names[key] = place
+        logging.info('Loaded %s places from GeoNames dump "%s".' % (sum(len(item) for item in cells.values()), path))
+        return cells, names
+
+    @staticmethod
+    def cell(latitude, longitude):
+        """Return coordinates of the grid cell containing the given point."""
+        return int(math.floor(latitude / CELL_SIZE)), int(math.floor((longitude % 360) / CELL_SIZE))
+
+    def nearest(self, latitude, longitude):
+        """
+        Find the nearest populated place to the given point within MAX_DISTANCE kilometers.
+
+        :return: a tuple (latitude, longitude, name, code) or None if there is no place around.
+        """
+        delta_latitude = math.degrees(MAX_DISTANCE / EARTH_RADIUS)
+        delta_longitude = min(delta_latitude / max(math.cos(math.radians(latitude)), 0.01), 180)
+        min_y, min_x = self.cell(latitude - delta_latitude, longitude - delta_longitude)
+        max_y, max_x = self.cell(latitude + delta_latitude, longitude + delta_longitude)
+        if delta_longitude >= 180:  # close to a pole
+            columns = range(0, int(360 / CELL_SIZE))
+        elif min_x <= max_x:
+            columns = range(min_x, max_x + 1)
+        else:  # crossing the antimeridian
+            columns = list(range(min_x, int(360 / CELL_SIZE))) + list(range(0, max_x + 1))
+        best, best_distance = None, MAX_DISTANCE
+        for y in range(min_y, max_y + 1):
+            for x in columns:
+                for place in self.cells.get((y, x), []):
+                    distance = get_distance(latitude, longitude, place[0], place[1])
+                    if distance <= best_distance:
+                        best, best_distance = place, distance
+        return best
+
+    def address(self, latitude, longitude):
+        """Return a 3-tuple (city, country, code) of the nearest place, or (None, None, None) if not found."""
+        place = self.nearest(latitude, longitude)
+        if not place:
+            return None, None, None
+        return place[2], self.countries.get(place[3], place[3].upper()), place[3]
+
+    def coords(self, city):
+        """Return a tuple (latitude, longitude) of the most populated place by its name, or (None, None)."""
+        place = self.names.get(city.strip().lower())
+        return (place[0], place[1]) if place else (None, None)
+
+
+class GeoCache:
+    """
+    A two-level cache of geocoding results: an in-process LRU dictionary in front of an SQLite store on disk
+    (shared by all processes and kept across restarts). Entries expire after GEOCODE_CACHE_TTL days.
+    Keys are built from coordinates rounded to GEOCODE_PRECISION decimal digits or from normalized city names.
+    """
+
+    def __init__(self, size=10000):
+        """
+        :param size: a maximum number of entries kept in memory.
+        """
+        self.size = size
+        self.entries = OrderedDict()  # tuples (value, stored timestamp) by keys, the least recently used first
+        self.lock = threading.Lock()
+        self.local = threading.local()  # SQLite connections cannot be shared by threads (and forked processes)
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def connection(self):
+        """Return a connection to the store on disk for the current thread, or None if it is not configured."""
+        path = SETTINGS['GEOCODE_CACHE_FILE']
+        if not path:
+            return None
+        if getattr(self.local, 'key', None) != (os.getpid(), path):
+            connection = sqlite3.connect(path, timeout=5)
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS geocache (key TEXT PRIMARY KEY, value TEXT, stored REAL)')
+                connection.execute('DELETE FROM geocache WHERE stored < ?', (time.time() - self.ttl(),))
+                connection.execute('CREATE TABLE IF NOT EXISTS rate_limits (name TEXT PRIMARY KEY, next REAL)')
+            self.local.connection, self.local.key = connection, (os.getpid(), path)
+        return self.local.connection
+
+    @staticmethod
+    def ttl():
+        """Return the time to live of cache entries in seconds."""
+        return float(SETTINGS['GEOCODE_CACHE_TTL']) * 86400
+
+    def get(self, key):
+        """Return the cached value by the key, or None if it is missing or expired."""
+        now = time.time()
+        with self.lock:
+            item = self.entries.get(key)
+            if item and now - item[1] < self.ttl():
+                self.entries.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return item[0]
+            self.entries.pop(key, None)
+        row = None
+        try:
+            connection = self.connection()
+            if connection:
+                row = connection.execute('SELECT value, stored FROM geocache WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as err:
+            logging.warning('Cannot read geocoding cache due to %s.' % err)
+        if row and now - row[1] < self.ttl():
+            value = json.loads(row[0])
+            self._remember(key, value, row[1])
+            self.counters['disk_hits'] += 1
+            return value
+        self.counters['misses'] += 1
+        return None
+
+    def set(self, key, value):
+        """Cache the value (a JSON-serializable one) by the key in memory and on disk."""
+        now = time.time()
+        self._remember(key, value, now)
+        try:
+            connection = self.connection()
+            if connection:
+                with connection:
+                    connection.execute('INSERT OR REPLACE INTO geocache (key, value, stored) VALUES (?, ?, ?)',
+                                       (key, json.dumps(value), now))
+        except sqlite3.Error as err:
+            logging.warning('Cannot write geocoding cache due to %s.' % err)
+
+    def _remember(self, key, value, stored):
+        """Keep the value in memory evicting the least recently used entries if the size is exceeded."""
+        with self.lock:
+            self.entries[key] = (value, stored)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """Return a dictionary of hit/miss counters and a number of entries kept in memory."""
+        lookups = sum(self.counters.values())
+        hits = self.counters['memory_hits'] + self.counters['disk_hits']
+        return dict(self.counters, entries=len(self.entries),
+                    hit_ratio=round(float(hits) / lookups, 3) if lookups else 0)
+
+
+class RateLimiter:
+    """
+    Space out calls (made by any thread of any process) by at least the given interval.
+    Every call reserves its time slot in the SQLite store of the cache (shared by all processes) in an exclusive
+    transaction, then waits for the slot without holding any lock. If the store is not configured (or fails),
+    slots are reserved in memory, i.e. calls are spaced out within the process only.
+    """
+
+    def __init__(self, name, interval, store):
+        """
+        :param name: a name of the limited calls (a key of the reserved slots in the store).
+        :param interval: a minimum number of seconds between calls.
+        :param store: an instance of GeoCache() class which store on disk keeps reserved slots.
+        """
+        self.name = name
+        self.interval = interval
+        self.store = store
+        self.lock = threading.Lock()
+        self.next = 0.0  # the earliest time of the next call reserved in memory
+
+    def wait(self):
+        """Block the calling thread until the next call is allowed."""
+        delay = self.reserve() - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve(self):
+        """Reserve the earliest free time slot for a call, return the time the call is allowed at."""
+        with self.lock:
+            now = time.time()
+            try:
+                connection = self.store.connection()
+                if connection:
+                    return self._reserve_shared(connection, now)
+            except sqlite3.Error as err:
+                logging.warning('Cannot reserve a slot for %s in the shared store due to %s.' % (self.name, err))
+            slot, self.next = max(self.next, now), max(self.next, now) + self.interval
+            return slot
+
+    def _reserve_shared(self, connection, now):
+        """Reserve the time slot in the store on disk (locked against other processes while it is read and updated)."""
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT next FROM rate_limits WHERE name = ?', (self.name,)).fetchone()
+            slot = max(row[0] if row else 0.0, now)
+            connection.execute('INSERT OR REPLACE INTO rate_limits (name, next) VALUES (?, ?)',
+                               (self.name, slot + self.interval))
+            connection.commit()
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+        return slot
+
+
+gazetteer = Gazetteer()
+cache = GeoCache()
+nominatim_limiter = RateLimiter('nominatim', NOMINATIM_INTERVAL, cache)
+
+
+def configure(app_config):
+    """
+    Apply geo lookup settings: GEONAMES_FILE - a path to the GeoNames dump for offline geocoding,
+    NOMINATIM_FALLBACK - a boolean to query Nominatim online when the dump has no answer,
+    GEOCODE_CACHE_FILE - a path to the SQLite file to cache results in, GEOCODE_PRECISION - a number
+    of decimal digits coordinates are rounded to in cache keys, GEOCODE_CACHE_TTL - days to keep results.
+    """
+    SETTINGS.update({key: app_config[key] for key in SETTINGS})
+
+
+def get_distance(latitude1, longitude1, latitude2, longitude2):
+    """Return the great-circle distance (in kilometers) between two points."""
+    latitude1, longitude1, latitude2, longitude2 = map(math.radians, [latitude1, longitude1, latitude2, longitude2])
+    value = math.sin((latitude2 - latitude1) / 2) ** 2 + \
+        math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(math.sqrt(value), 1.0))
 
 
 def get_coords(city):
     """
-    Detect geo coordinates (latitude, longitude) for the given city.
+    Detect geo coordinates (latitude, longitude) for the given city:
+    from the cache, or from the GeoNames dump if available, otherwise (if allowed) using Nominatim.
 
     :param city: a city name, e.g. minsk.
 
     :return: a tuple of float numbers (latitude, longitude).
     """
+    key = 'coords:%s' % ' '.join(str(city).lower().split())
+    cached = cache.get(key)
+    if cached:
+        return tuple(cached)
+    latitude, longitude = lookup_coords(city)
+    if latitude is not None and longitude is not None:
+        cache.set(key, [latitude, longitude])
+    return latitude, longitude
+
+
+def lookup_coords(city):
+    """Detect geo coordinates (latitude, longitude) for the given city bypassing the cache (see get_coords())."""
+    if gazetteer.load():
+        latitude, longitude = gazetteer.coords(city)
+        if latitude is not None or not SETTINGS['NOMINATIM_FALLBACK']:
+            return latitude, longitude
+    elif not SETTINGS['NOMINATIM_FALLBACK']:
+        return None, None
     location = latitude = longitude = None
     try:
+        nominatim_limiter.wait()
         location = Nominatim(timeout=10).geocode(city, language='en')
     except GeocoderQueryError as err:
         logging.error('Cannot get coordinates for city "%s" due to: %s.' % (city, err))
@@ -23,15 +326,36 @@ def get_coords(city):
 
 def get_address(latitude, longitude):
     """
-    Detect country, city, and country code based on latitude and longitude.
+    Detect country, city, and country code based on latitude and longitude:
+    from the cache, or from the GeoNames dump if available, otherwise (if allowed) using Nominatim.
 
     :param latitude: a float number representing a latitude coordinate.
     :param longitude: a float number representing a longitude coordinate.
 
     :return: a 3-tuple of strings (city, country, code) or (None, None, None) if an error occurred.
     """
+    precision = int(SETTINGS['GEOCODE_PRECISION'])
+    key = 'address:%.*f,%.*f' % (precision, float(latitude), precision, float(longitude))
+    cached = cache.get(key)
+    if cached:
+        return tuple(cached)
+    city, country, code = lookup_address(latitude, longitude)
+    if country:  # failed lookups are not cached, they may succeed next time
+        cache.set(key, [city, country, code])
+    return city, country, code
+
+
+def lookup_address(latitude, longitude):
+    """Detect country, city, and country code by coordinates bypassing the cache (see get_address())."""
+    if gazetteer.load():
+        city, country, code = gazetteer.address(float(latitude), float(longitude))
+        if city or not SETTINGS['NOMINATIM_FALLBACK']:
+            return city, country, code
+    elif not SETTINGS['NOMINATIM_FALLBACK']:
+        return None, None, None
     location = city = country = code = None
     try:
+        nominatim_limiter.wait()
         location = Nominatim(timeout=10).reverse((latitude, longitude), language='en')
     except GeocoderQueryError as err:
         logging.error('Cannot get location details for coordinates "%s,%s" due to: %s.' %
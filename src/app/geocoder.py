@@ -0,0 +1,139 @@
+"""A module to detect locations of media files by their GPS coordinates in background, separately from scanning."""
+import time
+import logging
+import threading
+from .models import db_session
+from .metamedia import format_timestamp
+from . import db_queries
+from . import geo_tools
+
+
+# A number of seconds after which running detection is considered interrupted (e.g. by a restart):
+STALE_AFTER = 3600
+# A number of entries taken from the queue at once:
+BATCH_SIZE = 1000
+# Decimal digits of coordinates defining a cluster (2 means cells of ~1 km) - one lookup is made per cluster:
+CLUSTER_PRECISION = 2
+
+
+class GeocodeQueue:
+    """
+    Detect locations of media files registered with geocode state 'pending' (i.e. having GPS coordinates
+    but no city) by a background thread, so that scans never wait for geocoder lookups.
+    Entries are taken in batches, their coordinates are grouped into clusters of nearby points,
+    and only one lookup (by the centroid) is made per cluster; the detected location is then set
+    for all entries of the cluster with one UPDATE. Coordinates of new locations (created without
+    coordinates by scans) are detected by city names afterwards. Lookups online are rate-limited
+    by geo_tools. The queue itself is kept in the database, so it survives restarts and is shared
+    (but never duplicated) between processes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.worker = None
+        self.generation = 0  # incremented by every wake() call, so that the idle worker re-checks the queue
+        self.located = set()  # ids of locations whose coordinates have been looked up by this process
+        self.completed = 0
+        self.lookups = 0
+
+    def wake(self):
+        """
+        Start the worker (one per process) to geocode pending entries.
+        Call it whenever new entries are registered - it is cheap if the worker is already running.
+        """
+        with self.lock:
+            self.generation += 1
+            if not self.worker:
+                self.worker = threading.Thread(target=self._work, daemon=True, name='geocode')
+                self.worker.start()
+
+    def _work(self):
+        """Geocode pending entries batch by batch until there is nothing left (the worker thread exits then)."""
+        try:
+            while True:
+                with self.lock:
+                    generation = self.generation
+                entries = db_queries.claim_geocodes(stale_time_str(), BATCH_SIZE)
+                if entries:
+                    self.geocode(entries)
+                    continue
+                self.locate_places()
+                with self.lock:
+                    if generation == self.generation:  # nothing has been queued meanwhile
+                        self.worker = None
+                        return
+        except Exception as err:
+            logging.exception('Geocoding worker failed due to %s.' % err)
+            with self.lock:
+                self.worker = None
+        finally:
+            db_session.remove()
+
+    def geocode(self, entries):
+        """
+        Detect locations for the given entries cluster by cluster and set them in the database.
+
+        :param entries: a list of tuples (id, coords) as returned by db_queries.claim_geocodes().
+        """
+        clusters, invalid = {}, []  # lists of tuples (id, latitude, longitude) by rounded coordinates
+        for mediafile_id, coords in entries:
+            try:
+                latitude, longitude = [float(item) for item in coords.split(',')]
+            except (AttributeError, ValueError):
+                invalid.append(mediafile_id)
+                continue
+            key = (round(latitude, CLUSTER_PRECISION), round(longitude, CLUSTER_PRECISION))
+            clusters.setdefault(key, []).append((mediafile_id, latitude, longitude))
+        if invalid:
+            db_queries.set_geocoded_location(invalid, 0)
+            db_session.commit()
+        for points in clusters.values():
+            mediafile_ids = [point[0] for point in points]
+            latitude = sum(point[1] for point in points) / len(points)
+            longitude = sum(point[2] for point in points) / len(points)
+            try:
+                city, country, code = geo_tools.get_address(latitude, longitude)
+                self.lookups += 1
+                locations = db_queries.upsert_locations([(city, country, code)])
+                location_id = locations.get(((city or '').strip().lower(), (country or '').strip().lower()), 0)
+                updated = db_queries.set_geocoded_location(mediafile_ids, location_id)
+                db_session.commit()
+                self.completed += updated if location_id else 0
+            except Exception as err:
+                db_session.rollback()
+                db_queries.ingest_cache.clear()  # it may remember locations of the rolled back transaction
+                logging.exception('Cannot geocode %s entries near %s,%s due to %s.'
+                                  % (len(mediafile_ids), latitude, longitude, err))
+                db_queries.set_geocoded_location(mediafile_ids, 0)
+                db_session.commit()
+
+    def locate_places(self):
+        """Detect coordinates (by city names) of locations which have none, each location is tried once."""
+        for location_id, city in db_queries.get_unlocated_places():
+            if location_id in self.located:
+                continue
+            self.located.add(location_id)
+            latitude, longitude = geo_tools.get_coords(city)
+            if latitude is not None and longitude is not None:
+                db_queries.set_location_coords(location_id, latitude, longitude)
+
+    def status(self):
+        """
+        Get the state of the queue: numbers of pending/running/failed entries (all processes),
+        whether the worker is running, numbers of geocoded entries and lookups made in the current process,
+        and counters of the geocoding cache.
+
+        :return: a dictionary of the queue state values.
+        """
+        data = db_queries.get_geocode_counts()
+        data.update({'workers': 1 if self.worker else 0, 'completed': self.completed, 'lookups': self.lookups,
+                     'cache': geo_tools.cache.stats()})
+        return data
+
+
+def stale_time_str():
+    """Get date & time (in the format of get_time_str()) before which running detection is considered stale."""
+    return format_timestamp(time.time() - STALE_AFTER, '%Y-%m-%d %H:%M:%S')
+
+
+geocode_queue = GeocodeQueue()
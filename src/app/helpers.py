@@ -1,19 +1,23 @@
 import os
 import time
+import hashlib
 import subprocess
 import shutil
 import json
 import logging
-import traceback
 from collections import OrderedDict
-from multiprocessing.dummy import Pool as ThreadPool, Value, Lock
+from multiprocessing import cpu_count
 from werkzeug.utils import secure_filename
 from .models import MediaFiles, get_time_str
-from .metamedia import MultiMedia, get_file_ctime, format_timestamp
+from .metamedia import MultiMedia
 from . import db_queries
 from .data import COUNTRIES
 
 
+# Country names indexed by country codes (upper-case), e.g. to count media files per country on maps:
+COUNTRY_NAMES = {country['code']: country['name'] for country in COUNTRIES}
+
+
 class Data:
     """A class to be used as a form of a return value for supporting functions."""
     def __init__(self, values, errors):
@@ -191,9 +195,40 @@ def upload_file(user_id, request, app_config, file_name=None):
     return data
 
 
-def collect_media_files(parent_folder, app_config, check_db=False):
+def file_checksum(path, chunk_size=1048576):
+    """
+    Compute a hash of the file content (BLAKE2b, 128 bits) reading the file chunk by chunk into one buffer,
+    so that even big videos are never loaded into memory at once.
+
+    :param path: an absolute path to the file.
+    :param chunk_size: a number of bytes read at once.
+    :return: a string of 32 hexadecimal digits.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, 'rb') as _f:
+        size = _f.readinto(buffer)
+        while size:
+            digest.update(view[:size])
+            size = _f.readinto(buffer)
+    return digest.hexdigest()
+
+
+def needs_geocode(gps):
+    """Return True if the location of a media file is to be detected by its GPS coordinates, False otherwise."""
+    return bool(gps['latitude'] and gps['longitude'] and not gps['city'])
+
+
+def needs_transcode(path):
+    """Return True if the given media file is a non-MP4 video to be converted into MP4, False otherwise."""
+    return path[path.rfind('.') + 1:].lower() not in ['jpg', 'jpeg', 'mp4']
+
+
+def iter_media_files(parent_folder, app_config, check_db=False, progress=None):
     """
-    Collect absolute paths of media files from the given folder recursively into a list of strings.
+    Discover media files in the given folder recursively and yield them one by one as soon as they are found,
+    so that parsing of the first files may start while the rest of the folder tree is still being walked.
     Files having not supported extensions will be skipped.
     Errors occurred during the scan will be saved to persist/scan_err.log (note: this file is cleaned before each scan).
 
@@ -201,159 +236,155 @@ def collect_media_files(parent_folder, app_config, check_db=False):
     :param app_config: a dictionary of app settings to use values of allowed extensions, media and watch folders.
     :param check_db: a boolean to perform additional check if the path is already registered in the database
                      (makes sense to use True for incremental scans and False to initial scans and full re-scans).
-    :return: a list of strings representing absolute paths of discovered media files.
-    """
-    all_media_files = []
-    declined = ''  # a string of semicolon-separated list of absolute paths of declined files.
-    for relative_path, subdirs, files in os.walk(parent_folder):
-        sub_folder = os.path.abspath(relative_path)
-        for file_name in files:
-            path = os.path.join(sub_folder, file_name)
-            if file_name[file_name.rfind('.') + 1:].lower() in app_config['ALLOWED_EXTENSIONS']:
-                if check_db is True:
-                    if db_queries.is_path_registered(path.replace(app_config['WATCH_FOLDER'],
-                                                                  app_config['MEDIA_FOLDER'], 1)):
-                        declined += '%s;' % path
-                    else:
-                        all_media_files.append(path)
-                else:
-                    all_media_files.append(path)
-            else:
-                declined += '%s;' % path
-    with open(os.path.join('persist', 'scan.json'), 'w') as scan_progress_file:
-        data = json.dumps({'total': len(all_media_files), 'passed': 0, 'failed': 0, 'declined': declined})
-        scan_progress_file.write(data)
+    :param progress: an instance of ScanProgress() class to count declined files, if any.
+    :return: a generator of tuples (path, stat) - an absolute path of a discovered media file and
+             its os.stat_result (to be reused instead of reading file size and times again).
+    """
     with open(os.path.join('persist', 'scan_err.log'), 'w'):
         pass
-    return all_media_files
-
-
-def parallel_scan(app_config, user_id, media_files):
+    folders = [os.path.abspath(parent_folder)]
+    while folders:
+        try:
+            entries = os.scandir(folders.pop())
+        except OSError as err:
+            logging.warning('Cannot list folder due to %s.' % err)
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():  # like os.walk(), do not follow symlinks to folders
+                        folders.append(entry.path)
+                    continue
+                if entry.name[entry.name.rfind('.') + 1:].lower() not in app_config['ALLOWED_EXTENSIONS'] \
+                        or (check_db is True and db_queries.is_path_registered(
+                            entry.path.replace(app_config['WATCH_FOLDER'], app_config['MEDIA_FOLDER'], 1))):
+                    if progress:
+                        progress.decline(entry.path)
+                    continue
+                try:
+                    yield entry.path, entry.stat()
+                except OSError as err:  # e.g. the file has been removed meanwhile or it is a broken symlink
+                    logging.warning('Cannot read "%s" due to %s.' % (entry.path, err))
+                    if progress:
+                        progress.decline(entry.path)
+
+
+def read_mediafile(path, app_config, stat=None):
     """
-    Once the app is launched for the first scan (when there is no database) or in order to re-scan,
-    analyzing media files will be performed on demand (as authorized user, navigate to /settings and
-    click 'Scan Media Files' button).
-    To speed-up the scan process, 32 threads max will be used for this task.
-    During the scan process files metadata is retrieved from files and is registered in the DB.
+    From the given path detect a media type (photo or video) and read metadata from the file -
+    EXIF tags from photo files or custom metadata from video files.
+    The database is not touched here, so this function is safe to run in worker processes.
 
-    :param app_config: a dictionary containing the application configuration settings (=app.config).
-    :param user_id: an integer number of user id which will be considered as owner (0 for public).
-    :param media_files: a list of strings - absolute paths of media files to be processed.
-    :return: True.
+    .. note :: any allowed non-MP4 video is marked to be converted into MP4 to be displayable in browsers -
+               conversion is done later by the transcoding queue (see transcoder.py), not here.
+               Likewise, a location of a photo having only GPS coordinates is detected later
+               by the geocoding queue (see geocoder.py).
+
+    :param path: an absolute path to the photo or video file.
+    :param app_config: a dictionary containing the application configuration settings (=app.config),
+                       only FFMPEG_PATH, FFPROBE_PATH and ALLOWED_EXTENSIONS are required
+                       (perceptual hashes of photos are computed only if PERCEPTUAL_HASH is True).
+    :param stat: an os.stat_result of the file if it is already known (e.g. from iter_media_files()).
+    :return: an instance of Data() class, where
+             value is a dictionary of metadata values (or None if the media type is not detected),
+             and errors is the list of messages - empty if reading metadata was successful.
     """
-    passed, lock_passed = Value('i', 0), Lock()
-    failed, lock_failed = Value('i', 0), Lock()
-    args = [(app_config, user_id, path, passed, lock_passed, failed, lock_failed)
-            for path in media_files]
-    pool = ThreadPool(2)
-    pool.starmap(single_scan, args)
-    pool.close()
-    pool.join()
-    return True
+    multimedia = MultiMedia.detect(path, app_config,
+                                   ffmpeg_path=app_config['FFMPEG_PATH'],
+                                   ffprobe_path=app_config['FFPROBE_PATH'],
+                                   stat=stat)
+    if not multimedia:
+        return Data(None, ['Cannot detect media type of "%s".' % path])
+    tags = [tag for tag in multimedia.tags.strip().split() if 3 <= len(tag) <= 15]
+    info = {'path': multimedia.path, 'duration': multimedia.duration, 'size': multimedia.stat.st_size,
+            'mtime': multimedia.stat.st_mtime, 'title': multimedia.title,
+            'description': multimedia.description, 'comment': multimedia.comment,
+            'tags': ' '.join(tags), 'gps': multimedia.gps,
+            'year': multimedia.year, 'created': multimedia.created,
+            'transcode': 'pending' if needs_transcode(multimedia.path) else '',
+            'geocode': 'pending' if needs_geocode(multimedia.gps) else '',
+            'checksum': file_checksum(multimedia.path),
+            'phash': multimedia.perceptual_hash() if app_config.get('PERCEPTUAL_HASH')
+            and hasattr(multimedia, 'perceptual_hash') else None}
+    return Data(info, [])
 
 
-def single_scan(app_config, user_id, path, passed, lock_passed, failed, lock_failed):
+def build_mediafile(user_id, info, location_id):
     """
-    Analyze a single media file:
-    read EXIF tags from photo files or custom metadata from video files
-    and write this information into the database.
-    The scan progress (number of total/passed/failed files) is written into 'persist/scan.json' file.
+    Create an instance of MediaFiles() class (not yet added to the DB session) from metadata values.
+    Media file keeps its original coords, they do not depend on location coords of the city center.
 
-    :param app_config: a dictionary containing the application configuration settings (=app.config).
     :param user_id: an integer number of user id which will be considered as owner (0 for public).
-    :param path: an absolute path to the photo or video file.
-    :param passed: an integer value - a count of all successfully processed media files.
-    :param lock_passed: a Lock() value to stay safe-thread in counting successfully processed files.
-    :param failed: an integer value - a count of all processed media files which failed.
-    :param lock_failed: a Lock() value to stay safe-thread in counting failed files.
-
-    :return: True if no errors occurred during the scan, otherwise False.
-    """
-    declined = ''
-    if path.startswith(app_config['WATCH_FOLDER']):
-        old_path = path
-        path = path.replace(app_config['WATCH_FOLDER'], app_config['MEDIA_FOLDER'], 1)
-        result = move_file(old_path, path)
-        if result.errors:
-            write_scan_error('%s failed: cannot move to %s due to %s\n%s\n' %
-                             (old_path, path, ';'.join(result.errors), traceback.format_exc()))
-            return False
-    try:
-        data = add_mediafile(user_id, path, app_config)
-    except Exception as err:
-        msg = '%s failed due to %s\n%s\n' % (path, err, traceback.format_exc())
-        write_scan_error(msg)
-        data = Data(None, [msg])
-    with open(os.path.join('persist', 'scan.json'), 'r+') as scan_progress_file:
-        if data.value:
-            with lock_passed:
-                passed.value += 1
-        else:
-            with lock_failed:
-                failed.value += 1
-                declined = path
-        content = json.loads(scan_progress_file.read())
-        if declined:
-            content['declined'] += ';%s' % declined
-        content['passed'] = passed.value
-        content['failed'] = failed.value
-        scan_progress_file.seek(0)
-        scan_progress_file.write(json.dumps(content))
-        scan_progress_file.truncate()
-    return False if data.errors else True
+    :param info: a dictionary of metadata values as returned by read_mediafile().
+    :param location_id: an id of the location entry (0 for unknown location).
+    :return: an instance of MediaFiles() class.
+    """
+    gps = info['gps']
+    coords = ','.join(str(item) for item in [gps['latitude'], gps['longitude']] if item)
+    return MediaFiles(user_id, info['path'], info['duration'], info['title'],
+                      info['description'], info['comment'], info['tags'], coords, location_id,
+                      info['year'], info['created'], info['size'], info['mtime'], info['transcode'],
+                      info['geocode'], info['checksum'], info['phash'])
 
 
-def add_mediafile(user_id, path, app_config):
+def register_mediafile(user_id, info, mediafile_id=None):
     """
-    From the given path detect a media type (photo or video) and read metadata from the file -
-    EXIF tags from photo files or custom metadata from video files, -
-    and create an entry in the database containing all available metadata.
+    Create an entry in the database containing all metadata read by read_mediafile(),
+    or, if mediafile_id is given, refresh metadata of the existing entry (e.g. a file changed on disk) -
+    in this case ownership, visits and access time of the entry are kept intact.
     If new tags or locations are detected, they will be added to the database.
     Original GEO coordinates will be stored - i.e. not overridden with the coordinates
     of the city center when location is automatically detected by the coordinates with geopy module.
 
-    .. note :: any allowed non-MP4 video will be converted into MP4 to be displayable in browsers.
-
     :param user_id: an integer number of user id which will be considered as owner (0 for public).
-    :param path: an absolute path to the photo or video file.
-    :param app_config: a dictionary containing the application configuration settings (=app.config).
+    :param info: a dictionary of metadata values as returned by read_mediafile().
+    :param mediafile_id: an id of the existing entry in 'mediafiles' table to be updated, if any.
     :return: an instance of Data() class, where
-             value is an instance of Photo()/Video() class (or None if adding a media file failed),
+             value is an instance of MediaFiles() class (or None if adding a media file failed),
              and errors is the list of messages - empty if adding a media file was successful.
     """
-    multimedia = MultiMedia.detect(path, app_config,
-                                   ffmpeg_path=app_config['FFMPEG_PATH'],
-                                   ffprobe_path=app_config['FFPROBE_PATH'])
-    # File creation year of the original file
-    timestamp = int(get_file_ctime(path))
-    timestamp = timestamp // 1000 if len(str(timestamp)) > 10 else timestamp
-    created = format_timestamp(timestamp, '%Y-%m-%d %H:%M:%S')
-    # Convert non-MP4 videos into MP4 (tested for '3gp', 'mpg', 'mpeg', 'mov', 'avi' - works well)
-    if multimedia.path[multimedia.path.rfind('.') + 1:].lower() not in ['jpg', 'jpeg', 'mp4']:
-        metadata = '-metadata copyright="%s" ' % created
-        multimedia.convert_to_mp4(' -y -vcodec h264 -acodec aac -strict -2 -b:a 384k %s' % metadata)
+    path, gps = info['path'], info['gps']
     # Add tags if new ones were discovered
-    tags = [tag for tag in multimedia.tags.strip().split() if 3 <= len(tag) <= 15]
-    for tag in tags:
+    for tag in info['tags'].split():
         msg, style, obj = db_queries.create_tag(tag)
         logging.debug('%s %s %s %s\n' % (get_time_str(), style.upper(), path, msg))
     # Add location if a new one is detected
-    msg, style, location = db_queries.create_location(multimedia.gps['city'],
-                                                      multimedia.gps['country'],
-                                                      multimedia.gps['code'])
+    msg, style, location = db_queries.create_location(gps['city'], gps['country'], gps['code'])
     logging.debug('%s %s %s %s\n' % (get_time_str(), style.upper(), path, msg))
-    # Add media file with its original coords, does not depend on location coords of the city center
-    coords = ','.join(str(item)
-                      for item in [multimedia.gps['latitude'], multimedia.gps['longitude']] if item)
-    entry = MediaFiles(user_id, multimedia.path, multimedia.duration, multimedia.title,
-                       multimedia.description, multimedia.comment, ' '.join(tags), coords,
-                       location.id if location else 0,
-                       multimedia.year, multimedia.created, multimedia.size)
-    msg, style, obj = db_queries.create_mediafile(user_id, entry)
+    entry = build_mediafile(user_id, info, location.id if location else 0)
+    if mediafile_id:
+        values = {'path': entry.path, 'duration': entry.duration, 'size': entry.size,
+                  'title': entry.title, 'description': entry.description, 'comment': entry.comment,
+                  'tags': entry.tags, 'coords': entry.coords, 'location_id': entry.location_id,
+                  'year': entry.year or 0, 'created': entry.created, 'mtime': entry.mtime,
+                  'transcode': entry.transcode, 'geocode': entry.geocode, 'checksum': entry.checksum,
+                  'phash': entry.phash, 'updated': get_time_str()}
+        msg, style = db_queries.update_mediafile_values(mediafile_id, values)
+        obj = db_queries.get_mediafile(mediafile_id)
+    else:
+        msg, style, obj = db_queries.create_mediafile(user_id, entry)
     logging.debug('%s %s %s %s\n' % (get_time_str(), style.upper(), path, msg))
     return Data(obj, [] if obj else [msg])
 
 
+def add_mediafile(user_id, path, app_config):
+    """
+    Read metadata from the given photo or video file and create an entry in the database
+    containing all available metadata (see read_mediafile() and register_mediafile()).
+
+    :param user_id: an integer number of user id which will be considered as owner (0 for public).
+    :param path: an absolute path to the photo or video file.
+    :param app_config: a dictionary containing the application configuration settings (=app.config).
+    :return: an instance of Data() class, where
+             value is an instance of MediaFiles() class (or None if adding a media file failed),
+             and errors is the list of messages - empty if adding a media file was successful.
+    """
+    data = read_mediafile(path, app_config)
+    if not data.value:
+        return data
+    return register_mediafile(user_id, data.value)
+
+
 def update_settings_file(settings, conf_file_path):
     """
     Settings are loaded from conf.py (which takes them from persist/conf.json) at every launch.
@@ -392,6 +423,33 @@ def collect_settings(app_config):
     settings['MAX_FILESIZE'] = {'value': '%s bytes' % app_config['MAX_FILESIZE'],
                                 'comment': pretty_size(app_config['MAX_FILESIZE'])}
     settings['ITEMS_PER_PAGE'] = {'value': app_config['ITEMS_PER_PAGE'], 'comment': ''}
+    settings['SCAN_PHOTO_WORKERS'] = {'value': app_config['SCAN_PHOTO_WORKERS'],
+                                      'comment': 'Processes parsing photos during scan '
+                                                 '(0 - one per CPU core, %s)' % cpu_count()}
+    settings['SCAN_VIDEO_WORKERS'] = {'value': app_config['SCAN_VIDEO_WORKERS'],
+                                      'comment': 'Threads probing videos during scan'}
+    settings['SCAN_BATCH_SIZE'] = {'value': app_config['SCAN_BATCH_SIZE'],
+                                   'comment': 'Scanned files registered in the DB per transaction'}
+    settings['SCAN_BATCH_INTERVAL'] = {'value': '%s ms' % app_config['SCAN_BATCH_INTERVAL'],
+                                       'comment': 'Max delay before scanned files are registered'}
+    settings['TRANSCODE_WORKERS'] = {'value': app_config['TRANSCODE_WORKERS'],
+                                     'comment': 'Videos converted into MP4 at once (in all processes)'}
+    settings['GEONAMES_FILE'] = {'value': app_config['GEONAMES_FILE'],
+                                 'comment': 'Abs path to GeoNames dump of cities for offline geocoding'}
+    settings['NOMINATIM_FALLBACK'] = {'value': 'yes' if app_config['NOMINATIM_FALLBACK'] else 'no',
+                                      'comment': 'Query Nominatim online if offline geocoding fails'}
+    settings['GEOCODE_PRECISION'] = {'value': app_config['GEOCODE_PRECISION'],
+                                     'comment': 'Decimal digits of coordinates sharing cached geo lookups'}
+    settings['GEOCODE_CACHE_TTL'] = {'value': '%s days' % app_config['GEOCODE_CACHE_TTL'],
+                                     'comment': 'Time to keep cached geo lookups (see /_geocode_status)'}
+    settings['PERCEPTUAL_HASH'] = {'value': 'yes' if app_config['PERCEPTUAL_HASH'] else 'no',
+                                   'comment': 'Compute perceptual hashes of photos during scans to find similar ones'}
+    settings['THUMBNAIL_CACHE_SIZE'] = {'value': '%s MB' % app_config['THUMBNAIL_CACHE_SIZE'],
+                                        'comment': 'Max disk space for thumbnails of photos (least used are evicted)'}
+    settings['VIDEO_SPRITES'] = {'value': 'yes' if app_config['VIDEO_SPRITES'] else 'no',
+                                 'comment': 'Extract sprite sheets of videos to preview them on hover'}
+    settings['MEDIA_DELIVERY'] = {'value': app_config['MEDIA_DELIVERY'],
+                                  'comment': 'Send media files by Flask or by nginx (X-Accel-Redirect)'}
     return settings
 
 
@@ -399,34 +457,25 @@ def get_media_per_countries_counts(mediafiles):
     """
     Prepare data to be displayed on highmaps: a number of shapshots made in the country, geo points.
 
-    :param mediafiles: a list of dicts or query.all()-like results of mediafiles collected from DB.
+    :param mediafiles: a list of dicts or query.all()-like results of mediafiles collected from DB,
+                       or counts of mediafiles per place (dicts having 'count' key, see db_queries.count_by_places()).
 
     :return: a tuple of jsonified data (counts, points) prepared to be displayed on highmaps.
     """
-    points = []       # GeoPoints, list of dicts: {'name': <city>, 'lat': <latitude>, 'lon': <longitude>}
-    tmp_counts = {}   # A dictionary to group snapshots counts per country.
-    tmp_codes = {}    # A dictionary to keep country codes for countries.
-    tmp_cities = {}  # A dictionary to group snapshots counts per city.
+    points = []                 # GeoPoints, list of dicts: {'name': <city>, 'lat': <latitude>, 'lon': <longitude>}
+    tmp_counts = OrderedDict()  # A dictionary to group snapshots counts per country code.
+    tmp_cities = set()          # A set of cities already added to geo points.
     for mediafile in mediafiles:
         if 'coords' not in mediafile:
             mediafile = mediafile._asdict()
-        coords = mediafile['coords'].split(',')
-        for country in COUNTRIES:
-            if mediafile['code'].upper() == country['code']:
-                if country['name'] in tmp_counts:
-                    tmp_counts[country['name']] += 1
-                else:
-                    tmp_counts.update({country['name']: 1})
-                    tmp_codes.update({country['name']: country['code']})
-                if mediafile['city'] in tmp_cities:
-                    tmp_cities[mediafile['city']] += 1
-                else:
-                    tmp_cities.update({mediafile['city']: 1})
-                    points.append({'name': mediafile['city'].title(),
-                                   'lat': coords[0], 'lon': coords[-1]})
-    counts = [{'name': country_name,
-               'value': tmp_counts[country_name],
-               'code': tmp_codes[country_name]}
-              for country_name in tmp_counts]
+        code = (mediafile['code'] or '').upper()
+        if code not in COUNTRY_NAMES:
+            continue
+        tmp_counts[code] = tmp_counts.get(code, 0) + mediafile.get('count', 1)
+        if mediafile['city'] not in tmp_cities:
+            tmp_cities.add(mediafile['city'])
+            coords = (mediafile['coords'] or '').split(',')
+            points.append({'name': mediafile['city'].title(), 'lat': coords[0], 'lon': coords[-1]})
+    counts = [{'name': COUNTRY_NAMES[code], 'value': count, 'code': code} for code, count in tmp_counts.items()]
     points = {'name': 'Points', 'type': 'mappoint', 'data': points}
     return json.dumps(counts), json.dumps(points)
@@ -2,25 +2,30 @@
 import os
 import platform
 import subprocess
-import shutil
 import logging
 import datetime
 import re
 import json
+import struct
+import shutil
+import tempfile
 import piexif
 import piexif.helper
 from PIL import Image
 from ffmpy import FFmpeg, FFprobe, FFRuntimeError, FFExecutableNotFoundError
 from abc import ABC, abstractmethod
 from . import geo_tools
+from .mp4_atoms import read_mp4_metadata, write_mp4_metadata
 
 
 EMPTY = bytes(''.encode('utf8'))
+# A side (in pixels) of the grid a photo is reduced to for its perceptual hash (see Photo.perceptual_hash()):
+DHASH_SIZE = 8
 
 
-def get_file_ctime(path):
-    """Get file creation timestamp."""
-    if not os.path.isfile(path):
+def get_file_ctime(path, stat=None):
+    """Get file creation timestamp (the given os.stat_result of the file is used if available)."""
+    if not stat and not os.path.isfile(path):
         return None
     if platform.system().lower() == 'windows':
         # need getctime as https://docs.python.org/3/library/os.html#os.stat says,
@@ -29,9 +34,9 @@ def get_file_ctime(path):
         # os.stat_result(st_mode=33206, st_ino=562949953426081, st_dev=844210706, st_nlink=1,
         #                st_uid=0, st_gid=0, st_size=15618908, st_atime=1532179025,
         #                st_mtime=1296303144, st_ctime=1532179024)
-        return os.path.getmtime(path)
+        return stat.st_mtime if stat else os.path.getmtime(path)
     else:
-        stat = os.stat(path)
+        stat = stat or os.stat(path)
         try:
             return stat.st_birthtime
         except AttributeError:
@@ -40,6 +45,89 @@ def get_file_ctime(path):
             return stat.st_mtime
 
 
+def read_jpeg_exif(path):
+    """
+    Read the raw EXIF block of a JPEG file walking through its header segments only:
+    the image data (which follows the header) is neither read nor decoded.
+
+    :param path: an absolute path to the JPEG file.
+    :return: bytes of the APP1 segment containing EXIF data (starting with b'Exif\\x00\\x00',
+             like PIL.Image.info['exif'], so it can be passed to piexif.load()),
+             or None if the file is not a JPEG file or it has no EXIF data.
+    """
+    with open(path, 'rb') as stream:
+        if stream.read(2) != b'\xff\xd8':  # SOI marker
+            return None
+        while True:
+            marker = stream.read(2)
+            while marker[1:] == b'\xff':  # skip fill bytes
+                marker = marker[1:] + stream.read(1)
+            if len(marker) < 2 or marker[0] != 0xff or marker[1] in [0xd9, 0xda]:  # EOI or SOS - no more headers
+                return None
+            if marker[1] == 0x01 or 0xd0 <= marker[1] <= 0xd7:  # stand-alone markers have no length
+                continue
+            length = stream.read(2)
+            if len(length) < 2:
+                return None
+            length = int.from_bytes(length, 'big') - 2
+            if marker[1] == 0xe1:  # APP1 may contain EXIF (or XMP, which is skipped)
+                segment = stream.read(length)
+                if segment.startswith(b'Exif\x00\x00'):
+                    return segment
+            else:
+                stream.seek(length, os.SEEK_CUR)
+
+
+def write_jpeg_exif(path, exif):
+    """
+    Replace the EXIF block of a JPEG file (or insert it if missing) by splicing header segments, like
+    piexif.insert() does: the image data is copied byte by byte, never decoded, so the file remains
+    bit-identical apart from the metadata. The result is written into a temporary file next to the original,
+    which then replaces the original atomically.
+
+    :param path: an absolute path to the JPEG file.
+    :param exif: bytes of EXIF data starting with b'Exif\\x00\\x00' (e.g. as returned by piexif.dump()).
+    :raise ValueError: if the file is not a JPEG file or EXIF data does not fit into a single segment.
+    """
+    if len(exif) + 2 > 0xffff:
+        raise ValueError('EXIF data is too big: %s bytes.' % len(exif))
+    app1 = b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif
+    handle, tmp_path = tempfile.mkstemp(prefix='.', suffix='.part', dir=os.path.dirname(path))
+    try:
+        with open(path, 'rb') as source, os.fdopen(handle, 'wb') as target:
+            if source.read(2) != b'\xff\xd8':  # SOI marker
+                raise ValueError('"%s" is not a JPEG file.' % path)
+            target.write(b'\xff\xd8')
+            written = False
+            while True:
+                marker = source.read(2)
+                while marker[1:] == b'\xff':  # skip fill bytes
+                    marker = marker[1:] + source.read(1)
+                if len(marker) < 2 or marker[0] != 0xff:
+                    raise ValueError('Malformed header of "%s".' % path)
+                if not written and marker[1] != 0xe0:  # EXIF goes right after SOI or JFIF (APP0) segment
+                    target.write(app1)
+                    written = True
+                if marker[1] in [0xd9, 0xda]:  # EOI or SOS - the rest is copied as is
+                    target.write(marker)
+                    break
+                if marker[1] == 0x01 or 0xd0 <= marker[1] <= 0xd7:  # stand-alone markers have no length
+                    target.write(marker)
+                    continue
+                length = source.read(2)
+                segment = source.read(struct.unpack('>H', length)[0] - 2)
+                if not (marker[1] == 0xe1 and segment.startswith(b'Exif\x00\x00')):  # drop the old EXIF
+                    target.write(marker + length + segment)
+            shutil.copyfileobj(source, target)
+            target.flush()
+            os.fsync(target.fileno())
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
 def format_timestamp(timestamp, fmt='%Y-%m-%d %H:%M:%S.%f'):
     """Convert given timestamp into string in a human-friendly format."""
     return datetime.datetime.fromtimestamp(timestamp).strftime(fmt)
@@ -47,9 +135,14 @@ def format_timestamp(timestamp, fmt='%Y-%m-%d %H:%M:%S.%f'):
 
 class Media(ABC):
 
-    def __init__(self, path):
+    def __init__(self, path, stat=None):
+        """
+        :param path: an absolute path to the media file.
+        :param stat: an os.stat_result of the file if it is already known (e.g. from a directory scan).
+        """
         self.path = path
-        self.size = os.path.getsize(path) if os.path.isfile(path) else None
+        self.stat = stat or (os.stat(path) if os.path.isfile(path) else None)
+        self.size = self.stat.st_size if self.stat else None
         self.media = None
         self.metadata = self.read_metadata()
         self.duration = None
@@ -89,12 +182,21 @@ class Media(ABC):
                 return int(self.created[:4])
             except ValueError:
                 logging.warning('Could not extract year from "%s".' % self.created)
-        timestamp = get_file_ctime(self.path)
+        timestamp = get_file_ctime(self.path, self.stat)
         if timestamp:
             return format_timestamp(timestamp, '%Y')
         logging.warning('Could not detect year for "%s".' % self.path)
         return None
 
+    def geocode(self):
+        """
+        Detect city, country and country code by GPS coordinates if they are not known yet.
+        Note: this is a blocking lookup, scans leave it to the geocoding queue (see geocoder.py).
+        """
+        if self.gps['latitude'] and self.gps['longitude'] and not self.gps['city']:
+            city, country, code = geo_tools.get_address(self.gps['latitude'], self.gps['longitude'])
+            self.gps.update({'city': city, 'country': country, 'code': code})
+
     def __str__(self):
         """Override __str__ to be able to print() the object in a human-friendly mode."""
         gps = 'coords=(%s,%s)\tcountry=%s\tcity=%s' % \
@@ -111,10 +213,22 @@ class Media(ABC):
 class Photo(Media):
     """A class to read & write metadata inside a photo file using Python PIL and piexif modules."""
 
-    def __init__(self, path):
-        super().__init__(path)
+    def __init__(self, path, stat=None):
+        self._media = None
+        super().__init__(path, stat)
         self.duration = 0  # All images have 0 duration
 
+    @property
+    def media(self):
+        """The PIL image - it is opened on first access only, since reading metadata does not need it."""
+        if self._media is None:
+            self._media = self.load_media()
+        return self._media
+
+    @media.setter
+    def media(self, value):
+        self._media = value
+
     def load_media(self):
         """Load the Photo JPEG-file using PIL.image()."""
         image = None
@@ -124,9 +238,34 @@ class Photo(Media):
             logging.error('Could not read media: %s.' % err)
         return image
 
+    def perceptual_hash(self):
+        """
+        Compute a difference hash (dHash) of the photo: the photo is reduced to a grayscale grid of
+        (DHASH_SIZE + 1) x DHASH_SIZE pixels, and every bit tells whether a pixel is brighter than its right
+        neighbour. Resized, recompressed or slightly edited copies and burst shots get hashes differing
+        in a few bits only. The JPEG is decoded in draft mode (downscaled by the decoder), so it is fast.
+
+        :return: a 64-bit signed integer (to fit PostgreSQL BIGINT), or None if the photo cannot be decoded.
+        """
+        if self.media is None:
+            return None
+        try:
+            self.media.draft('L', (DHASH_SIZE * 16, DHASH_SIZE * 16))
+            pixels = list(self.media.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR).getdata())
+        except (IOError, ValueError) as err:
+            logging.error('Could not compute perceptual hash of %s: %s.' % (self.path, err))
+            return None
+        value = 0
+        for row in range(DHASH_SIZE):
+            for col in range(DHASH_SIZE):
+                offset = row * (DHASH_SIZE + 1) + col
+                value = value << 1 | (pixels[offset] > pixels[offset + 1])
+        return value - (1 << 64) if value >= 1 << 63 else value
+
     def read_metadata(self):
         """
-        Obtain EXIF metadata of the Photo JPEG-file using piexif.load().
+        Obtain EXIF metadata of the Photo JPEG-file using piexif.load() -
+        only the EXIF segment is read from the file header (see read_jpeg_exif()), PIL is not involved.
         Note: as mentioned at http://dev.exiv2.org/projects/exiv2/wiki/The_Metadata_in_JPEG_files,
         besides JPEG/Exif there is a high probability to meet photos of JPEG/JFIF format since it is
         also popular - in this case read_metadata() will return None,
@@ -134,13 +273,20 @@ class Photo(Media):
         (and this is taken care of in _parse_metadata() method).
         """
         metadata = None
-        self.media = self.load_media()
-        if self.media and self.media.info and 'exif' in self.media.info:
-            metadata = piexif.load(self.media.info['exif'])
+        try:
+            exif = read_jpeg_exif(self.path)
+        except IOError as err:
+            logging.error('Could not read media: %s.' % err)
+            exif = None
+        if exif:
+            metadata = piexif.load(exif)
         return metadata
 
     def write_metadata(self, title, description, tags, comment, gps=None, datetime=None):
-        """Update EXIF metadata of the Photo JPEG-file using piexif.dump() and PIL.image.save()."""
+        """
+        Update EXIF metadata of the Photo JPEG-file using piexif.dump() and write_jpeg_exif() -
+        only the EXIF segment of the file is replaced, the image is not re-encoded.
+        """
         if not self.metadata:
             return False
         if datetime:  # e.g. '2015:01:29 21:29:29'
@@ -156,12 +302,10 @@ class Photo(Media):
             {key: value or '' for key, value in gps.items()}
         exif_bytes = piexif.dump(self.metadata)
         try:
-            self.media.save(self.path, 'jpeg', exif=exif_bytes)
-        except IOError as err:
+            write_jpeg_exif(self.path, exif_bytes)
+        except (IOError, ValueError, struct.error) as err:
             logging.error('Cannot save "%s" after metadata update due to: %s.' % (self.path, err))
             return False
-        finally:
-            self.media.close()
         return True
 
     def _get_exif_datetime(self):
@@ -208,7 +352,7 @@ class Photo(Media):
         """Collect desired values from EXIF data and keep them as attributes."""
         if not self.metadata:  # E.g. if we have a photo of JPEG/JFIF format instead of JPEG/Exif
             # Then just keep file creation time and extract year from it:
-            timestamp = get_file_ctime(self.path)
+            timestamp = get_file_ctime(self.path, self.stat)
             if timestamp:
                 timestamp = int(timestamp)
                 self.created = format_timestamp(timestamp // 1000 if len(str(timestamp)) > 10 else timestamp,
@@ -223,7 +367,7 @@ class Photo(Media):
         self.tags = self.__get_metadata_value('0th', piexif.ImageIFD.ImageHistory)
         self.created = self._get_exif_datetime() or ''
         self.year = self.year or self._get_year() or ''
-        # Now try to get GPSMapDatum value if exists, or collect GPS tags and convert to address
+        # Now try to get GPSMapDatum value if exists, or collect GPS tags (address is detected later, see geocode())
         gps_info = self.__get_metadata_value('GPS', piexif.GPSIFD.GPSMapDatum).split(',')
         try:  # attempt to keep at least city+country if coords are not set
             self.gps = {'city': gps_info[2].strip(), 'country': gps_info[3].strip(),
@@ -234,9 +378,7 @@ class Photo(Media):
             logging.warning('Failed to read GPSDatum value for %s.' % self.path)
             latitude, longitude = self._get_exif_gps_coords()
             if latitude and longitude:
-                city, country, code = geo_tools.get_address(latitude, longitude)
-                self.gps = {'city': city, 'country': country, 'code': code,
-                            'latitude': latitude, 'longitude': longitude}
+                self.gps = {'city': '', 'country': '', 'code': '', 'latitude': latitude, 'longitude': longitude}
             else:
                 logging.warning('EXIF GPS info is incorrect/missing for %s: %s' % (self.path, err))
                 return False
@@ -256,14 +398,16 @@ class Video(Media):
     Note, once video files are imported/uploaded into MetaPhotor - they are converted into MP4.
     """
 
-    def __init__(self, path, ffmpeg_path, ffprobe_path):
+    def __init__(self, path, ffmpeg_path, ffprobe_path, stat=None):
         self.ffmpeg = ffmpeg_path
         self.ffprobe = ffprobe_path
-        super().__init__(path)
+        super().__init__(path, stat)
 
     def read_metadata(self):
         """
-        Obtain metadata of the video file in JSON format using FFprobe from FFMPEG.
+        Obtain metadata of the video file in JSON format: MP4/MOV files are parsed natively
+        (see mp4_atoms.read_mp4_metadata() - it costs no process spawn), other containers
+        (and files which cannot be parsed natively) are probed using FFprobe from FFMPEG.
 
         :Example of equivalent of FFprobe command and its output:
 
@@ -295,6 +439,9 @@ class Video(Media):
             }
         }
         """
+        metadata = read_mp4_metadata(self.path)
+        if metadata is not None:
+            return metadata
         ffprobe = FFprobe(self.ffprobe,
                           global_options=['-v', 'quiet', '-print_format', 'json',
                                           '-show_format', '-show_private_data'],
@@ -312,36 +459,29 @@ class Video(Media):
     def convert_to_mp4(self, options=' -y -vcodec h264 -acodec aac -strict -2 -b:a 384k '):
         """
         Convert a video file into MP4 (tested on .3gp, .mov, mpg, .avi, .mp4).
-        Before conversion, a temporary file is created and after operation it is removed.
-        If successful, the source file is also removed.
+        The output is written into a partial file next to the source (so the source may have the same
+        name as the result, e.g. when metadata of MP4 file is updated), which replaces the resulting
+        file only once conversion succeeds. If successful, the source file is also removed.
 
         :Example of equivalent of FFMPEG command:
 
-        > ffmpeg.exe -y -i video.mov.tmp  -vcodec h264 -acodec aac -strict -2 -b:a 384k  video.mp4
+        > ffmpeg.exe -y -i video.mov -vcodec h264 -acodec aac -strict -2 -b:a 384k -f mp4 video.MP4.part
         """
-        tmp_path = '%s.tmp' % self.path
         new_path = self.path[:self.path.rfind('.')] + '.MP4'
-        # Create a temporary file:
-        try:
-            shutil.copy(self.path, tmp_path)
-        except IOError as err:
-            logging.error('Cannot create a temporary copy "%s" due to %s.' % (tmp_path, err))
-            return ''
+        part_path = '%s.part' % new_path  # not an allowed extension, so it is never scanned
         try:
             ffmpeg = FFmpeg(self.ffmpeg,
-                            inputs={tmp_path: None},
-                            outputs={new_path: options or ''})
+                            inputs={self.path: None},
+                            outputs={part_path: '%s -f mp4' % (options or '')})
             logging.info('Running FFmpeg command: %s.' % ffmpeg.cmd)
             stderr, stdout = ffmpeg.run(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            logging.info('Converted "%s" into "%s".' % (tmp_path, new_path))
-        except (FFRuntimeError, FFExecutableNotFoundError) as err:
-            logging.error('Cannot convert "%s" -> "%s" due to %s.' % (tmp_path, new_path, err))
+            os.replace(part_path, new_path)
+            logging.info('Converted "%s" into "%s".' % (self.path, new_path))
+        except (FFRuntimeError, FFExecutableNotFoundError, OSError) as err:
+            logging.error('Cannot convert "%s" -> "%s" due to %s.' % (self.path, new_path, err))
+            if os.path.isfile(part_path):
+                os.remove(part_path)
             return ''
-        finally:
-            # Remove the temporary file
-            if os.path.isfile(tmp_path):
-                os.remove(tmp_path)
-                logging.info('Removed temporary file "%s".' % tmp_path)
         # Remove non-MP4 source file if any
         if self.path.lower() != new_path.lower() and os.path.isfile(self.path):
             os.remove(self.path)
@@ -349,16 +489,63 @@ class Video(Media):
         self.path = new_path
         return '\n'.join([stdout.decode('utf-8', 'ignore'), stderr.decode('utf-8', 'ignore')])
 
+    def extract_previews(self, poster_path, poster_width, sprite_path=None, sprite_frames=10, sprite_width=160):
+        """
+        Extract a poster frame and (optionally) a sprite sheet of frames evenly spread over the video
+        in one pass of FFMPEG. Only key frames are decoded, so it is fast even for long videos:
+        the poster is the first key frame after 1 second (to skip fade-ins), the sprite sheet is a row
+        of sprite_frames frames sprite_width pixels wide each.
+
+        :Example of equivalent of FFMPEG command:
+
+        > ffmpeg.exe -y -v error -skip_frame nokey -i video.mp4 -filter_complex \
+          "[0:v]split=2[p][s];[p]select='gte(t,1)',scale='min(640,iw)':-2[poster];\
+           [s]fps=10/7.531,scale=160:-2,tile=10x1[sprite]" \
+          -map [poster] -frames:v 1 -c:v mjpeg -q:v 3 -f image2 poster.jpg \
+          -map [sprite] -frames:v 1 -c:v mjpeg -q:v 5 -f image2 sprite.jpg
+
+        :param poster_path: an absolute path to the poster JPEG file to be written.
+        :param poster_width: a maximum width of the poster in pixels.
+        :param sprite_path: an absolute path to the sprite sheet JPEG file (None to skip it).
+        :param sprite_frames: a number of frames in the sprite sheet.
+        :param sprite_width: a width of every frame of the sprite sheet in pixels.
+        :return: True if FFMPEG succeeded, False otherwise.
+        """
+        duration = self.duration if self.duration and self.duration > 0 else 0
+        start = 1 if duration > 2 else 0
+        graph = "[0:v]select='gte(t,%s)',scale='min(%s,iw)':-2[poster]" % (start, poster_width)
+        outputs = {poster_path: '-map [poster] -frames:v 1 -c:v mjpeg -q:v 3 -f image2'}
+        if sprite_path and duration:
+            graph = "[0:v]split=2[p][s];[p]select='gte(t,%s)',scale='min(%s,iw)':-2[poster];" \
+                    "[s]fps=%s/%s,scale=%s:-2,tile=%sx1[sprite]" % \
+                    (start, poster_width, sprite_frames, duration, sprite_width, sprite_frames)
+            outputs[sprite_path] = '-map [sprite] -frames:v 1 -c:v mjpeg -q:v 5 -f image2'
+        try:
+            ffmpeg = FFmpeg(self.ffmpeg,
+                            global_options=['-y', '-v', 'error', '-filter_complex', graph],
+                            inputs={self.path: '-skip_frame nokey'},
+                            outputs=outputs)
+            logging.debug('Running FFmpeg command: %s.' % ffmpeg.cmd)
+            ffmpeg.run(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except (FFRuntimeError, FFExecutableNotFoundError) as err:
+            logging.error('Cannot extract previews of "%s" due to %s.' % (self.path, err))
+            return False
+        return True
+
     def write_metadata(self, title, description, tags, comment, gps=None, datetime=None):
         """
         Write metadata inside a video file.
         Notes:
+        0) MP4/MOV files are updated natively and in place (see mp4_atoms.write_mp4_metadata()):
+           only the movie atom (kilobytes) is rewritten, the media data is left intact.
+           FFMPEG (re-muxing the whole file) is used if the file cannot be updated natively.
+
         1) since with FFMPEG it is not possible to write metadata into the same file at once,
            then for FFMPEG command we must provide:
               an input file name, metadata parameters and the output file name,
            and if both files have same name, the command will fail
            (video will be spoiled: only first frame will remain).
-           So, before metadata update, a temporary copy of the video file is created.
+           So, the output is written into a partial file which then replaces the video file (see convert_to_mp4()).
 
         2) Metadata fields 'title', 'description', 'comment', 'copyright', 'grouping', 'album'
            are supported by MP4 format, and the other video formats have less supported fields.
@@ -375,14 +562,25 @@ class Video(Media):
            -metadata album="53.87303611111111,27.65790833333333,minsk,belarus,by" \
            -vcodec copy -acodec copy   video.mp4
         """
-        gps = '%(latitude)s,%(longitude)s,%(city)s,%(country)s,%(code)s' % \
-              {key: value or '' for key, value in gps.items()}
-        metadata = {'title': title, 'description': description, 'comment': comment,
-                    'grouping': tags, 'album': gps or '', 'copyright': datetime or self.year or ''}
-        options = ' -metadata '.join(['%s="%s"' % (key, metadata[key]) for key in metadata.keys()])
-        ffmpeg_output = self.convert_to_mp4(' -y -vcodec copy -acodec copy  -metadata ' + options)
+        metadata = self.metadata_values(title, description, tags, comment, gps, datetime)
+        if write_mp4_metadata(self.path, metadata):
+            logging.info('Metadata of "%s" has been updated in place.' % self.path)
+            return 'Metadata of "%s" has been updated in place.' % self.path
+        ffmpeg_output = self.convert_to_mp4(' -y -vcodec copy -acodec copy ' + self.metadata_options(metadata))
         return ffmpeg_output
 
+    def metadata_values(self, title, description, tags, comment, gps=None, datetime=None):
+        """Return a dictionary of metadata values by tag names (see write_metadata() for details)."""
+        gps = '%(latitude)s,%(longitude)s,%(city)s,%(country)s,%(code)s' % \
+              {key: value or '' for key, value in gps.items()} if gps else ''
+        return {'title': title, 'description': description, 'comment': comment,
+                'grouping': tags, 'album': gps or '', 'copyright': datetime or self.year or ''}
+
+    @staticmethod
+    def metadata_options(metadata):
+        """Return FFMPEG options to write the given dictionary of metadata values by tag names."""
+        return ' -metadata ' + ' -metadata '.join(['%s="%s"' % (key, metadata[key]) for key in metadata.keys()])
+
     def __get_metadata_value(self, item, default, from_tag=True):
         if from_tag:
             return self.metadata.get('format', {}).get('tags', {}).get(item, default).strip()
@@ -396,7 +594,7 @@ class Video(Media):
         self.tags = self.__get_metadata_value('grouping', '')
         self.comment = self.__get_metadata_value('comment', '')
         self.created = self.__get_metadata_value('copyright', '') \
-                       or format_timestamp(get_file_ctime(self.path), '%Y-%m-%d %H:%M:%S')
+                       or format_timestamp(get_file_ctime(self.path, self.stat), '%Y-%m-%d %H:%M:%S')
         self.year = self.year or self._get_year() or ''
         gps_info = self.__get_metadata_value('album', '')
         if gps_info:
@@ -422,17 +620,19 @@ class MultiMedia:
         and return an object of a protocol class derived from Manifest() class.
 
         :param path: an absolute path to the file.
+        :param app_config: a dictionary containing the application configuration settings (=app.config).
+        :param kwargs: ffmpeg_path & ffprobe_path (required for videos), stat (optional os.stat_result).
 
         :return: an instance of Photo or Video class. Return None if file extension is unexpected.
         """
         result_obj = None
         file_extension = path[path.rfind('.') + 1:].lower()
         if file_extension in ['jpg', 'jpeg']:
-            result_obj = Photo(path)
+            result_obj = Photo(path, kwargs.get('stat'))
         elif file_extension in app_config['ALLOWED_EXTENSIONS']:
             if not (os.path.isfile(kwargs.get('ffmpeg_path', ''))
                     and os.path.isfile(kwargs.get('ffprobe_path', ''))):
                 logging.error('Cannot find FFMPEG/FFProbe executables. Check MetaPhotor settings.')
             else:
-                result_obj = Video(path, kwargs['ffmpeg_path'], kwargs['ffprobe_path'])
+                result_obj = Video(path, kwargs['ffmpeg_path'], kwargs['ffprobe_path'], kwargs.get('stat'))
         return result_obj
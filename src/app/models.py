@@ -1,8 +1,11 @@
 import json
+import random
+from collections import OrderedDict
 from datetime import datetime
 from flask_sqlalchemy import Pagination
 from sqlalchemy import exc
-from sqlalchemy import Column, String, Integer, Float, Text, ForeignKey, create_engine
+from sqlalchemy import Column, String, Integer, BigInteger, Float, Text, ForeignKey, create_engine
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import sessionmaker, scoped_session, relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 from app import app
@@ -17,6 +20,62 @@ db_session = scoped_session(sessionmaker(autocommit=False,
 Base = declarative_base()
 Base.query = db_session.query_property()
 
+# Idempotent statements to bring tables created by older versions up to date
+# (Base.metadata.create_all() creates missing tables only, but never alters existing ones):
+SCHEMA_UPGRADES = [
+    'ALTER TABLE mediafiles ADD COLUMN IF NOT EXISTS mtime FLOAT',
+    "ALTER TABLE mediafiles ADD COLUMN IF NOT EXISTS transcode VARCHAR(10) DEFAULT ''",
+    "CREATE INDEX IF NOT EXISTS ix_mediafiles_transcode ON mediafiles (transcode) WHERE transcode <> ''",
+    "ALTER TABLE mediafiles ADD COLUMN IF NOT EXISTS geocode VARCHAR(10) DEFAULT ''",
+    "CREATE INDEX IF NOT EXISTS ix_mediafiles_geocode ON mediafiles (geocode) WHERE geocode <> ''",
+    'ALTER TABLE mediafiles ADD COLUMN IF NOT EXISTS checksum VARCHAR(32)',
+    'CREATE INDEX IF NOT EXISTS ix_mediafiles_checksum ON mediafiles (checksum)',
+    'ALTER TABLE mediafiles ADD COLUMN IF NOT EXISTS phash BIGINT',
+    # Indexes backing stable orders of search results (see db_queries.SORT_ORDERS):
+    'CREATE INDEX IF NOT EXISTS ix_mediafiles_created_id ON mediafiles (created, id)',
+    'CREATE INDEX IF NOT EXISTS ix_mediafiles_year_id ON mediafiles ((COALESCE(year, 0)), id)',
+    'CREATE INDEX IF NOT EXISTS ix_mediafiles_visits_id ON mediafiles (visits, id)',
+    'ALTER TABLE mediafiles ADD COLUMN IF NOT EXISTS shuffle_key FLOAT DEFAULT random()',
+    'CREATE INDEX IF NOT EXISTS ix_mediafiles_shuffle_key_id ON mediafiles (shuffle_key, id)',
+    # Full-text search (see db_queries.get_search_query()): a weighted vector of words maintained by a trigger
+    # (paths are split into words by separators), and trigram indexes to match substrings with LIKE:
+    'ALTER TABLE mediafiles ADD COLUMN IF NOT EXISTS search_vector TSVECTOR',
+    '''CREATE OR REPLACE FUNCTION mediafiles_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('simple', COALESCE(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('simple', COALESCE(NEW.description, '')), 'B') ||
+        setweight(to_tsvector('simple', COALESCE(NEW.comment, '')), 'C') ||
+        setweight(to_tsvector('simple', translate(COALESCE(NEW.path, ''), '/._-', '    ')), 'D');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql''',
+    '''DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'mediafiles_search_vector_update') THEN
+        CREATE TRIGGER mediafiles_search_vector_update
+            BEFORE INSERT OR UPDATE OF title, description, comment, path ON mediafiles
+            FOR EACH ROW EXECUTE PROCEDURE mediafiles_search_vector();
+    END IF;
+END
+$$''',
+    'CREATE INDEX IF NOT EXISTS ix_mediafiles_search_vector ON mediafiles USING GIN (search_vector)',
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_mediafiles_path_trgm ON mediafiles USING GIN (path gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_mediafiles_title_trgm ON mediafiles USING GIN (title gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_mediafiles_description_trgm ON mediafiles USING GIN (description gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_mediafiles_comment_trgm ON mediafiles USING GIN (comment gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_mediafiles_tags_trgm ON mediafiles USING GIN (tags gin_trgm_ops)',
+]
+# One-off statements filling in columns added by SCHEMA_UPGRADES for existing rows, by names they are
+# recorded by in 'schema_upgrades' table once applied (so that they never scan the table again):
+DATA_UPGRADES = OrderedDict([
+    ('shuffle_key', 'UPDATE mediafiles SET shuffle_key = random() WHERE shuffle_key IS NULL'),
+    ('search_vector', 'UPDATE mediafiles SET path = path WHERE search_vector IS NULL'),  # fired by the trigger
+])
+# A key of the PostgreSQL advisory lock serializing upgrades started by several processes at once:
+SCHEMA_LOCK_KEY = 20200601
+
 
 def to_dict(data, columns):
     """Convert a model class instance into a dictionary."""
@@ -42,10 +101,16 @@ def get_time_str():
     return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
 
-def paginate(query, page, per_page):
-    """Create a Pagination instance to be used in HTML templates."""
-    items = query.limit(per_page).offset((page - 1) * per_page).all()
-    pagination = Pagination(query, page, per_page, query.count(), items)
+def paginate(query, page, per_page, items=None, total=None):
+    """
+    Create a Pagination instance to be used in HTML templates.
+    Items of the page are fetched by skipping rows of previous pages unless they are given
+    (e.g. found by keyset pagination, see db_queries.get_page()).
+    The total number of items is counted by the query unless it is given (e.g. already known from an aggregate).
+    """
+    if items is None:
+        items = query.limit(per_page).offset((page - 1) * per_page).all()
+    pagination = Pagination(query, page, per_page, query.count() if total is None else total, items)
     return pagination
 
 
@@ -71,9 +136,17 @@ class MediaFiles(Base):
     updated = Column(String(30))
     accessed = Column(String(30))
     visits = Column(Integer)
+    mtime = Column(Float)  # last modification timestamp of the file, to detect changes on re-scan
+    transcode = Column(String(10), default='')  # conversion into MP4: '', 'pending', 'running' or 'failed'
+    geocode = Column(String(10), default='')  # detection of location by coords: '', 'pending', 'running', 'failed'
+    checksum = Column(String(32), index=True)  # a hash of the file content to detect duplicates
+    phash = Column(BigInteger)  # a perceptual hash of a photo to find similar ones (see similarity.py)
+    shuffle_key = Column(Float)  # a random number from 0 to 1 to shuffle search results (see db_queries.get_page())
+    search_vector = Column(TSVECTOR)  # words of title, description, comment and path, maintained by a trigger
 
     def __init__(self, user_relation, path, duration, title, description, comment, tags,
-                 coords, location_relation, year, created, size):
+                 coords, location_relation, year, created, size, mtime=None, transcode='', geocode='',
+                 checksum=None, phash=None):
         """
         An initializer for the database entry object.
         Note: Adding .replace('\x00', '') to string literals to avoid PostgreSQL error:
@@ -97,6 +170,12 @@ class MediaFiles(Base):
         self.updated = ''
         self.accessed = ''
         self.visits = 0
+        self.mtime = mtime
+        self.transcode = transcode
+        self.geocode = geocode
+        self.checksum = checksum
+        self.phash = phash
+        self.shuffle_key = random.random()
 
     def __repr__(self):
         return '[Metadata for file #%s]' % self.id
@@ -187,10 +266,103 @@ class Locations(Base):
         return info
 
 
+class ScanJobs(Base):
+    __tablename__ = 'scan_jobs'
+
+    id = Column(Integer, primary_key=True)
+    folder = Column(Text())
+    status = Column(String(20))  # running, cancelling, completed, cancelled, failed
+    total = Column(Integer)      # files to be parsed (grows while the folder is being walked)
+    passed = Column(Integer)
+    failed = Column(Integer)
+    declined = Column(Integer)   # files skipped without parsing (e.g. not supported extension)
+    started = Column(String(30))
+    updated = Column(String(30))
+    finished = Column(String(30))
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.status = 'running'
+        self.total = self.passed = self.failed = self.declined = 0
+        self.started = self.updated = get_time_str()
+        self.finished = ''
+
+    def __repr__(self):
+        return '[Scan job #%s]' % self.id
+
+
+class ScanIssues(Base):
+    __tablename__ = 'scan_issues'
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey('scan_jobs.id', ondelete='CASCADE'), index=True)
+    path = Column(Text())
+    reason = Column(String(20))  # declined or failed
+
+    def __init__(self, job_id, path, reason):
+        self.job_id = job_id
+        self.path = path
+        self.reason = reason
+
+    def __repr__(self):
+        return '[Scan issue #%s]' % self.id
+
+
+class DuplicateFiles(Base):
+    """Copies of registered media files (same content, another path) skipped by scans."""
+    __tablename__ = 'duplicate_files'
+
+    id = Column(Integer, primary_key=True)
+    path = Column(Text(), unique=True)
+    checksum = Column(String(32), index=True)
+    size = Column(Integer)
+    mtime = Column(Float)
+    mediafile_id = Column(Integer, ForeignKey('mediafiles.id', ondelete='CASCADE'), index=True)  # the original
+
+    def __init__(self, path, checksum, size, mtime, mediafile_id):
+        self.path = path
+        self.checksum = checksum
+        self.size = size
+        self.mtime = mtime
+        self.mediafile_id = mediafile_id
+
+    def __repr__(self):
+        return '[Duplicate file #%s]' % self.id
+
+
+class SchemaUpgrades(Base):
+    """Names of DATA_UPGRADES which have been applied."""
+    __tablename__ = 'schema_upgrades'
+
+    name = Column(String(50), primary_key=True)
+    applied = Column(String(30))
+
+    def __repr__(self):
+        return '[Schema upgrade %s]' % self.name
+
+
+def upgrade_schema():
+    """
+    Create missing tables, apply SCHEMA_UPGRADES and DATA_UPGRADES which have not been applied yet.
+    Every process (e.g. uWSGI worker) does it on startup, so upgrades are serialized by an advisory lock
+    held until the end of the transaction they all run in.
+    """
+    with engine.begin() as connection:
+        connection.execute('SELECT pg_advisory_xact_lock(%s)' % SCHEMA_LOCK_KEY)
+        Base.metadata.create_all(connection)
+        for statement in SCHEMA_UPGRADES:
+            connection.execute(statement)
+        applied = {row[0] for row in connection.execute(SchemaUpgrades.__table__.select())}
+        for name, statement in DATA_UPGRADES.items():
+            if name not in applied:
+                connection.execute(statement)
+                connection.execute(SchemaUpgrades.__table__.insert().values(name=name, applied=get_time_str()))
+
+
 @app.before_first_request
 def startup():
     """Create database and all the tables, insert all predefined data into tables."""
-    Base.metadata.create_all(engine)
+    upgrade_schema()
     # Add all predefined locations, default (unknown) location will have id=0:
     for place in PLACES:
         latitude, longitude, city, country, code = place
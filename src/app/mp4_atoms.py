@@ -0,0 +1,412 @@
+"""
+A module to read metadata of MP4/MOV (ISO base media / QuickTime) files natively, i.e. without FFprobe:
+only the atoms (boxes) describing the movie are read - ftyp, moov/mvhd and moov/udta (QuickTime user data
+strings, iTunes-style meta/ilst items) and moov/meta (QuickTime metadata keys) - media data is skipped.
+The result has the same shape as FFprobe JSON output (see Video.read_metadata()).
+
+Metadata can be written natively as well, i.e. without FFMPEG re-muxing the whole file:
+only the movie atom is rewritten - in place if it fits, otherwise it is appended to the end of the file
+(see write_mp4_metadata()), media data is never moved.
+
+The module has no dependencies, so it can be run as a script to benchmark it against FFprobe:
+
+> python app/mp4_atoms.py /usr/bin/ffprobe video1.mp4 video2.mov ...
+"""
+import os
+import struct
+import logging
+
+
+# Extensions of containers based on the ISO base media file format (= QuickTime atoms):
+MP4_EXTENSIONS = ['mp4', 'm4v', 'mov', 'qt', '3gp', '3g2']
+# Atom types which may appear at the top level of a supported file:
+TOP_LEVEL_ATOMS = [b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot', b'uuid', b'pdin', b'meta']
+# Metadata atoms mapped to tag names as FFprobe reports them (see 'mov' demuxer of FFMPEG):
+TAG_NAMES = {b'\xa9nam': 'title', b'\xa9ART': 'artist', b'aART': 'album_artist', b'\xa9alb': 'album',
+             b'\xa9grp': 'grouping', b'\xa9wrt': 'composer', b'\xa9day': 'date', b'\xa9cmt': 'comment',
+             b'\xa9gen': 'genre', b'\xa9too': 'encoder', b'\xa9lyr': 'lyrics', b'cprt': 'copyright',
+             b'\xa9cpy': 'copyright', b'desc': 'description', b'\xa9des': 'description', b'ldes': 'synopsis',
+             b'tvsh': 'show', b'tven': 'episode_id', b'tvnn': 'network', b'\xa9xyz': 'location'}
+# Type indicators of text values in 'data' atoms: UTF-8 and UTF-16 (big endian):
+DATA_ENCODINGS = {1: 'utf-8', 2: 'utf-16-be'}
+# Atoms of 'ilst' items to write tags into (as FFMPEG does for MP4 files):
+TAG_ATOMS = {'title': b'\xa9nam', 'album': b'\xa9alb', 'grouping': b'\xa9grp', 'comment': b'\xa9cmt',
+             'copyright': b'cprt', 'description': b'desc', 'artist': b'\xa9ART', 'date': b'\xa9day',
+             'genre': b'\xa9gen', 'composer': b'\xa9wrt', 'synopsis': b'ldes'}
+# A number of bytes of free space kept after the movie atom whenever it is rewritten, so that next edits fit in place:
+PADDING = 1024
+
+
+class UnsupportedContainer(Exception):
+    """Raised when the file cannot be handled natively (e.g. it is fragmented or malformed)."""
+
+
+def iter_atoms(stream, start, end):
+    """
+    Iterate over atoms stored one after another in the given range of the file.
+
+    :param stream: a file object opened in binary mode.
+    :param start: an offset of the first atom.
+    :param end: an offset where the last atom ends (e.g. the end of the parent atom or of the file).
+    :return: a generator of tuples (atom_type, offset, header_size, size) - size includes the header.
+    """
+    offset = start
+    while offset + 8 <= end:
+        stream.seek(offset)
+        size, atom_type = struct.unpack('>I4s', stream.read(8))
+        header_size = 8
+        if size == 1:  # 64-bit size follows the type
+            size = struct.unpack('>Q', stream.read(8))[0]
+            header_size = 16
+        elif size == 0:  # the atom lasts until the end of the file/parent
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise UnsupportedContainer('Malformed atom "%s" at offset %s.' % (atom_type, offset))
+        yield atom_type, offset, header_size, size
+        offset += size
+
+
+def find_atom(stream, start, end, atom_type):
+    """Return a tuple (offset, header_size, size) of the first child atom of the given type, or None."""
+    for child_type, offset, header_size, size in iter_atoms(stream, start, end):
+        if child_type == atom_type:
+            return offset, header_size, size
+    return None
+
+
+def read_atom(stream, offset, header_size, size):
+    """Return the content of the atom (without its header) as bytes."""
+    stream.seek(offset + header_size)
+    return stream.read(size - header_size)
+
+
+def meta_children_offset(stream, offset, header_size):
+    """
+    Return an offset of the first child of the 'meta' atom: in MP4 files 'meta' is a full atom
+    (4 bytes of version & flags precede its children), while in QuickTime files it is not.
+    """
+    stream.seek(offset + header_size + 4)
+    return offset + header_size + (0 if stream.read(4) == b'hdlr' else 4)
+
+
+def decode_text(data, encoding='utf-8'):
+    """Decode a text value, values which are not valid UTF-8 are considered to be in Mac Roman encoding."""
+    try:
+        return data.decode(encoding)
+    except UnicodeDecodeError:
+        return data.decode('mac_roman')
+
+
+def parse_data_atoms(content):
+    """Return a text value of the first 'data' atom found in the content of a metadata item (None if none)."""
+    position = 0
+    while position + 16 <= len(content):
+        size, atom_type, type_indicator = struct.unpack('>I4sI', content[position:position + 12])
+        if size < 16:
+            break
+        if atom_type == b'data' and type_indicator & 0xffffff in DATA_ENCODINGS:
+            return decode_text(content[position + 16:position + size], DATA_ENCODINGS[type_indicator & 0xffffff])
+        position += size
+    return None
+
+
+def parse_udta_string(content):
+    """
+    Return a text value of a QuickTime user data item (©xxx): it is a list of strings, each preceded
+    by 2 bytes of its length and 2 bytes of its language code - the first string is taken.
+    Items written in iTunes style (containing 'data' atoms) are supported as well.
+    """
+    if content[4:8] == b'data':
+        return parse_data_atoms(content)
+    if len(content) < 4:
+        return None
+    length = struct.unpack('>H', content[:2])[0]
+    return decode_text(content[4:4 + length])
+
+
+def parse_ilst(stream, start, end, keys=None):
+    """
+    Read items of the 'ilst' atom into a dictionary of tags.
+
+    :param keys: a list of key names declared in 'keys' atom (for QuickTime metadata, where items are
+                 referred to by 1-based key indexes instead of atom types), None for iTunes-style items.
+    """
+    tags = {}
+    for atom_type, offset, header_size, size in iter_atoms(stream, start, end):
+        if keys is not None:
+            index = struct.unpack('>I', atom_type)[0]
+            name = keys[index - 1] if 0 < index <= len(keys) else None
+        else:
+            name = TAG_NAMES.get(atom_type)
+        if name:
+            value = parse_data_atoms(read_atom(stream, offset, header_size, size))
+            if value is not None:
+                tags[name] = value
+    return tags
+
+
+def parse_meta(stream, offset, header_size, size):
+    """Read tags from the 'meta' atom: either iTunes-style ('mdir' handler) or QuickTime metadata keys ('mdta')."""
+    start, end = meta_children_offset(stream, offset, header_size), offset + size
+    keys = None
+    found = find_atom(stream, start, end, b'keys')
+    if found:  # QuickTime metadata, e.g. 'com.apple.quicktime.location.ISO6709'
+        content = read_atom(stream, *found)
+        count, position, keys = struct.unpack('>I', content[4:8])[0], 8, []
+        for _ in range(count):
+            key_size = struct.unpack('>I', content[position:position + 4])[0]
+            if key_size < 8:
+                break
+            keys.append(decode_text(content[position + 8:position + key_size]))
+            position += key_size
+    found = find_atom(stream, start, end, b'ilst')
+    if not found:
+        return {}
+    return parse_ilst(stream, found[0] + found[1], found[0] + found[2], keys)
+
+
+def parse_udta(stream, start, end):
+    """Read tags from the 'udta' atom: QuickTime user data strings and the nested 'meta' atom."""
+    tags = {}
+    for atom_type, offset, header_size, size in iter_atoms(stream, start, end):
+        if atom_type == b'meta':
+            tags.update(parse_meta(stream, offset, header_size, size))
+        elif atom_type in TAG_NAMES:
+            value = parse_udta_string(read_atom(stream, offset, header_size, size))
+            if value is not None:
+                tags[TAG_NAMES[atom_type]] = value
+    return tags
+
+
+def parse_mvhd(content):
+    """Return the movie duration in seconds read from the 'mvhd' atom content."""
+    if content[0] == 1:  # version 1: 64-bit creation/modification times and duration
+        timescale, duration = struct.unpack('>IQ', content[20:32])
+    else:
+        timescale, duration = struct.unpack('>II', content[12:20])
+    if not timescale or not duration or duration in [0xffffffff, 0xffffffffffffffff]:
+        raise UnsupportedContainer('Movie duration is unknown.')
+    return duration / timescale
+
+
+def read_mp4_metadata(path):
+    """
+    Read the duration and tags of a MP4/MOV file natively (see the module description).
+
+    :param path: an absolute path to the video file.
+    :return: a dictionary of the same shape as FFprobe JSON output, e.g.
+             {'format': {'duration': '7.531000', 'tags': {'major_brand': 'isom', 'title': 'nice title', ...}}},
+             or None if the file cannot be handled natively (e.g. it is not an ISO base media file,
+             or it is fragmented, or it is malformed) - FFprobe should be used then.
+    """
+    if path[path.rfind('.') + 1:].lower() not in MP4_EXTENSIONS:
+        return None
+    try:
+        with open(path, 'rb') as stream:
+            end = os.fstat(stream.fileno()).st_size
+            tags, moov = {}, None
+            for atom_type, offset, header_size, size in iter_atoms(stream, 0, end):
+                if atom_type not in TOP_LEVEL_ATOMS:
+                    raise UnsupportedContainer('Unexpected top level atom "%s".' % atom_type)
+                if atom_type == b'ftyp':
+                    content = read_atom(stream, offset, header_size, size)
+                    tags['major_brand'] = decode_text(content[:4])
+                    tags['minor_version'] = str(struct.unpack('>I', content[4:8])[0])
+                    tags['compatible_brands'] = decode_text(content[8:])
+                elif atom_type == b'moov':
+                    moov = (offset + header_size, offset + size)
+                    break
+            if not moov:
+                raise UnsupportedContainer('No movie atom found.')
+            duration = None
+            for atom_type, offset, header_size, size in iter_atoms(stream, *moov):
+                if atom_type == b'mvex':
+                    raise UnsupportedContainer('Fragmented movies are not supported.')
+                if atom_type == b'mvhd':
+                    duration = parse_mvhd(read_atom(stream, offset, header_size, size))
+                elif atom_type == b'udta':
+                    tags.update(parse_udta(stream, offset + header_size, offset + size))
+                elif atom_type == b'meta':
+                    tags.update(parse_meta(stream, offset, header_size, size))
+            if duration is None:
+                raise UnsupportedContainer('No movie header found.')
+    except (UnsupportedContainer, IOError, struct.error, IndexError) as err:
+        logging.debug('Cannot read metadata of "%s" natively: %s' % (path, err))
+        return None
+    return {'format': {'duration': '%.6f' % duration, 'tags': tags}}
+
+
+def make_atom(atom_type, content):
+    """Return bytes of the atom of the given type and content (a 64-bit size is used for huge atoms)."""
+    if len(content) + 8 > 0xffffffff:
+        return struct.pack('>I4sQ', 1, atom_type, len(content) + 16) + content
+    return struct.pack('>I4s', len(content) + 8, atom_type) + content
+
+
+def make_free(size):
+    """Return bytes of a 'free' atom of the given total size (at least 8 bytes)."""
+    return make_atom(b'free', b'\x00' * (size - 8))
+
+
+def copy_atom(stream, offset, size):
+    """Return bytes of the atom as it is stored in the file (including its header)."""
+    stream.seek(offset)
+    return stream.read(size)
+
+
+def build_ilst(stream, start, end, tags):
+    """
+    Return bytes of a new 'ilst' atom: items of the existing 'ilst' (in the given range of the file, if any)
+    are kept unless they are given in tags, and items for all non-empty tags are added.
+    """
+    items = [copy_atom(stream, offset, size) for atom_type, offset, header_size, size
+             in iter_atoms(stream, start, end) if TAG_NAMES.get(atom_type) not in tags]
+    for name, value in tags.items():
+        if value:
+            data = make_atom(b'data', struct.pack('>II', 1, 0) + str(value).encode('utf-8'))
+            items.append(make_atom(TAG_ATOMS[name], data))
+    return make_atom(b'ilst', b''.join(items))
+
+
+def build_meta(stream, offset, header_size, size, tags):
+    """Return bytes of a new iTunes-style 'meta' atom based on the existing one (if offset is not None)."""
+    if offset is None:
+        hdlr = make_atom(b'hdlr', b'\x00' * 8 + b'mdir' + b'appl' + b'\x00' * 9)
+        return make_atom(b'meta', b'\x00' * 4 + hdlr + build_ilst(stream, 0, 0, tags))
+    start, end = meta_children_offset(stream, offset, header_size), offset + size
+    children, ilst = [read_atom(stream, offset, header_size, start - offset)], None  # version & flags, if any
+    for atom_type, child_offset, child_header_size, child_size in iter_atoms(stream, start, end):
+        if atom_type == b'ilst':
+            ilst = build_ilst(stream, child_offset + child_header_size, child_offset + child_size, tags)
+            children.append(ilst)
+        else:
+            children.append(copy_atom(stream, child_offset, child_size))
+    if ilst is None:
+        children.append(build_ilst(stream, 0, 0, tags))
+    return make_atom(b'meta', b''.join(children))
+
+
+def build_udta(stream, start, end, tags):
+    """
+    Return bytes of a new 'udta' atom based on the existing one (in the given range of the file, if any):
+    tags are written into the iTunes-style 'meta' atom, QuickTime user data strings of the same tags are dropped.
+    """
+    children, meta = [], None
+    for atom_type, offset, header_size, size in iter_atoms(stream, start, end):
+        if atom_type == b'meta' and meta is None \
+                and not find_atom(stream, meta_children_offset(stream, offset, header_size), offset + size, b'keys'):
+            meta = build_meta(stream, offset, header_size, size, tags)
+            children.append(meta)
+        elif TAG_NAMES.get(atom_type) not in tags:
+            children.append(copy_atom(stream, offset, size))
+    if meta is None:
+        children.append(build_meta(stream, None, 0, 0, tags))
+    return make_atom(b'udta', b''.join(children))
+
+
+def build_moov(stream, start, end, tags):
+    """Return bytes of a new 'moov' atom (its children are in the given range of the file) containing tags."""
+    children, udta = [], None
+    for atom_type, offset, header_size, size in iter_atoms(stream, start, end):
+        if atom_type == b'mvex':
+            raise UnsupportedContainer('Fragmented movies are not supported.')
+        if atom_type == b'udta' and udta is None:
+            udta = build_udta(stream, offset + header_size, offset + size, tags)
+            children.append(udta)
+        else:
+            children.append(copy_atom(stream, offset, size))
+    if udta is None:
+        children.append(build_udta(stream, 0, 0, tags))
+    return make_atom(b'moov', b''.join(children))
+
+
+def write_mp4_metadata(path, tags):
+    """
+    Write tags into a MP4/MOV file natively: the movie atom is rebuilt with new 'udta/meta/ilst' items and
+    - if it fits into the space of the old movie atom (and 'free' atoms following it) leaving at least PADDING bytes
+      of free space for next edits - written in place,
+    - else if it is the last atom of the file - written in place extending the file (PADDING bytes follow it),
+    - otherwise it is appended to the end of the file (PADDING bytes follow it)
+      and the old movie atom is turned into a 'free' atom.
+    Media data is never moved, so chunk offsets stored in the movie atom remain valid.
+    The new movie atom is synced to disk before the call returns (or before the old one is dropped).
+
+    :param path: an absolute path to the video file.
+    :param tags: a dictionary of tag values by tag names (see TAG_ATOMS), empty values remove tags.
+    :return: True if tags have been written, False if the file cannot be handled natively
+             (e.g. it is not an ISO base media file, or it is fragmented, or it is malformed) -
+             FFMPEG should be used then.
+    """
+    if path[path.rfind('.') + 1:].lower() not in MP4_EXTENSIONS or set(tags) - set(TAG_ATOMS):
+        return False
+    try:
+        with open(path, 'r+b') as stream:
+            end = os.fstat(stream.fileno()).st_size
+            atoms = list(iter_atoms(stream, 0, end))
+            if any(atom_type not in TOP_LEVEL_ATOMS for atom_type, offset, header_size, size in atoms):
+                raise UnsupportedContainer('Unexpected top level atom.')
+            index = [atom_type for atom_type, offset, header_size, size in atoms].index(b'moov')
+            moov_type, moov_offset, header_size, available = atoms[index]
+            moov = build_moov(stream, moov_offset + header_size, moov_offset + available, tags)
+            for atom_type, offset, header_size, size in atoms[index + 1:]:
+                if atom_type not in [b'free', b'skip']:
+                    break
+                available += size  # free space following the movie atom can be used as well
+                index += 1
+            if len(moov) + 8 + PADDING <= available:
+                stream.seek(moov_offset)
+                stream.write(moov)  # the rest of the space becomes a 'free' atom (its content is ignored)
+                stream.write(struct.pack('>I4s', available - len(moov), b'free'))
+                stream.flush()
+                os.fsync(stream.fileno())
+            elif index == len(atoms) - 1:
+                stream.seek(moov_offset)
+                stream.write(moov + make_free(PADDING))
+                stream.truncate()
+                stream.flush()
+                os.fsync(stream.fileno())
+            else:
+                stream.seek(atoms[-1][1])
+                if stream.read(4) == b'\x00' * 4:  # the last atom lasts until the end of the file
+                    raise UnsupportedContainer('Cannot append to the file.')
+                stream.seek(end)
+                stream.write(moov + make_free(PADDING))
+                stream.flush()
+                os.fsync(stream.fileno())  # the new movie atom must be stored before the old one is dropped
+                stream.seek(moov_offset + 4)
+                stream.write(b'free')
+    except (UnsupportedContainer, IOError, struct.error, IndexError, ValueError) as err:
+        logging.debug('Cannot write metadata into "%s" natively: %s' % (path, err))
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import json
+    import subprocess
+
+    if len(sys.argv) < 3:
+        sys.exit('Usage: python mp4_atoms.py <path to ffprobe> <video file> [<video file> ...]')
+    ffprobe_path, paths = sys.argv[1], sys.argv[2:]
+    timings = {'native': 0.0, 'ffprobe': 0.0}
+    for path in paths:
+        started = time.time()
+        native = read_mp4_metadata(path)
+        timings['native'] += time.time() - started
+        started = time.time()
+        stdout = subprocess.run([ffprobe_path, '-v', 'quiet', '-print_format', 'json',
+                                 '-show_format', '-show_private_data', '-i', path], stdout=subprocess.PIPE).stdout
+        probed = json.loads(stdout or '{}')
+        timings['ffprobe'] += time.time() - started
+        if native is None:
+            print('%s: not supported natively' % path)
+            continue
+        probed_tags = probed.get('format', {}).get('tags', {})
+        mismatches = [key for key, value in native['format']['tags'].items() if probed_tags.get(key) != value]
+        print('%s: duration %s (ffprobe: %s), mismatched tags: %s'
+              % (path, native['format']['duration'], probed.get('format', {}).get('duration'),
+                 ', '.join(mismatches) or 'none'))
+    for method, seconds in timings.items():
+        print('%-8s %.3f seconds total, %.2f ms per file' % (method, seconds, 1000 * seconds / len(paths)))
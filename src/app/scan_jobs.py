@@ -0,0 +1,65 @@
+"""A module to run scans of media folders as background jobs."""
+import logging
+import threading
+from .models import db_session
+from . import db_queries
+from .scan_progress import ScanProgress, ACTIVE_SCANS, stale_time_str
+
+
+class ScanJobManager:
+    """
+    Accept scan requests and run them in background threads, so that HTTP requests return immediately
+    with a scan job id. Progress of a job is available via get_scan_status() from scan_progress module.
+    A scan requested for a folder which is already being scanned (by this or another process)
+    collapses into the running job.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def submit(self, folder, scan_function, app_config, user_id):
+        """
+        Start a scan job unless the given folder is already being scanned.
+
+        :param folder: an absolute path of the folder to be scanned.
+        :param scan_function: a function from scanner module, e.g. scanner.reconcile_scan,
+                              to be called as scan_function(app_config, user_id, progress).
+        :param app_config: a dictionary containing the application configuration settings (=app.config).
+        :param user_id: an integer number of user id which will be considered as owner (0 for public).
+        :return: a tuple (job_id, started), started is False if the request collapsed into a running job.
+        """
+        with self.lock:
+            for progress in list(ACTIVE_SCANS.values()):
+                if progress.folder == folder:
+                    return progress.job_id, False
+            job, created = db_queries.claim_scan_job(folder, stale_time_str())
+            if not created:
+                return job.id, False
+            progress = ScanProgress(folder, job_id=job.id)
+        thread = threading.Thread(target=self._run, args=(progress, scan_function, app_config, user_id),
+                                  name='scan-job-%s' % progress.job_id, daemon=True)
+        thread.start()
+        return progress.job_id, True
+
+    @staticmethod
+    def _run(progress, scan_function, app_config, user_id):
+        """Run the scan function in the current (background) thread."""
+        try:
+            with progress:
+                counts = scan_function(app_config, user_id, progress)
+                logging.info('Scan job #%s of "%s": %s.' % (progress.job_id, progress.folder, counts))
+        except Exception as err:
+            logging.exception('Scan job #%s failed due to %s.' % (progress.job_id, err))
+        finally:
+            db_session.remove()
+
+    @staticmethod
+    def cancel(job_id):
+        """Request cancellation of the scan job, return True if the job was running."""
+        if job_id in ACTIVE_SCANS:
+            ACTIVE_SCANS[job_id].cancel()
+            return True
+        return db_queries.cancel_scan_job(job_id)
+
+
+manager = ScanJobManager()
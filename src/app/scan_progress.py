@@ -0,0 +1,147 @@
+"""A module to keep track of scan progress: counters and paths of declined/failed files."""
+import time
+import logging
+from .models import db_session, get_time_str
+from .metamedia import format_timestamp
+from . import db_queries
+
+
+# Progress of scans running in the current process, by scan job id:
+ACTIVE_SCANS = {}
+# A number of seconds after which a running scan job without checkpoints is considered interrupted:
+STALE_AFTER = 600
+
+
+class ScanCancelled(Exception):
+    """Raised in the scanning thread once cancellation of its scan job is requested."""
+
+
+class ScanProgress:
+    """
+    Progress of a single scan kept in memory: counters are updated by the only thread writing scan
+    results, so no locks are needed, and reading them costs nothing. Counters and new paths of
+    declined/failed files are checkpointed into 'scan_jobs' & 'scan_issues' tables periodically
+    (every `interval` seconds), so that the progress is visible to other processes as well.
+    Use it as a context manager to mark the scan as completed (or failed on exception) at exit.
+    Cancellation requested by another thread (see cancel()) or another process (status 'cancelling'
+    found in the database at checkpoint) is signalled by raising ScanCancelled in the scanning thread.
+    """
+
+    def __init__(self, folder, interval=1.0, job_id=None):
+        """
+        :param folder: an absolute path of the folder being scanned.
+        :param interval: a number of seconds between checkpoints.
+        :param job_id: an id of the scan job entry if it is already created (see db_queries.claim_scan_job()).
+        """
+        self.job_id = job_id or db_queries.create_scan_job(folder).id
+        self.folder = folder
+        self.status = 'running'
+        self.total = 0
+        self.passed = 0
+        self.failed = 0
+        self.declined = 0
+        self.issues = []  # tuples (path, reason) not yet checkpointed
+        self.interval = interval
+        self.checkpointed = time.time()
+        self.started = get_time_str()
+        self.finished = ''
+        self.cancelled = False
+        ACTIVE_SCANS[self.job_id] = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type:
+            db_session.rollback()  # the session may be left in a failed transaction
+        if exc_type is ScanCancelled:
+            self.finish('cancelled')
+            return True
+        self.finish('failed' if exc_type else 'completed')
+        return False
+
+    def cancel(self):
+        """Request cancellation of the scan (the scanning thread stops at its next checkpoint)."""
+        self.cancelled = True
+
+    def add_total(self, count=1):
+        """Increase the number of files to be parsed."""
+        self.total += count
+        self.checkpoint_if_due()
+
+    def decline(self, path):
+        """Count a file skipped without parsing."""
+        self.declined += 1
+        self.issues.append((path, 'declined'))
+        self.checkpoint_if_due()
+
+    def count(self, path, error=''):
+        """Count a parsed file as passed (if there is no error) or failed."""
+        if error:
+            self.failed += 1
+            self.issues.append((path, 'failed'))
+        else:
+            self.passed += 1
+        self.checkpoint_if_due()
+
+    def as_dict(self):
+        """Return the current progress as a dictionary."""
+        return {'id': self.job_id, 'folder': self.folder, 'status': self.status,
+                'total': self.total, 'passed': self.passed, 'failed': self.failed,
+                'declined': self.declined, 'started': self.started, 'finished': self.finished}
+
+    def checkpoint_if_due(self):
+        """
+        Save the progress into the database if the last checkpoint is older than the interval.
+        Raise ScanCancelled (once) if cancellation of the scan has been requested.
+        """
+        if time.time() - self.checkpointed >= self.interval:
+            self.checkpoint()
+        if self.cancelled and self.status == 'running':
+            self.status = 'cancelling'
+            raise ScanCancelled('Scan job #%s has been cancelled.' % self.job_id)
+
+    def checkpoint(self, final=False):
+        """
+        Save the progress and all new paths of declined/failed files into the database.
+        The status is saved only if final is True, otherwise it is read back from the database
+        to detect cancellation requested by other processes.
+        """
+        issues, self.issues = self.issues, []
+        values = {key: value for key, value in self.as_dict().items()
+                  if key not in ['id', 'folder'] and (final or key != 'status')}
+        if db_queries.update_scan_job(self.job_id, values, issues) == 'cancelling':
+            self.cancelled = True
+        self.checkpointed = time.time()
+
+    def finish(self, status='completed'):
+        """Mark the scan as finished with the given status and save the final progress."""
+        self.status = status
+        self.finished = get_time_str()
+        ACTIVE_SCANS.pop(self.job_id, None)
+        try:
+            self.checkpoint(final=True)
+        except Exception as err:
+            db_session.rollback()
+            logging.error('Cannot save progress of scan job #%s due to %s.' % (self.job_id, err))
+        logging.info('Scan job #%s %s: %s.' % (self.job_id, status, self.as_dict()))
+
+
+def get_scan_status(job_id=None):
+    """
+    Get the progress of the given scan job (or the most recent one if job id is not given):
+    from memory if the scan runs in the current process, otherwise from the last checkpoint.
+
+    :return: a dictionary of the progress values (see ScanProgress.as_dict()), empty if there is no job.
+    """
+    if job_id in ACTIVE_SCANS:
+        return ACTIVE_SCANS[job_id].as_dict()
+    data = db_queries.get_scan_job(job_id, as_dict=True)
+    if data.get('status') in ['running', 'cancelling'] and data['updated'] < stale_time_str():
+        data['status'] = 'interrupted'  # e.g. the process running the scan has been restarted
+    return data
+
+
+def stale_time_str():
+    """Get date & time (in the format of get_time_str()) before which running jobs are considered stale."""
+    return format_timestamp(time.time() - STALE_AFTER, '%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,513 @@
+"""A module to scan media folders: parse media files in worker pools and register them in the DB."""
+import os
+import time
+import queue
+import logging
+import traceback
+from multiprocessing import Pool as ProcessPool, cpu_count
+from multiprocessing.dummy import Pool as ThreadPool
+from .models import db_session, get_time_str
+from . import helpers
+from . import db_queries
+from . import transcoder
+from . import geocoder
+from . import similarity
+from . import thumbnails
+from .metamedia import Photo, Video
+from .scan_progress import ScanCancelled
+
+
+PHOTO_EXTENSIONS = ['jpg', 'jpeg']
+# Settings passed to the worker functions (a picklable subset of app.config):
+WORKER_SETTINGS = ['MEDIA_FOLDER', 'WATCH_FOLDER', 'FFMPEG_PATH', 'FFPROBE_PATH', 'ALLOWED_EXTENSIONS',
+                   'PERCEPTUAL_HASH', 'THUMBNAIL_FOLDER', 'VIDEO_SPRITES']
+# A maximum number of discovered files waiting to be parsed (the folder walk pauses once it is reached):
+MAX_PENDING = 10000
+
+
+def is_photo(path):
+    """Return True if the given path is expected to be a photo file, False otherwise."""
+    return path[path.rfind('.') + 1:].lower() in PHOTO_EXTENSIONS
+
+
+def read_media(path, settings, stat=None):
+    """
+    Worker function to analyze a single media file: read EXIF tags from a photo file or custom metadata
+    from a video file (non-MP4 videos are converted later, see transcoder.py), and generate thumbnails
+    of the photo or previews of the video (see thumbnails.py).
+    Files discovered in the watch folder are moved into the media folder first.
+    This function does not access the database, so it can be executed in another process.
+
+    :param path: an absolute path to the photo or video file.
+    :param settings: a dictionary containing WORKER_SETTINGS values of the app configuration.
+    :param stat: an os.stat_result of the file as discovered by the folder walk (None to read it again).
+    :return: a 3-tuple (path, info, error), where info is a dictionary of metadata values
+             (see helpers.read_mediafile()) or None if reading failed, and error is a message
+             to be written into the scan errors log (empty string if reading was successful).
+    """
+    if path.startswith(settings['WATCH_FOLDER']):
+        old_path = path
+        path = path.replace(settings['WATCH_FOLDER'], settings['MEDIA_FOLDER'], 1)
+        result = helpers.move_file(old_path, path)
+        if result.errors:
+            return old_path, None, '%s failed: cannot move to %s due to %s\n' % \
+                                   (old_path, path, ';'.join(result.errors))
+    try:
+        data = helpers.read_mediafile(path, settings, stat)  # a moved file keeps its size and times
+    except Exception as err:
+        return path, None, '%s failed due to %s\n%s\n' % (path, err, traceback.format_exc())
+    try:  # not fatal: thumbnails will be generated once requested
+        if data.value and data.value['checksum'] and is_photo(path):
+            thumbnails.make_thumbnails(path, data.value['checksum'], settings['THUMBNAIL_FOLDER'],
+                                       thumbnails.EAGER_SIZES)
+        elif data.value and data.value['checksum'] and not data.value['transcode']:  # others once converted
+            video = Video(path, settings['FFMPEG_PATH'], settings['FFPROBE_PATH'], stat)
+            thumbnails.make_video_previews(video, data.value['checksum'], settings['THUMBNAIL_FOLDER'],
+                                           settings['VIDEO_SPRITES'])
+    except Exception as err:
+        logging.warning('Cannot generate thumbnails of "%s" due to %s.' % (path, err))
+    return path, data.value, '\n'.join(data.errors)
+
+
+class BatchSink:
+    """
+    Accumulate parsed media files and register them in the database in batches:
+    new tags and locations are upserted in bulk, new entries are created with one multi-row INSERT,
+    entries of changed files are updated at once - all in a single transaction per batch.
+    New files are matched with registered ones by content hash: a file whose registered original
+    no longer exists on disk has been moved (its entry follows it), otherwise it is a copy -
+    copies are not registered as media files, they are only remembered in 'duplicate_files' table.
+    A batch is flushed when it reaches batch_size items or when it is older than interval milliseconds.
+    """
+
+    # Values refreshed in existing entries of changed files (ownership, visits, etc. are kept intact):
+    UPDATED_FIELDS = ['path', 'duration', 'size', 'title', 'description', 'comment', 'tags',
+                      'coords', 'location_id', 'year', 'created', 'mtime', 'transcode', 'geocode', 'checksum', 'phash']
+
+    def __init__(self, user_id, batch_size=500, interval=1000):
+        """
+        :param user_id: an integer number of user id which will be considered as owner (0 for public).
+        :param batch_size: an integer number of media files to be registered in one transaction.
+        :param interval: an integer number of milliseconds to wait for a batch to be filled up.
+        """
+        self.user_id = user_id
+        self.batch_size = max(int(batch_size), 1)
+        self.interval = max(int(interval), 1) / 1000.0
+        self.items = []  # a list of tuples (path, info, mediafile_id)
+        self.started = time.time()
+        self.moved = set()  # ids of entries which files have been found under new paths
+        self.duplicates = 0  # a number of skipped copies of registered media files
+
+    def add(self, path, info, mediafile_id=None):
+        """Add a parsed media file to the batch (mediafile_id is set for changed files only)."""
+        if not self.items:
+            self.started = time.time()
+        self.items.append((path, info, mediafile_id))
+
+    def time_left(self):
+        """Return a number of seconds left before the batch must be flushed (None if it is empty)."""
+        if not self.items:
+            return None
+        return max(self.started + self.interval - time.time(), 0)
+
+    def is_due(self):
+        """Return True if the batch is full or it waits for too long, False otherwise."""
+        return len(self.items) >= self.batch_size or self.time_left() == 0
+
+    def flush(self):
+        """
+        Register all accumulated media files in the database.
+        If the batch transaction fails, media files are registered one by one, so that
+        a single broken file does not fail the whole batch.
+
+        :return: a list of tuples (path, error), where error is an empty string for registered files.
+        """
+        items, self.items = self.items, []
+        if not items:
+            return []
+        try:
+            results, moved, duplicates = self._register(items)
+            db_session.commit()
+            self.moved.update(moved)
+            self.duplicates += duplicates
+        except Exception as err:
+            db_session.rollback()
+            db_queries.ingest_cache.clear()  # it may remember tags/locations of the rolled back batch
+            logging.warning('Batch of %s files failed due to %s, registering one by one.' % (len(items), err))
+            results = []
+            for path, info, mediafile_id in items:
+                try:
+                    data = helpers.register_mediafile(self.user_id, info, mediafile_id)
+                except Exception as err:
+                    db_session.rollback()
+                    data = helpers.Data(None, ['%s failed due to %s\n%s\n' %
+                                               (path, err, traceback.format_exc())])
+                results.append((path, '\n'.join(data.errors)))
+        return results
+
+    def _register(self, items):
+        """
+        Perform bulk upserts/inserts/updates for the given items.
+
+        :return: a 3-tuple (results, moved, duplicates) - results as flush() returns them,
+                 a set of ids of moved entries and a number of skipped copies.
+        """
+        db_queries.upsert_tags(tag for path, info, mediafile_id in items for tag in info['tags'].split())
+        locations = db_queries.upsert_locations((info['gps']['city'], info['gps']['country'], info['gps']['code'])
+                                                for path, info, mediafile_id in items)
+        known = db_queries.find_mediafiles_by_checksums(info['checksum'] for path, info, mediafile_id in items
+                                                        if not mediafile_id)
+        new_entries, updates, copies, moved = [], [], [], set()
+        for path, info, mediafile_id in items:
+            original_id, original_path = known.get(info['checksum'], (None, info['path']))
+            if not mediafile_id and original_path != info['path']:
+                if original_id is None or os.path.exists(original_path):
+                    copies.append(info)
+                    continue
+                mediafile_id = original_id  # the file has been moved
+                moved.add(original_id)
+            if not mediafile_id:  # the next files of this batch with the same content are its copies
+                known[info['checksum']] = (None, info['path'])
+            gps = info['gps']
+            key = ((gps['city'] or '').strip().lower(), (gps['country'] or '').strip().lower())
+            entry = helpers.build_mediafile(self.user_id, info, locations.get(key, 0))
+            if mediafile_id:
+                values = {field: getattr(entry, field) for field in self.UPDATED_FIELDS}
+                values.update({'id': mediafile_id, 'year': entry.year or 0, 'updated': get_time_str()})
+                updates.append(values)
+            else:
+                entry.year = entry.year or 0
+                new_entries.append(entry)
+        created = db_queries.insert_mediafiles(new_entries)
+        db_queries.update_mediafiles_values(updates, commit=False)
+        db_queries.upsert_duplicate_files(copies)
+        rejected = {entry.path for entry in new_entries} - created
+        results = []
+        for path, info, mediafile_id in items:
+            error = ''
+            if info['path'].replace('\x00', '') in rejected:
+                error = 'Cannot add Media File "%s" - already exists.' % info['path']
+            results.append((path, error))
+        return results, moved, len(copies)
+
+
+class ScanEngine:
+    """
+    Parse media files in parallel and register them in the database.
+    Photo parsing is CPU-bound (EXIF decoding), so photos are handled by a pool of processes,
+    while video probing may be bound to FFprobe sub-processes, so videos are handled
+    by a separate pool of threads. Files are submitted to the pools as soon as they are discovered,
+    and all results flow back to the calling thread - the only one writing into the database
+    (in batches, see BatchSink) - which collects them in between of walking the folder tree.
+    """
+
+    def __init__(self, app_config, user_id, progress):
+        """
+        :param app_config: a dictionary containing the application configuration settings (=app.config).
+        :param user_id: an integer number of user id which will be considered as owner (0 for public).
+        :param progress: an instance of ScanProgress() class to count processed files.
+        """
+        self.user_id = user_id
+        self.progress = progress
+        self.app_config = app_config
+        self.settings = {key: app_config[key] for key in WORKER_SETTINGS}
+        self.photo_workers = int(app_config['SCAN_PHOTO_WORKERS']) or cpu_count()
+        self.video_workers = max(int(app_config['SCAN_VIDEO_WORKERS']), 1)
+        self.sink = BatchSink(user_id, app_config['SCAN_BATCH_SIZE'], app_config['SCAN_BATCH_INTERVAL'])
+        self.results = queue.Queue()
+        self.registered = {}  # paths of changed files mapped to ids of their existing DB entries
+        self.pending = 0  # a number of submitted media files which results are not yet collected
+        self.transcodes = 0  # a number of collected videos to be converted into MP4 once registered
+        self.geocodes = 0  # a number of collected media files to detect locations for once registered
+
+    def _submit(self, pool, path, stat):
+        """Schedule parsing of the media file in the given pool, the result will be queued."""
+        self.pending += 1
+        self.progress.add_total()
+        pool.apply_async(read_media, (path, self.settings, stat),
+                         callback=self.results.put,
+                         error_callback=lambda err: self.results.put((path, None, '%s failed due to %s\n'
+                                                                            % (path, err))))
+
+    def run(self, media_files, registered=None):
+        """
+        Parse the given media files in worker pools and register them in the database.
+
+        :param media_files: an iterable (e.g. a generator walking a folder) of tuples (path, stat) -
+                            absolute paths of media files to be processed and their os.stat_result.
+        :param registered: a dictionary mapping paths of already registered (but changed) files
+                           to ids of their DB entries - these entries will be updated, not created.
+                           It may be filled up by the media_files generator while it is being iterated.
+        :return: a tuple of integers (passed, failed) - counts of processed media files.
+        """
+        self.registered = registered if registered is not None else {}
+        self.pending = 0
+        db_queries.ingest_cache.warm_up()
+        photo_pool = ProcessPool(self.photo_workers)
+        video_pool = ThreadPool(self.video_workers)
+        try:
+            for path, stat in media_files:
+                self._submit(photo_pool if is_photo(path) else video_pool, path, stat)
+                self.collect(block=self.pending >= MAX_PENDING)
+            while self.pending:
+                self.collect(block=True)
+            self.flush()
+        except ScanCancelled:
+            self.flush()  # register files which are already parsed
+            for pool in [photo_pool, video_pool]:
+                pool.terminate()  # drop files not yet parsed
+            raise
+        finally:
+            for pool in [photo_pool, video_pool]:
+                pool.close()
+                pool.join()
+            similarity.similarity_index.invalidate()  # new photos are to be found by next queries
+            thumbnails.cache.evict()  # thumbnails of new photos may exceed the cache size
+        return self.progress.passed, self.progress.failed
+
+    def collect(self, block=False):
+        """
+        Collect results of parsed media files into the batch and register the batch once it is due.
+
+        :param block: a boolean to wait for at least one result (or for the batch to be due),
+                      if False - only already available results are collected.
+        """
+        while self.pending:
+            timeout = self.sink.time_left()
+            try:
+                if block:
+                    path, info, error = self.results.get(timeout=1.0 if timeout is None else min(timeout, 1.0))
+                else:
+                    path, info, error = self.results.get_nowait()
+            except queue.Empty:  # nothing parsed for a while, register what is ready
+                if self.sink.is_due():
+                    self.flush()
+                self.progress.checkpoint_if_due()  # keeps the job alive, raises if it is cancelled
+                return
+            self.pending -= 1
+            block = False
+            if info:
+                self.sink.add(path, info, self.registered.get(path))
+                self.transcodes += 1 if info['transcode'] else 0
+                self.geocodes += 1 if info['geocode'] else 0
+            else:
+                self.count(path, error)
+            if self.sink.is_due():
+                self.flush()
+
+    def flush(self):
+        """Register accumulated media files in the database and count the results."""
+        for path, error in self.sink.flush():
+            self.count(path, error)
+        if self.transcodes:  # registered videos are converted by the transcoding queue, not by the scan
+            transcoder.transcode_queue.wake(self.app_config)
+            self.transcodes = 0
+        if self.geocodes:  # locations are detected by the geocoding queue, not by the scan
+            geocoder.geocode_queue.wake()
+            self.geocodes = 0
+
+    def count(self, path, error):
+        """Count a processed media file as passed (if there is no error) or failed."""
+        if error:
+            helpers.write_scan_error(error)
+            logging.warning('Failed to scan "%s".' % path)
+        self.progress.count(path, error)
+
+
+def parallel_scan(app_config, user_id, media_files, progress):
+    """
+    Once the app is launched for the first scan (when there is no database) or in order to re-scan,
+    analyzing media files will be performed on demand (as authorized user, navigate to /settings and
+    click 'Scan Media Files' button).
+    To speed-up the scan process, photos are parsed by app_config['SCAN_PHOTO_WORKERS'] processes
+    and videos by app_config['SCAN_VIDEO_WORKERS'] threads (see ScanEngine).
+    During the scan process files metadata is retrieved from files and is registered in the DB.
+
+    :param app_config: a dictionary containing the application configuration settings (=app.config).
+    :param user_id: an integer number of user id which will be considered as owner (0 for public).
+    :param media_files: an iterable of tuples (path, stat) of media files to be processed
+                        (see helpers.iter_media_files()).
+    :param progress: an instance of ScanProgress() class to keep track of the scan.
+    :return: True.
+    """
+    ScanEngine(app_config, user_id, progress).run(media_files)
+    return True
+
+
+def reconcile_scan(app_config, user_id, progress):
+    """
+    Incremental re-scan of the media folder app.config['MEDIA_FOLDER']: compare discovered files
+    with entries registered in the database by path, size and last modification time, and then
+    parse & register only new files, re-parse only changed files and remove entries of vanished files.
+    Unchanged entries (including their visits, access time and ownership) are left intact.
+    New and changed files are parsed while the folder is being walked, vanished files are known
+    (and removed) only once the walk is over. New files having the content of a vanished file are
+    considered as moved (the entry gets the new path), copies of registered files are skipped -
+    and they are not parsed again by next re-scans unless changed (see BatchSink). If a registered file
+    has vanished, but its copy is still there, the entry is kept as moved to the path of the copy.
+    Content hashes of unchanged files registered by older versions are computed in the end.
+
+    :param app_config: a dictionary containing the application configuration settings (=app.config).
+    :param user_id: an integer number of user id which will be considered as owner of new files.
+    :param progress: an instance of ScanProgress() class to keep track of the scan.
+    :return: a dictionary of counts: total (new and changed files to be parsed),
+             new, changed, unchanged, removed, moved, duplicates (skipped copies), hashed
+             and phashed (photos which perceptual hashes are computed for the first time).
+    """
+    registered = db_queries.get_registered_files(app_config['MEDIA_FOLDER'])
+    copies = db_queries.get_duplicate_files(app_config['MEDIA_FOLDER'])
+    counts = {'total': 0, 'new': 0, 'changed': 0, 'unchanged': 0, 'removed': 0,
+              'moved': 0, 'duplicates': 0, 'hashed': 0, 'phashed': 0}
+    changed, backfill, unhashed, unphashed = {}, [], [], []
+
+    def to_scan():
+        """Yield new and changed files out of all discovered ones."""
+        for path, stat in helpers.iter_media_files(app_config['MEDIA_FOLDER'], app_config, False, progress):
+            copy = copies.pop(path, None)
+            if copy and copy.size == stat.st_size and copy.mtime == stat.st_mtime:
+                counts['duplicates'] += 1
+                continue
+            elif copy:  # a changed copy is parsed again as a new file
+                db_queries.remove_duplicate_files([copy.id])
+            entry = registered.pop(path, None)
+            if entry is None:
+                counts['new'] += 1
+            elif entry.size == stat.st_size and entry.mtime in [None, stat.st_mtime]:
+                if entry.mtime is None:  # registered by older versions: just remember mtime
+                    backfill.append({'id': entry.id, 'mtime': stat.st_mtime})
+                if entry.checksum is None:  # registered by older versions: the content is to be hashed
+                    unhashed.append((entry.id, path))
+                if entry.phash is None and app_config['PERCEPTUAL_HASH'] and is_photo(path):
+                    unphashed.append((entry.id, path))
+                counts['unchanged'] += 1
+                continue
+            else:
+                changed[path] = entry.id
+                counts['changed'] += 1
+            counts['total'] += 1
+            yield path, stat
+
+    engine = ScanEngine(app_config, user_id, progress)
+    engine.run(to_scan(), changed)
+    # Whatever is left in registered (and has not been found under another path) has vanished from disk:
+    vanished = [entry.id for entry in registered.values() if entry.id not in engine.sink.moved]
+    # Unless a copy of it is left (copies left in copies have vanished as well) - the entry is moved to the copy
+    # then, otherwise removing the entry would remove the copy too, while it is skipped by scans:
+    takeovers = {}
+    for copy in db_queries.find_duplicate_files_of(vanished):
+        if copy.path not in copies:
+            takeovers.setdefault(copy.mediafile_id, copy)
+    db_queries.update_mediafiles_values([{'id': mediafile_id, 'path': copy.path, 'size': copy.size,
+                                          'mtime': copy.mtime, 'updated': get_time_str()}
+                                         for mediafile_id, copy in takeovers.items()])
+    db_queries.remove_duplicate_files([copy.id for copy in takeovers.values()])
+    engine.sink.moved.update(takeovers)
+    counts['removed'] = db_queries.remove_mediafiles([mediafile_id for mediafile_id in vanished
+                                                      if mediafile_id not in takeovers])
+    db_queries.remove_duplicate_files([copy.id for copy in copies.values()])
+    counts['moved'] = len(engine.sink.moved)
+    counts['duplicates'] += engine.sink.duplicates
+    db_queries.update_mediafiles_values(backfill)
+    counts['hashed'] = hash_files(unhashed, engine.video_workers)
+    counts['phashed'] = perceptual_hash_files(unphashed, engine.photo_workers)
+    logging.info('Reconciled "%s": %s.' % (app_config['MEDIA_FOLDER'], counts))
+    return counts
+
+
+def read_checksum(path):
+    """Worker function to compute a hash of the file content, return None if the file cannot be read."""
+    try:
+        return helpers.file_checksum(path)
+    except OSError as err:
+        logging.warning('Cannot compute a content hash of "%s" due to %s.' % (path, err))
+        return None
+
+
+def hash_files(files, workers, chunk_size=500):
+    """
+    Compute hashes of the content of the given registered files (reading is I/O-bound, so a pool of threads is used)
+    and store them in the database chunk by chunk.
+
+    :param files: a list of tuples (id, path) of entries in 'mediafiles' table.
+    :param workers: a number of threads reading files.
+    :param chunk_size: a number of entries updated in one transaction.
+    :return: a number of entries updated.
+    """
+    count = 0
+    if not files:
+        return count
+    pool = ThreadPool(workers)
+    try:
+        for i in range(0, len(files), chunk_size):
+            chunk = files[i:i + chunk_size]
+            checksums = pool.map(read_checksum, [path for mediafile_id, path in chunk])
+            count += db_queries.update_mediafiles_values([{'id': mediafile_id, 'checksum': checksum}
+                                                         for (mediafile_id, path), checksum in zip(chunk, checksums)
+                                                         if checksum])
+    finally:
+        pool.close()
+        pool.join()
+    return count
+
+
+def read_perceptual_hash(path):
+    """Worker function to compute a perceptual hash of the photo, return None if the photo cannot be read."""
+    try:
+        return Photo(path).perceptual_hash()
+    except Exception as err:
+        logging.warning('Cannot compute a perceptual hash of "%s" due to %s.' % (path, err))
+        return None
+
+
+def perceptual_hash_files(files, workers, chunk_size=500):
+    """
+    Compute perceptual hashes of the given registered photos (decoding is CPU-bound, so a pool of processes is used)
+    and store them in the database chunk by chunk.
+
+    :param files: a list of tuples (id, path) of entries in 'mediafiles' table.
+    :param workers: a number of processes decoding photos.
+    :param chunk_size: a number of entries updated in one transaction.
+    :return: a number of entries updated.
+    """
+    count = 0
+    if not files:
+        return count
+    pool = ProcessPool(workers)
+    try:
+        for i in range(0, len(files), chunk_size):
+            chunk = files[i:i + chunk_size]
+            values = pool.map(read_perceptual_hash, [path for mediafile_id, path in chunk])
+            count += db_queries.update_mediafiles_values([{'id': mediafile_id, 'phash': value}
+                                                         for (mediafile_id, path), value in zip(chunk, values)
+                                                         if value is not None])
+    finally:
+        pool.close()
+        pool.join()
+    similarity.similarity_index.invalidate()
+    return count
+
+
+def full_scan(app_config, user_id, progress):
+    """
+    Full re-scan of the media folder app.config['MEDIA_FOLDER']: entries of all previously scanned files
+    will be removed from database and all files will be parsed again.
+    Other tables (tags, locations, users) will be left intact.
+
+    :return: a dictionary of counts: total (files to be parsed).
+    """
+    db_queries.remove_previously_scanned(app_config['MEDIA_FOLDER'])
+    parallel_scan(app_config, user_id,
+                  helpers.iter_media_files(app_config['MEDIA_FOLDER'], app_config, False, progress), progress)
+    return {'total': progress.total}
+
+
+def increment_scan(app_config, user_id, progress):
+    """
+    Scan the watch folder app.config['WATCH_FOLDER']: discovered files not yet registered
+    are moved into the media folder and registered. Entries of previously scanned files will not be affected.
+
+    :return: a dictionary of counts: total (files to be parsed).
+    """
+    parallel_scan(app_config, user_id,
+                  helpers.iter_media_files(app_config['WATCH_FOLDER'], app_config, True, progress), progress)
+    return {'total': progress.total}
@@ -0,0 +1,130 @@
+"""A module to find visually similar photos by their perceptual hashes (see metamedia.Photo.perceptual_hash())."""
+import time
+import logging
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import combinations
+from .models import db_session
+from . import db_queries
+
+
+# A number of parts 64-bit hashes are split into to be indexed (multi-index hashing):
+BLOCKS = 4
+BLOCK_BITS = 64 // BLOCKS
+# A maximum number of differing bits for photos to be considered similar - by default and at most:
+DEFAULT_DISTANCE = 10
+MAX_DISTANCE = 16
+# A number of seconds the index is used before it is rebuilt from the database:
+REFRESH_AFTER = 300
+
+
+def to_unsigned(value):
+    """Convert a 64-bit hash stored in the database as a signed integer into an unsigned one."""
+    return value & 0xFFFFFFFFFFFFFFFF
+
+
+def hamming_distance(hash1, hash2):
+    """Return a number of bits differing in two unsigned 64-bit hashes."""
+    return bin(hash1 ^ hash2).count('1')
+
+
+class SimilarityIndex:
+    """
+    An in-memory multi-index hashing structure over perceptual hashes of all photos.
+    Every hash is split into BLOCKS parts of BLOCK_BITS bits, and for every part positions of hashes
+    are kept sorted by the part value. If two hashes differ in not more than distance bits, then at least
+    one of their parts differs in not more than distance // BLOCKS bits (pigeonhole principle), so
+    candidates are found by looking up a few part values in each block (binary search in sorted arrays)
+    and only candidates are compared bit by bit - instead of comparing with every photo.
+    Arrays of machine integers keep the index compact: about 30 bytes per photo.
+    An outdated index is rebuilt in a background thread, queries are served by the previous one meanwhile.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = 0  # a timestamp of the last build, 0 if the index is to be (re)built
+        self.rebuilding = None  # a thread rebuilding the index in background
+        # A tuple (ids, hashes, positions, keys) replaced at once by every build, None until the first build:
+        # positions are arrays of positions sorted by part values, keys are arrays of part values (sorted)
+        # matching positions - one per block.
+        self.index = None
+
+    def invalidate(self):
+        """Make the index rebuilt on the next query (e.g. once new photos are registered)."""
+        self.built = 0
+
+    def build(self):
+        """(Re)build the index from all perceptual hashes stored in the database."""
+        started = time.time()
+        ids, hashes = array('q'), array('Q')
+        for mediafile_id, value in db_queries.get_perceptual_hashes():
+            ids.append(mediafile_id)
+            hashes.append(to_unsigned(value))
+        positions, keys = [], []
+        mask = (1 << BLOCK_BITS) - 1
+        for block in range(BLOCKS):
+            shift = block * BLOCK_BITS
+            order = sorted(range(len(hashes)), key=lambda i: hashes[i] >> shift & mask)
+            positions.append(array('l', order))
+            keys.append(array('H' if BLOCK_BITS <= 16 else 'L', (hashes[i] >> shift & mask for i in order)))
+        self.index = (ids, hashes, positions, keys)
+        self.built = started  # photos registered meanwhile are found once the index is outdated again
+        logging.info('Similarity index of %s photos built in %.2f seconds.' % (len(ids), time.time() - started))
+
+    def ensure_built(self):
+        """
+        Build the index if it has not been built yet (the caller waits for it),
+        or start rebuilding it in background if it is outdated.
+        """
+        with self.lock:
+            if self.index is None:
+                self.build()
+            elif time.time() - self.built > REFRESH_AFTER and not self.rebuilding:
+                self.rebuilding = threading.Thread(target=self._rebuild, daemon=True, name='similarity-rebuild')
+                self.rebuilding.start()
+
+    def _rebuild(self):
+        """Rebuild the index (in a background thread)."""
+        try:
+            self.build()
+        except Exception as err:
+            logging.exception('Similarity index rebuild failed due to %s.' % err)
+        finally:
+            db_session.remove()
+            with self.lock:
+                self.rebuilding = None
+
+    def find(self, value, distance=DEFAULT_DISTANCE, exclude=None):
+        """
+        Find photos which perceptual hashes differ from the given one in not more than distance bits.
+
+        :param value: a perceptual hash (as stored in the database).
+        :param distance: a maximum number of differing bits (up to MAX_DISTANCE).
+        :param exclude: an id of the photo to be skipped (e.g. the one being compared with others).
+        :return: a list of tuples (distance, id) sorted by distance.
+        """
+        self.ensure_built()
+        value, distance = to_unsigned(value), max(min(int(distance), MAX_DISTANCE), 0)
+        mask = (1 << BLOCK_BITS) - 1
+        flips = [0]
+        for bits in range(1, distance // BLOCKS + 1):
+            flips.extend(sum(1 << bit for bit in combination) for combination in combinations(range(BLOCK_BITS), bits))
+        ids, hashes, all_positions, all_keys = self.index
+        checked, found = set(), []
+        for block, (positions, keys) in enumerate(zip(all_positions, all_keys)):
+            key = value >> block * BLOCK_BITS & mask
+            for flip in flips:
+                probe = key ^ flip
+                for i in range(bisect_left(keys, probe), bisect_right(keys, probe)):
+                    position = positions[i]
+                    if position in checked:
+                        continue
+                    checked.add(position)
+                    bits = hamming_distance(value, hashes[position])
+                    if bits <= distance and ids[position] != exclude:
+                        found.append((bits, ids[position]))
+        return sorted(found)
+
+
+similarity_index = SimilarityIndex()
@@ -31,6 +31,25 @@ $(function() {
             getValue: 'hint'
         });
 
+		$("video[data-sprite]").on("mousemove", function(e) {
+			// Scrub through the sprite sheet of a paused video on hover, without loading the video itself
+			if (!this.paused || this.currentTime > 0) {
+				return
+			}
+			frames = Number($(this).data("sprite-frames"))
+			frame = Math.min(Math.floor(e.offsetX / this.clientWidth * frames), frames - 1)
+			$(this).data("poster", $(this).data("poster") || this.poster)
+			this.removeAttribute("poster")
+			$(this).css({"background": "url(" + $(this).data("sprite") + ") no-repeat",
+						 "background-size": (frames * 100) + "% 100%",
+						 "background-position": (frames > 1 ? frame * 100 / (frames - 1) : 0) + "% 0"})
+		}).on("mouseleave play", function() {
+			if ($(this).data("poster")) {
+				this.poster = $(this).data("poster")
+			}
+			$(this).css("background", "")
+		});
+
 	});  // onLoad function()
 
 });  // function()
@@ -76,54 +95,67 @@ function load_coords() {
 
 
 function scan_media(increment=false) {
-	// Start scan of media folder in parallel
+	// Start a background scan job of media (or watch) folder
 	// and start timer to update progress bar (update interval is 1 second)
-	scan_status_interval = setInterval(function() {
-		scan_status()
-	}, 1000); // time in milliseconds;
-
     ajax_path = increment ? "/_scan_increment" : "/_scan";
 
 	$.getJSON(ajax_path, function(data) {
-		if ($("#scan_progress").html() == "") {
-		    scan_status()
+		if (typeof scan_status_interval !== "undefined") {
+			clearInterval(scan_status_interval)
 		}
+		scan_status(data.job)
+		scan_status_interval = setInterval(function() {
+			scan_status(data.job)
+		}, 1000); // time in milliseconds;
 	});  // getJSON
 }  // scan_media()
 
 
-function scan_status() {
-	// Read scan progress from server and update statistics and refresh progress bar;
-	// if total is 0 or once 100% (passed + failed == total) is reached, stop calling for scan process updates.
-	$.getJSON("/_scan_status", function(data) {
+function scan_status(job, cancel=false) {
+	// Read progress of the scan job from server and update statistics and refresh progress bar;
+	// once the scan job is not running anymore, stop calling for scan process updates.
+	// Only the first page of declined/failed files is displayed (see /_scan_status?page=<number>).
+	$.getJSON("/_scan_status", {"job": job, "cancel": cancel ? "yes" : "no"}, function(data) {
 		total = parseInt(data.total)
 		passed = parseInt(data.passed)
 		failed = parseInt(data.failed)
-		declined = data.declined == '' ? '<span style="color: green">None</span>' : data.declined
+		declined = parseInt(data.declined)
+		issues = data.issues.map(function(issue) { return issue.reason + ': ' + issue.path }).join('<br>')
+		issues = issues == '' ? '<span style="color: green">None</span>' : issues
+		if (data.issues.length < failed + declined) {
+			issues += '<br>... (' + (failed + declined) + ' in total)'
+		}
 		progress = total == 0 ? 0 : Math.ceil(100 * (passed + failed) / (1.0 * total))
-		content = '<span>Total items found: ' + total + '</span><div class="progress">'
+		content = '<span>Scan job #' + data.job + ': ' + data.status + '</span>'
+		if (data.status == "running") {
+			content += ' <a href="javascript:scan_status(' + data.job + ', true)">Cancel</a>'
+		}
+		content += '<br><span>Total items found: ' + total + '</span><div class="progress">'
 		content += '<div class="progress-bar bg-info" role="progressbar" style="width: ' + progress + '%" aria-valuenow="' 
 		content += (passed + failed) + '" aria-valuemin="0" aria-valuemax="' + total + '">' + progress + '%</div></div>'
 		content += '<span style="color: green">Passed: ' + passed + '</span><br>'
-		content += '<span style="color: red">Failed: ' + failed + '</span><br><br>'
-		content += '<span>Declined files:</span><br><pre style="color: red">' + declined.replace(/;/g, '<br>') + '</pre>'
+		content += '<span style="color: red">Failed: ' + failed + '</span><br>'
+		content += '<span>Declined: ' + declined + '</span><br><br>'
+		content += '<span>Declined/failed files:</span><br><pre style="color: red">' + issues + '</pre>'
 		$("#scan_progress").html(content);
-		if (total >= 0 && passed + failed == total) {
+		if (data.status != "running" && data.status != "cancelling") {
 			clearInterval(scan_status_interval)
 		}
 	});  // getJSON
 }  // scan_status()
 
 
-function show_mediafile_preview(mediafile_id, mediafile_path) {
+function show_mediafile_preview(mediafile_id, mediafile_path, checksum="") {
 	// Load photo or video file in the div container and update "visits" & "accessed" values
+	// (URLs versioned by the content hash are cached by the browser, see download_file() view)
 	content = $("#preview-" + mediafile_id).html()
 	if (content == "") {
+		url = "/load_mediafile" + mediafile_path + (checksum ? "?v=" + checksum : "")
 		if (mediafile_path.toLowerCase().endsWith(".jpg") || mediafile_path.toLowerCase().endsWith(".jpeg")) {
-			content = '<img src="/load_mediafile' + mediafile_path + '" style="max-width: 100%" />'
+			content = '<img src="' + url + '" style="max-width: 100%" />'
 		} else {
 			content =	'<video controls="controls" preload="metadata" style="max-width: 100%">' +
-						'<source src="/load_mediafile' + mediafile_path + '">' +
+						'<source src="' + url + '">' +
 						'</video>'
 		}
 	} else {
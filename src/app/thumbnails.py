@@ -0,0 +1,245 @@
+"""A module to generate thumbnails of photos and previews of videos and keep them in a size-bounded on-disk cache."""
+import os
+import time
+import logging
+import tempfile
+import threading
+from PIL import Image, ImageOps
+from .metamedia import Video
+
+
+# Bounding boxes (in pixels) of thumbnails by size names: for lists, tiles and gallery views respectively:
+SIZES = {'small': 96, 'medium': 320, 'large': 1280}
+# Sizes generated as soon as photos are registered (others are generated on first request):
+EAGER_SIZES = ['small', 'medium']
+JPEG_QUALITY = 85
+# Previews of videos: a poster frame (displayed instead of loading the video) and a sprite sheet (to scrub on hover):
+VIDEO_PREVIEWS = ['poster', 'sprite']
+POSTER_WIDTH = 640
+SPRITE_FRAMES = 10
+SPRITE_FRAME_WIDTH = 160
+# A number of seconds after which a served thumbnail is marked as recently used again (see ThumbnailCache.touch()):
+TOUCH_AFTER = 86400
+
+
+def thumbnail_path(folder, size, checksum):
+    """
+    Get the path of the thumbnail in the cache: thumbnails are addressed by the hash of the photo content,
+    so copies of a photo share them, and a changed photo never gets an outdated thumbnail.
+
+    :param folder: an absolute path to the cache folder.
+    :param size: a size name - one of SIZES keys.
+    :param checksum: a hash of the photo content (see helpers.file_checksum()).
+    :return: an absolute path to the thumbnail file (it may not exist).
+    """
+    return os.path.join(folder, size, checksum[:2], '%s.jpg' % checksum)
+
+
+def make_thumbnails(path, checksum, folder, sizes=None):
+    """
+    Generate thumbnails of the photo which are missing in the cache.
+    The JPEG is decoded in draft mode (downscaled by the decoder to the nearest scale above the biggest size),
+    then every next (smaller) thumbnail is reduced from the previous one - the original is decoded only once.
+    This function does not access the database, so it can be executed in worker processes.
+
+    :param path: an absolute path to the photo.
+    :param checksum: a hash of the photo content.
+    :param folder: an absolute path to the cache folder.
+    :param sizes: a list of size names to generate (all SIZES if None).
+    :return: a number of bytes written into the cache.
+    """
+    targets = [(SIZES[size], thumbnail_path(folder, size, checksum)) for size in sizes or SIZES]
+    targets = sorted((box, target) for box, target in targets if not os.path.isfile(target))
+    if not targets:
+        return 0
+    written = 0
+    with Image.open(path) as image:
+        image.draft('RGB', (targets[-1][0], targets[-1][0]))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB') if image.mode != 'RGB' else image
+        for box, target in reversed(targets):
+            image.thumbnail((box, box), Image.BICUBIC, reducing_gap=2.0)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            handle, tmp_path = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(target))
+            try:
+                with os.fdopen(handle, 'wb') as _f:
+                    image.save(_f, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+                os.replace(tmp_path, target)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            written += os.path.getsize(target)
+    return written
+
+
+def make_video_previews(video, checksum, folder, sprite=True):
+    """
+    Generate previews of the video (unless all of them are already in the cache) in one FFMPEG run.
+    This function does not access the database, so it can be executed in worker threads/processes.
+
+    :param video: an instance of metamedia.Video() class.
+    :param checksum: a hash of the video content.
+    :param folder: an absolute path to the cache folder.
+    :param sprite: a boolean to generate a sprite sheet along with the poster.
+    :return: a number of bytes written into the cache.
+    """
+    targets = {name: thumbnail_path(folder, name, checksum) for name in VIDEO_PREVIEWS[:2 if sprite else 1]}
+    if all(os.path.isfile(target) for target in targets.values()):
+        return 0
+    parts = {}
+    for name, target in targets.items():
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        handle, parts[name] = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(target))
+        os.close(handle)
+    written = 0
+    try:
+        if video.extract_previews(parts['poster'], POSTER_WIDTH, parts.get('sprite'), SPRITE_FRAMES, SPRITE_FRAME_WIDTH):
+            for name, part in parts.items():
+                if os.path.getsize(part):  # e.g. a sprite sheet is not extracted from a video without duration
+                    os.replace(part, targets[name])
+                    written += os.path.getsize(targets[name])
+    finally:
+        for part in parts.values():
+            if os.path.isfile(part):
+                os.remove(part)
+    return written
+
+
+class ThumbnailCache:
+    """
+    The cache of thumbnails on disk bounded by app.config['THUMBNAIL_CACHE_SIZE'] megabytes:
+    once exceeded, the least recently used thumbnails (by modification time, which is refreshed
+    when a thumbnail is served) are removed in a background thread until 90% of the limit is left.
+    Eviction is triggered after scans and once enough thumbnails are generated on request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.folder = ''
+        self.max_bytes = 0
+        self.written = 0  # bytes written by this process since the last eviction
+        self.settings = {}  # FFMPEG_PATH, FFPROBE_PATH and VIDEO_SPRITES to generate previews of videos
+        self.evicting = None
+
+    def configure(self, app_config):
+        """Apply THUMBNAIL_FOLDER, THUMBNAIL_CACHE_SIZE and settings required to generate previews of videos."""
+        self.folder = app_config['THUMBNAIL_FOLDER']
+        self.max_bytes = int(app_config['THUMBNAIL_CACHE_SIZE']) * 1048576
+        self.settings = {key: app_config[key] for key in ['FFMPEG_PATH', 'FFPROBE_PATH', 'VIDEO_SPRITES']}
+
+    def get(self, size, checksum, path=None):
+        """
+        Get the path of the thumbnail (or video preview), generate it if it is missing and the path
+        of the photo (or video) is given.
+
+        :param size: a size name - one of SIZES keys or VIDEO_PREVIEWS.
+        :param checksum: a hash of the photo (or video) content.
+        :param path: an absolute path to the photo or video (None if it is not known).
+        :return: an absolute path to the thumbnail file, or None if it is not available.
+        """
+        target = thumbnail_path(self.folder, size, checksum)
+        if os.path.isfile(target):
+            self.touch(target)
+            return target
+        if not path:
+            return None
+        if size in VIDEO_PREVIEWS:
+            self.generate_video(path, checksum, sprite=size == 'sprite' or self.settings['VIDEO_SPRITES'])
+        else:
+            self.generate(path, checksum, [size])
+        return target if os.path.isfile(target) else None
+
+    def generate(self, path, checksum, sizes=None):
+        """
+        Generate missing thumbnails of the photo (e.g. once it is uploaded).
+
+        :param path: an absolute path to the photo.
+        :param checksum: a hash of the photo content.
+        :param sizes: a list of size names to generate (EAGER_SIZES if None).
+        :return: True if thumbnails are in the cache, False if they cannot be generated.
+        """
+        try:
+            self.add(make_thumbnails(path, checksum, self.folder, sizes or EAGER_SIZES))
+        except (IOError, ValueError) as err:
+            logging.error('Cannot generate thumbnails of "%s" due to %s.' % (path, err))
+            return False
+        return True
+
+    def generate_video(self, path, checksum, sprite=None):
+        """
+        Generate missing previews of the video (e.g. once it is uploaded or converted into MP4).
+
+        :param path: an absolute path to the video.
+        :param checksum: a hash of the video content.
+        :param sprite: a boolean to generate a sprite sheet too (app.config['VIDEO_SPRITES'] if None).
+        :return: True if previews are in the cache, False if they cannot be generated.
+        """
+        sprite = self.settings['VIDEO_SPRITES'] if sprite is None else sprite
+        try:
+            video = Video(path, self.settings['FFMPEG_PATH'], self.settings['FFPROBE_PATH'])
+            self.add(make_video_previews(video, checksum, self.folder, sprite))
+        except Exception as err:  # e.g. broken metadata: previews are optional, so never fail the caller
+            logging.error('Cannot generate previews of "%s" due to %s.' % (path, err))
+            return False
+        return True
+
+    @staticmethod
+    def touch(target):
+        """Mark the thumbnail as recently used (at most once per TOUCH_AFTER seconds, to save disk writes)."""
+        try:
+            if os.stat(target).st_mtime < time.time() - TOUCH_AFTER:
+                os.utime(target)
+        except OSError:
+            pass
+
+    def add(self, written):
+        """Count bytes written into the cache, and start eviction once a tenth of the limit has been written."""
+        with self.lock:
+            self.written += written
+            due = self.written > self.max_bytes // 10
+        if due:
+            self.evict()
+
+    def evict(self):
+        """Start eviction in a background thread (if it is not running yet)."""
+        with self.lock:
+            if self.evicting or not self.folder:
+                return
+            self.written = 0
+            self.evicting = threading.Thread(target=self._evict, daemon=True, name='thumbnails-evict')
+            self.evicting.start()
+
+    def _evict(self):
+        """Remove the least recently used thumbnails until the cache fits into 90% of the limit."""
+        try:
+            files, total = [], 0
+            for root, dirs, names in os.walk(self.folder):
+                for name in names:
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue  # removed meanwhile (e.g. by another process)
+                    files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+                    total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            files.sort()
+            removed, target = 0, self.max_bytes * 0.9
+            for mtime, size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+                total -= size
+            logging.info('Evicted %s thumbnails, %s bytes left in cache.' % (removed, total))
+        except Exception as err:
+            logging.exception('Thumbnails eviction failed due to %s.' % err)
+        finally:
+            with self.lock:
+                self.evicting = None
+
+
+cache = ThumbnailCache()
@@ -0,0 +1,139 @@
+"""A module to convert non-MP4 videos into MP4 in background, separately from scanning and uploading."""
+import os
+import time
+import logging
+import threading
+from collections import deque
+from .models import db_session, get_time_str
+from .metamedia import Video, format_timestamp
+from . import db_queries
+from . import helpers
+from . import thumbnails
+
+
+# A number of seconds after which a running conversion is considered interrupted (e.g. by a restart):
+STALE_AFTER = 6 * 3600
+# FFMPEG options to convert a video into MP4 (tested for '3gp', 'mpg', 'mpeg', 'mov', 'avi' - works well):
+TRANSCODE_OPTIONS = ' -y -vcodec h264 -acodec aac -strict -2 -b:a 384k '
+
+
+class TranscodeQueue:
+    """
+    Convert videos registered with transcode state 'pending' into MP4 by a limited number of background
+    threads (app.config['TRANSCODE_WORKERS'] conversions at once in all processes), so that long conversions
+    never stall parsing and registering of other media files. The queue itself is kept in the database,
+    so pending conversions survive restarts and are shared (but never duplicated) between processes.
+    Metadata stored in the database is written into the converted file.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.workers = []
+        self.generation = 0  # incremented by every wake() call, so that idle workers re-check the queue
+        self.converting = {}  # paths of videos being converted by thread identifiers
+        self.completed = 0
+        self.recent = deque(maxlen=100)  # tuples (finish timestamp, seconds spent) of recent conversions
+
+    def wake(self, app_config):
+        """
+        Start workers (up to app_config['TRANSCODE_WORKERS'] in this process) to convert pending videos.
+        Call it whenever new videos are registered - it is cheap if workers are already running.
+        Workers of all processes together never run more than app_config['TRANSCODE_WORKERS'] conversions
+        (see db_queries.claim_transcode()): a worker exits if the limit is reached, and the running ones
+        take the rest of the queue.
+
+        :param app_config: a dictionary containing FFMPEG_PATH, FFPROBE_PATH and TRANSCODE_WORKERS settings.
+        """
+        settings = {key: app_config[key] for key in ['FFMPEG_PATH', 'FFPROBE_PATH', 'TRANSCODE_WORKERS']}
+        with self.lock:
+            self.generation += 1
+            for _ in range(max(int(app_config['TRANSCODE_WORKERS']), 1) - len(self.workers)):
+                thread = threading.Thread(target=self._work, args=(settings,), daemon=True,
+                                          name='transcode-%s' % (len(self.workers) + 1))
+                self.workers.append(thread)
+                thread.start()
+
+    def _work(self, settings):
+        """Convert pending videos one by one until there is nothing left (the worker thread exits then)."""
+        try:
+            while True:
+                with self.lock:
+                    generation = self.generation
+                entry = db_queries.claim_transcode(stale_time_str(), max(int(settings['TRANSCODE_WORKERS']), 1))
+                if entry:
+                    self.transcode(entry, settings)
+                    continue
+                with self.lock:
+                    if generation == self.generation:  # nothing has been queued meanwhile
+                        self.workers.remove(threading.current_thread())
+                        return
+        except Exception as err:
+            logging.exception('Transcoding worker failed due to %s.' % err)
+            with self.lock:
+                self.workers.remove(threading.current_thread())
+        finally:
+            db_session.remove()
+
+    def transcode(self, entry, settings):
+        """
+        Convert the video of the given entry into MP4 and point the entry to the converted file,
+        or mark the entry as 'failed' if conversion is not possible.
+
+        :param entry: an instance of MediaFiles() class (claimed by db_queries.claim_transcode()).
+        :param settings: a dictionary containing FFMPEG_PATH and FFPROBE_PATH settings.
+        """
+        started, mediafile_id, path = time.time(), entry.id, entry.path
+        self.converting[threading.get_ident()] = path
+        values = {'transcode': 'failed', 'updated': get_time_str()}
+        try:
+            if os.path.isfile(path):
+                video = Video(path, settings['FFMPEG_PATH'], settings['FFPROBE_PATH'])
+                gps = None
+                if entry.coords or entry.location_id:  # keep city and country from location but original coords
+                    location, coords = entry.location_relation, (entry.coords or '').split(',')
+                    gps = {'latitude': coords[0], 'longitude': coords[-1], 'city': getattr(location, 'city', ''),
+                           'country': getattr(location, 'country', ''), 'code': getattr(location, 'code', '')}
+                options = video.metadata_options(video.metadata_values(entry.title, entry.description, entry.tags,
+                                                                       entry.comment, gps, entry.created))
+                db_session.commit()  # do not keep the transaction open during a long conversion
+                video.convert_to_mp4(TRANSCODE_OPTIONS + options)
+                if video.path != path:
+                    stat = os.stat(video.path)
+                    values.update({'path': video.path, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                                   'checksum': helpers.file_checksum(video.path), 'transcode': ''})
+            else:
+                logging.error('Cannot convert "%s" - it does not exist or is not a file.' % path)
+            db_queries.update_mediafile_values(mediafile_id, values)
+        except Exception as err:
+            db_session.rollback()
+            logging.exception('Cannot convert "%s" due to %s.' % (path, err))
+            values = {'transcode': 'failed', 'updated': get_time_str()}
+            db_queries.update_mediafile_values(mediafile_id, values)
+        finally:
+            self.converting.pop(threading.get_ident(), None)
+        if not values['transcode']:
+            self.completed += 1
+            self.recent.append((time.time(), time.time() - started))
+            thumbnails.cache.generate_video(values['path'], values['checksum'])  # pages display the poster
+
+    def status(self):
+        """
+        Get the state of the queue: numbers of pending/running/failed conversions (all processes),
+        and workers, videos being converted and throughput of conversions in the current process.
+
+        :return: a dictionary of the queue state values.
+        """
+        durations = [seconds for finished, seconds in self.recent if finished >= time.time() - 3600]
+        data = db_queries.get_transcode_counts()
+        data.update({'workers': len(self.workers), 'converting': sorted(self.converting.values()),
+                     'completed': self.completed, 'last_hour': len(durations),
+                     'avg_seconds': round(sum(durations) / len(durations), 1) if durations else 0})
+        return data
+
+
+def stale_time_str():
+    """Get date & time (in the format of get_time_str()) before which running conversions are considered stale."""
+    return format_timestamp(time.time() - STALE_AFTER, '%Y-%m-%d %H:%M:%S')
+
+
+transcode_queue = TranscodeQueue()
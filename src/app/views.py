@@ -1,10 +1,14 @@
 import os
 import json
+import random
+import mimetypes
 from functools import wraps
+from urllib.parse import quote
 from flask import session, render_template, redirect, abort, url_for, \
-    request, jsonify, flash, send_file
+    request, jsonify, flash, send_file, make_response
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import app
+from conf import DEFAULT_SETTINGS
 from .forms import MediaFilesForm, LocationsForm, TagsForm, SettingsForm, \
     UsersForm, LoginForm, UploadForm
 from .models import MediaFiles, Locations, Users, Tags, db_session, paginate, get_time_str
@@ -12,6 +16,17 @@ from .metamedia import MultiMedia
 from . import db_queries
 from . import geo_tools
 from . import helpers
+from . import scanner
+from .scan_progress import get_scan_status
+from . import scan_jobs
+from . import transcoder
+from . import geocoder
+from . import similarity
+from . import thumbnails
+
+
+# A number of seconds clients may keep responses under versioned (content-addressed) URLs:
+IMMUTABLE_MAX_AGE = 31536000
 
 
 def login_required(route_function):
@@ -29,29 +44,77 @@ def login_required(route_function):
     return decorated_function
 
 
+def send_media_file(path, mimetype=None, etag=None, immutable=False, private=False):
+    """
+    Send the file to the client. If app.config['MEDIA_DELIVERY'] is 'nginx' and the file is in the media folder
+    (or in the thumbnails folder), only the X-Accel-Redirect header pointing to the internal nginx location
+    is returned, and nginx sends the file itself (see nginx configs in "deploy" folder), so that uWSGI processes
+    are not tied up by long transfers. Otherwise the file is sent by Flask conditionally: Range requests get
+    206 partial responses (to seek in videos), requests with If-None-Match/If-Modified-Since matching
+    the ETag/Last-Modified of the file get empty 304 responses.
+    Responses under versioned URLs (immutable) are cached by clients for a year without revalidation,
+    other responses are revalidated by clients on every use (which costs a 304 response if nothing has changed).
+
+    :param path: an absolute path to the file (the caller is responsible for authorization).
+    :param mimetype: a MIME type of the file (guessed by the file extension if None).
+    :param etag: a strong ETag of the file (e.g. its content hash), Flask makes one of mtime and size if None
+                 (nginx always makes it of mtime and size).
+    :param immutable: a boolean, True if the URL changes whenever the file content changes.
+    :param private: a boolean, True if the file must not be stored by shared caches (e.g. it is not public).
+    :return: a response object.
+    """
+    if immutable:
+        cache_control = '%s, max-age=%s, immutable' % ('private' if private else 'public', IMMUTABLE_MAX_AGE)
+    else:
+        cache_control = 'private, no-cache' if private else 'no-cache'
+    if app.config['MEDIA_DELIVERY'] == 'nginx':
+        for folder, location in [(app.config['MEDIA_FOLDER'], app.config['MEDIA_ACCEL_LOCATION']),
+                                 (app.config['THUMBNAIL_FOLDER'], app.config['THUMBNAIL_ACCEL_LOCATION'])]:
+            folder = os.path.join(os.path.normpath(folder), '')
+            if path.startswith(folder):
+                response = make_response('')
+                response.headers['X-Accel-Redirect'] = location + quote(path[len(folder):].replace(os.sep, '/'))
+                response.headers['Content-Type'] = mimetype or mimetypes.guess_type(path)[0] \
+                    or 'application/octet-stream'
+                response.headers['Cache-Control'] = cache_control  # nginx keeps it, and adds ETag & Last-Modified
+                return response
+    response = send_file(path, mimetype=mimetype, add_etags=etag is None, conditional=etag is None)
+    if etag:
+        response.set_etag(etag)
+        response = response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(path))
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
 @app.route('/_scan')
 def scan():
     """
-    On AJAX request - scan the media folder app.config['MEDIA_FOLDER']
+    On AJAX request - start a background job to scan the media folder app.config['MEDIA_FOLDER']
     and register all discovered media files with public access.
     Only files with allowed extensions (see app.config['ALLOWED_EXTENSIONS']) will be processed.
 
-    Note! Entries of previously scanned files (in fact, entries about all public files - user_id=0)
-          will be removed from database. Other tables (tags, locations, users) will be left intact.
+    By default, the scan is incremental (reconcile mode): only new files are registered,
+    only changed files (by size or last modification time) are re-parsed,
+    and entries of files vanished from disk are removed - other entries are left intact.
 
-    :return: a jsonified response containing the total number of discovered files.
+    Note! With request argument mode=full, entries of all previously scanned files
+          will be removed from database and all files will be parsed again.
+          Other tables (tags, locations, users) will be left intact.
+
+    :return: a jsonified response containing the scan job id (see /_scan_status)
+             and a flag if the job has been started (false if the folder is already being scanned).
     """
-    all_media_files = helpers.collect_media_files(app.config['MEDIA_FOLDER'], app.config, False)
-    db_queries.remove_previously_scanned(app.config['MEDIA_FOLDER'])
     public_user_id = 0  # just to emphasize that all scanned files will be available for any user
-    helpers.parallel_scan(app.config, public_user_id, all_media_files)
-    return jsonify(total=len(all_media_files))
+    scan_function = scanner.full_scan if request.args.get('mode') == 'full' else scanner.reconcile_scan
+    job_id, started = scan_jobs.manager.submit(app.config['MEDIA_FOLDER'], scan_function,
+                                               app.config, public_user_id)
+    return jsonify(job=job_id, started=started)
 
 
 @app.route('/_scan_increment')
 def scan_increment():
     """
-    On AJAX request - scan the watch folder app.config['WATCH_FOLDER']
+    On AJAX request - start a background job to scan the watch folder app.config['WATCH_FOLDER']
     and register all discovered media files with public access.
     Only files with allowed extensions (see app.config['ALLOWED_EXTENSIONS']) will be processed.
 
@@ -59,29 +122,112 @@ def scan_increment():
           If a file already exists in media folder, no overwrites will happen,
           and the increment file will remain in watch folder.
 
-    :return: a jsonified response containing the total number of discovered files.
+    :return: a jsonified response containing the scan job id (see /_scan_status)
+             and a flag if the job has been started (false if the folder is already being scanned).
     """
-    all_media_files = helpers.collect_media_files(app.config['WATCH_FOLDER'], app.config, True)
     public_user_id = 0  # just to emphasize that all scanned files will be available for any user
-    helpers.parallel_scan(app.config, public_user_id, all_media_files)
-    return jsonify(total=len(all_media_files))
+    job_id, started = scan_jobs.manager.submit(app.config['WATCH_FOLDER'], scanner.increment_scan,
+                                               app.config, public_user_id)
+    return jsonify(job=job_id, started=started)
 
 
 @app.route('/_scan_status')
 def scan_status():
     """
-    On AJAX request - read scan statistics from 'persist/scan.json' file:
-    - numbers of total/passed/failed files;
-    - a string of semicolon-separated absolute paths of declined files.
+    On AJAX request - get statistics of the given scan job (request argument job=<id>)
+    or the most recent one:
+    - numbers of total/passed/failed/declined files, status of the scan job;
+    - a page (request argument page=<number>, 100 items per page) of absolute paths
+      of declined and failed files.
+    With request argument cancel=yes, cancellation of the running scan job is requested first.
 
     :return: a jsonified response of scan statistics.
     """
-    with open(os.path.join('persist', 'scan.json'), 'r') as scan_progress_file:
-        data = json.loads(scan_progress_file.read())
-    return jsonify(total=data['total'],
-                   failed=data['failed'],
-                   passed=data['passed'],
-                   declined=data['declined'])
+    per_page = 100
+    page = max(request.args.get('page', 1, type=int), 1)
+    job_id = request.args.get('job', type=int)
+    if job_id and request.args.get('cancel') == 'yes':
+        scan_jobs.manager.cancel(job_id)
+    data = get_scan_status(job_id)
+    if not data:
+        return jsonify(job=None, status='', total=0, passed=0, failed=0, declined=0, issues=[],
+                       page=page, per_page=per_page)
+    issues = db_queries.get_scan_issues(data['id'], page, per_page)
+    return jsonify(job=data['id'], status=data['status'], total=data['total'],
+                   passed=data['passed'], failed=data['failed'], declined=data['declined'],
+                   issues=[{'path': path, 'reason': reason} for path, reason in issues],
+                   page=page, per_page=per_page)
+
+
+@app.route('/_transcode_status')
+def transcode_status():
+    """
+    On AJAX request - get the state of the queue of videos to be converted into MP4:
+    numbers of pending/running/failed conversions, and for the current process - a number of workers,
+    paths of videos being converted, numbers of completed conversions (in total and within the last hour)
+    and the average conversion time in seconds.
+    Conversions left pending (e.g. after a restart) are resumed on request.
+
+    :return: a jsonified response of the transcoding queue state.
+    """
+    data = transcoder.transcode_queue.status()
+    if (data['pending'] or data['running']) and not data['workers']:
+        transcoder.transcode_queue.wake(app.config)
+    return jsonify(**data)
+
+
+@app.route('/_geocode_status')
+def geocode_status():
+    """
+    On AJAX request - get the state of the queue of media files which locations are to be detected by coords:
+    numbers of pending/running/failed entries, and for the current process - a number of workers,
+    numbers of geocoded entries and lookups, and hit/miss counters of the geocoding cache
+    (hits in memory, hits on disk, misses, a number of entries kept in memory and the hit ratio).
+    Entries left pending (e.g. after a restart) are resumed on request.
+
+    :return: a jsonified response of the geocoding queue state.
+    """
+    data = geocoder.geocode_queue.status()
+    if (data['pending'] or data['running']) and not data['workers']:
+        geocoder.geocode_queue.wake()
+    return jsonify(**data)
+
+
+@app.route('/_duplicates')
+@login_required
+def duplicates_data():
+    """
+    On AJAX request - get groups of files having the same content (see db_queries.get_duplicates()),
+    a total number of redundant copies and the space they take in bytes.
+
+    :return: a jsonified response of duplicates.
+    """
+    groups = db_queries.get_duplicates()
+    return jsonify(groups=groups, copies=sum(len(group['files']) - 1 for group in groups),
+                   wasted=sum(group['wasted'] for group in groups))
+
+
+@app.route('/_similar/<int:mediafile_id>')
+def similar_mediafiles(mediafile_id):
+    """
+    On AJAX request - find photos visually similar to the given one (e.g. burst shots, resized or edited copies)
+    by their perceptual hashes, among public photos and photos owned by the current user.
+    Query parameter distance (up to similarity.MAX_DISTANCE) limits the number of differing bits of hashes,
+    limit - the number of returned photos.
+
+    :param mediafile_id: an id of the photo in the database.
+    :return: a jsonified response of similar photos (id, path, distance), the most similar first.
+    """
+    media = db_queries.get_mediafile(mediafile_id)
+    if not media or media.phash is None:
+        abort(404, 'Media file #%s is missing or it has no perceptual hash.' % mediafile_id)
+    distance = request.args.get('distance', similarity.DEFAULT_DISTANCE, type=int)
+    limit = request.args.get('limit', 100, type=int)
+    found = similarity.similarity_index.find(media.phash, distance, exclude=mediafile_id)
+    paths = db_queries.get_visible_paths([mediafile_id for bits, mediafile_id in found], session.get('user_id', 0))
+    similar = [{'id': mediafile_id, 'path': paths[mediafile_id], 'distance': bits}
+               for bits, mediafile_id in found if mediafile_id in paths][:limit]
+    return jsonify(id=mediafile_id, distance=distance, similar=similar)
 
 
 @app.route('/_hint')
@@ -166,11 +312,50 @@ def download_file(abs_path):
     """
     Send the contents of a file to the client -
     this is used to display photo or video as a static file on the web pages.
+    Only registered media files which are public or owned by the current user are sent.
+    The content hash of the file is its ETag, unless the file has been changed since it was hashed.
+    URLs versioned by the content hash (?v=<checksum>, see _thumbnail.html) are cached by clients forever.
 
     :param abs_path: an absolute path to the file.
     """
-    abs_path = abs_path.replace('/', os.sep).replace('opt/metaphotor/app/', '')
-    return send_file(abs_path)
+    path = os.path.normpath(os.sep + abs_path.replace('/', os.sep).lstrip(os.sep))
+    entry = db_queries.get_visible_mediafile(path, session.get('user_id', 0))
+    if not entry or not os.path.isfile(path):
+        abort(404)
+    stat = os.stat(path)
+    checksum = entry.checksum if (entry.size, entry.mtime) == (stat.st_size, stat.st_mtime) else None
+    return send_media_file(path, etag=checksum or '%x-%x' % (stat.st_size, stat.st_mtime_ns),
+                           immutable=bool(checksum) and request.args.get('v') == checksum,
+                           private=entry.user_id != 0)
+
+
+@app.route('/thumbnails/<size>/<checksum>.jpg')
+def thumbnail(size, checksum):
+    """
+    Send the thumbnail of a photo or the poster/sprite sheet of a video to the client (used in lists, tiles
+    and gallery views instead of originals). Thumbnails are addressed by the hash of the media file content,
+    so their URLs never change meaning and they can be cached by browsers forever.
+    Thumbnails are sent only if the media file is public or owned by the current user, thumbnails of private
+    media files are not stored by shared caches. A missing thumbnail is generated on the fly.
+
+    :param size: a size name - one of thumbnails.SIZES keys or thumbnails.VIDEO_PREVIEWS.
+    :param checksum: a hash of the media file content.
+    """
+    if size not in list(thumbnails.SIZES) + thumbnails.VIDEO_PREVIEWS \
+            or len(checksum) != 32 or set(checksum) - set('0123456789abcdef'):
+        abort(404)
+    entry = db_queries.get_visible_mediafile_by_checksum(checksum, session.get('user_id', 0))
+    if not entry:
+        abort(404)
+    thumbnail_path = thumbnails.cache.get(size, checksum)
+    if not thumbnail_path:
+        if scanner.is_photo(entry.path) != (size in thumbnails.SIZES) or helpers.needs_transcode(entry.path):
+            abort(404)
+        thumbnail_path = thumbnails.cache.get(size, checksum, entry.path)
+        if not thumbnail_path:
+            abort(404)
+    return send_media_file(thumbnail_path, mimetype='image/jpeg', etag='%s-%s' % (size, checksum), immutable=True,
+                           private=entry.user_id != 0)
 
 
 @app.route('/home')
@@ -242,11 +427,12 @@ def __top_stats(top_field_name, user_id=None, limit=10, sort_desc=True, randomiz
     user_id = session.get('user_id', 0) if user_id is None else user_id
     model_field = getattr(MediaFiles, top_field_name)
     fields = [MediaFiles.id, MediaFiles.year, MediaFiles.path, model_field, MediaFiles.coords,
-              MediaFiles.location_id, Locations.city, Locations.country, Locations.code]
+              MediaFiles.location_id, Locations.city, Locations.country, Locations.code, MediaFiles.checksum]
     locations = db_queries.get_all_locations([Locations.id, Locations.city, Locations.country])
     query = db_queries.top_mediafiles(user_id, fields, model_field, sort_desc, limit, randomize)
-    data, points = helpers.get_media_per_countries_counts(query.all())
-    return render_template('top.html', session=session, rows=paginate(query, 1, limit).items,
+    rows = query.all()
+    data, points = helpers.get_media_per_countries_counts(rows)
+    return render_template('top.html', session=session, rows=rows,
                            locations=locations, points=points, data=data, info=info,
                            top_field=top_field_name, fields=['year', 'path'] + [top_field_name])
 
@@ -308,14 +494,27 @@ def stats_mix():
     return __top_stats('id', 0, 100, randomize=True, info=info)
 
 
+@app.route('/statistics/duplicates')
+@login_required
+def stats_duplicates():
+    """Route to a view page of groups of files having the same content - registered twice or skipped by scans."""
+    groups = db_queries.get_duplicates()
+    wasted = sum(group['wasted'] for group in groups)
+    info = {'header': 'Duplicates',
+            'text': 'Below are %s groups of files having the same content, copies take %s.'
+                    % (len(groups), helpers.pretty_size(wasted))}
+    return render_template('duplicates.html', session=session, groups=groups, info=info,
+                           sizes={group['checksum']: helpers.pretty_size(group['size']) for group in groups})
+
+
 @app.route('/statistics/map')
 def geo_map():
     """Route to the web page to display snapshots counts and geo points on the world map."""
     fields = [MediaFiles.coords, MediaFiles.location_id,
               Locations.city, Locations.country, Locations.code]
     params = {'search': '', 'tags_matching': 'lazy', 'year': 'any', 'location': 'any'}
-    mediafiles = db_queries.get_all_mediafiles(-1, params, fields).all()
-    data, points = helpers.get_media_per_countries_counts(mediafiles)
+    places = db_queries.count_by_places(db_queries.get_all_mediafiles(-1, params, fields))
+    data, points = helpers.get_media_per_countries_counts(places)
     return render_template('map.html', session=session, points=points, data=data)
 
 
@@ -329,24 +528,35 @@ def list_mediafiles(page):
     Route to the web page containing a search form to find media files by different attributes.
     Search results will be paginated, a message about the number of found items will be flashed,
     and one out of three viewing templates will be selected: list (default), tiles or gallery.
+    Results are sorted by the 'sort' parameter (see db_queries.SORT_ORDERS), shuffled by default -
+    with a random seed which is kept in links to other pages, so pages never repeat or miss items.
+    The link to the next page carries a cursor ('after' parameter), so it is found by keyset pagination.
 
     :param page: a page number for pagination, default is 1 (pages start from 1).
     """
     fields = [MediaFiles.id, MediaFiles.year, MediaFiles.path, MediaFiles.tags, MediaFiles.coords,
-              MediaFiles.location_id, Locations.city, Locations.country, Locations.code]
+              MediaFiles.location_id, Locations.city, Locations.country, Locations.code, MediaFiles.checksum]
     locations = db_queries.get_all_locations([Locations.id, Locations.city, Locations.country])
-    params = request.args or {'search': '', 'tags_matching': 'lazy', 'view_mode': 'tiles',
-                              'ownership_public': 'on', 'year': 'any', 'location': 'any'}
+    params = request.args.to_dict() or {'search': '', 'tags_matching': 'lazy', 'view_mode': 'tiles',
+                                        'ownership_public': 'on', 'year': 'any', 'location': 'any'}
+    cursor = params.pop('after', None)
+    if params.setdefault('sort', 'shuffle') == 'shuffle' and not params.get('seed', '').isdigit():
+        params['seed'] = str(random.randrange(1000000000))
     query = db_queries.get_all_mediafiles(session.get('user_id', 0), params, fields)
-    pagination = paginate(query, page, app.config['ITEMS_PER_PAGE'])
+    items = db_queries.get_page(query, params, page, app.config['ITEMS_PER_PAGE'], cursor)
+    places = db_queries.count_by_places(query)
+    pagination = paginate(query, page, app.config['ITEMS_PER_PAGE'], items,
+                          total=sum(place['count'] for place in places))
+    pagination.next_cursor = db_queries.encode_cursor(pagination.items[-1]) \
+        if pagination.has_next and pagination.items else ''
     flash('Found items: %s.' % pagination.total, 'info')
-    data, points = helpers.get_media_per_countries_counts(query.all())
+    data, points = helpers.get_media_per_countries_counts(places)
     template = 'media%s.html' % params['view_mode'] \
         if params.get('view_mode') in ['list', 'tiles', 'gallery'] else 'mediatiles.html'
     return render_template(template, rows=pagination.items, pagination=pagination,
-                           session=session, args=request.args, locations=locations,
+                           session=session, args=params, locations=locations,
                            params='&'.join('%s=%s' % (key, value) for key, value in params.items()),
-                           points=points, data=data,
+                           points=points, data=data, sort_orders=list(db_queries.SORT_ORDERS),
                            table='mediafiles', fields=[field.__dict__['key'] for field in fields])
 
 
@@ -389,6 +599,7 @@ def inspect_mediafile(mediafile_id):
     item_file = MultiMedia.detect(item_db['path'], app.config,
                                   ffmpeg_path=app.config['FFMPEG_PATH'],
                                   ffprobe_path=app.config['FFPROBE_PATH'])
+    item_file.geocode()
     setattr(item_file, 'city', item_file.gps['city'])
     setattr(item_file, 'coords', '%s,%s' % (item_file.gps['latitude'], item_file.gps['longitude'])
                                  if item_file.gps['latitude'] else '')
@@ -445,6 +656,15 @@ def upload_media_file():
         else:
             flash('File "%s" has been uploaded and saved in the database.' % upload_result.value,
                   'success')
+            if add_result.value.geocode:
+                geocoder.geocode_queue.wake()
+            if add_result.value.checksum and scanner.is_photo(add_result.value.path):
+                thumbnails.cache.generate(add_result.value.path, add_result.value.checksum)
+            elif add_result.value.checksum and not add_result.value.transcode:  # others get previews once converted
+                thumbnails.cache.generate_video(add_result.value.path, add_result.value.checksum)
+            if add_result.value.transcode:
+                transcoder.transcode_queue.wake(app.config)
+                flash('Video will be converted into MP4 in background (see /_transcode_status).', 'info')
             return redirect(url_for('edit_mediafile', mediafile_id=add_result.value.id))
     info = helpers.get_subfolders_list(app.config['MEDIA_FOLDER']).value
     return render_template('upload.html', session=session, form=form, info=info,
@@ -505,7 +725,10 @@ def edit_mediafile(mediafile_id):
             for tag in tags:
                 db_queries.create_tag(tag)
             # Finally, if metadata was changed then inject updated metadata into media file on disk:
-            if file_metadata_changed:
+            if file_metadata_changed and media.transcode:
+                flash('Video "%s" is not yet converted into MP4 - metadata stored in the database '
+                      'will be injected once it is converted.' % new_path, 'info')
+            elif file_metadata_changed:
                 multimedia = MultiMedia.detect(request.form.get('path', '').strip(),
                                                app.config,
                                                ffmpeg_path=app.config['FFMPEG_PATH'],
@@ -798,9 +1021,24 @@ def settings_update():
                     'FFPROBE_PATH': request.form.get('ffprobe_path'),
                     'MIN_FILESIZE': int(request.form.get('min_filesize')),
                     'MAX_FILESIZE': int(request.form.get('max_filesize')),
-                    'ITEMS_PER_PAGE': int(request.form.get('items_per_page'))}
+                    'ITEMS_PER_PAGE': int(request.form.get('items_per_page')),
+                    'SCAN_PHOTO_WORKERS': int(request.form.get('scan_photo_workers')),
+                    'SCAN_VIDEO_WORKERS': int(request.form.get('scan_video_workers')),
+                    'TRANSCODE_WORKERS': int(request.form.get('transcode_workers')),
+                    'GEONAMES_FILE': request.form.get('geonames_file', '').strip(),
+                    'NOMINATIM_FALLBACK': request.form.get('nominatim_fallback') == 'yes',
+                    'GEOCODE_PRECISION': int(request.form.get('geocode_precision')),
+                    'GEOCODE_CACHE_TTL': int(request.form.get('geocode_cache_ttl')),
+                    'PERCEPTUAL_HASH': request.form.get('perceptual_hash') == 'yes',
+                    'THUMBNAIL_CACHE_SIZE': int(request.form.get('thumbnail_cache_size')),
+                    'VIDEO_SPRITES': request.form.get('video_sprites') == 'yes',
+                    'MEDIA_DELIVERY': 'nginx' if request.form.get('media_delivery') == 'nginx' else 'flask'}
+        # Keep settings which are not editable in the form as they are:
+        settings = dict({key: app.config[key] for key in DEFAULT_SETTINGS}, **settings)
         if helpers.update_settings_file(settings, app.config['SETTINGS_FILE']):
             app.config.update(settings)  # reload config only after successful file update
+            geo_tools.configure(app.config)
+            thumbnails.cache.configure(app.config)
             flash('Settings have been updated', 'success')
         else:
             flash('Could not save settings', 'danger')
@@ -813,6 +1051,17 @@ def settings_update():
     form.min_filesize.data = app.config['MIN_FILESIZE']
     form.max_filesize.data = app.config['MAX_FILESIZE']
     form.items_per_page.data = app.config['ITEMS_PER_PAGE']
+    form.scan_photo_workers.data = app.config['SCAN_PHOTO_WORKERS']
+    form.scan_video_workers.data = app.config['SCAN_VIDEO_WORKERS']
+    form.transcode_workers.data = app.config['TRANSCODE_WORKERS']
+    form.geonames_file.data = app.config['GEONAMES_FILE']
+    form.nominatim_fallback.data = 'yes' if app.config['NOMINATIM_FALLBACK'] else 'no'
+    form.geocode_precision.data = app.config['GEOCODE_PRECISION']
+    form.geocode_cache_ttl.data = app.config['GEOCODE_CACHE_TTL']
+    form.perceptual_hash.data = 'yes' if app.config['PERCEPTUAL_HASH'] else 'no'
+    form.thumbnail_cache_size.data = app.config['THUMBNAIL_CACHE_SIZE']
+    form.video_sprites.data = 'yes' if app.config['VIDEO_SPRITES'] else 'no'
+    form.media_delivery.data = app.config['MEDIA_DELIVERY']
     return render_template('form.html', session=session, form=form, submit_name='Apply')
 
 
@@ -820,13 +1069,11 @@ def settings_update():
 @login_required
 def settings_restore():
     """Route to the page to restore default values of customizable application settings."""
-    default_settings = {'MEDIA_FOLDER': '/opt/metaphotor/app/media',
-                        'WATCH_FOLDER': '/opt/metaphotor/app/watch',
-                        'FFMPEG_PATH': '/usr/bin/ffmpeg',
-                        'FFPROBE_PATH': '/usr/bin/ffprobe',
-                        'MIN_FILESIZE': 524288, 'MAX_FILESIZE': 1073741824, 'ITEMS_PER_PAGE': 100}
+    default_settings = dict(DEFAULT_SETTINGS)
     if helpers.update_settings_file(default_settings, app.config['SETTINGS_FILE']):
         app.config.update(default_settings)
+        geo_tools.configure(app.config)
+        thumbnails.cache.configure(app.config)
         flash('Loaded default settings', 'success')
     else:
         flash('Could not restore settings', 'danger')
@@ -2,22 +2,40 @@ import os
 import json
 
 
+# Default values of settings configurable by user (also used to restore defaults from the web UI):
+DEFAULT_SETTINGS = {'MEDIA_FOLDER': '/opt/metaphotor/app/media',
+                    'WATCH_FOLDER': '/opt/metaphotor/app/watch',
+                    'FFMPEG_PATH': '/usr/bin/ffmpeg',
+                    'FFPROBE_PATH': '/usr/bin/ffprobe',
+                    'MIN_FILESIZE': 524288,
+                    'MAX_FILESIZE': 1073741824,
+                    'ITEMS_PER_PAGE': 100,
+                    'SCAN_PHOTO_WORKERS': 0,  # 0 means "as many as CPU cores"
+                    'SCAN_VIDEO_WORKERS': 2,
+                    'SCAN_BATCH_SIZE': 500,
+                    'SCAN_BATCH_INTERVAL': 1000,
+                    'TRANSCODE_WORKERS': 1,
+                    'GEONAMES_FILE': '/opt/metaphotor/persist/cities15000.txt',
+                    'NOMINATIM_FALLBACK': False,
+                    'GEOCODE_PRECISION': 3,  # decimal digits, 3 means ~110 meters
+                    'GEOCODE_CACHE_TTL': 30,
+                    'PERCEPTUAL_HASH': False,
+                    'THUMBNAIL_CACHE_SIZE': 4096,  # megabytes
+                    'VIDEO_SPRITES': True,
+                    'MEDIA_DELIVERY': 'flask'}  # or 'nginx' to offload sending files via X-Accel-Redirect
+
+
 def init_conf(settings_file):
     """
     Create persist/conf.json file if not exists, otherwise read settings from it.
+    Settings missing in the file (e.g. introduced by newer versions) take their default values.
     Return settings as a dictionary.
     """
+    custom_settings = dict(DEFAULT_SETTINGS)
     try:
         with open(settings_file, 'r') as _f:
-            custom_settings = json.loads(_f.read().strip())
+            custom_settings.update(json.loads(_f.read().strip()))
     except FileNotFoundError:
-        custom_settings = {'MEDIA_FOLDER': '/opt/metaphotor/app/media',
-                           'WATCH_FOLDER': '/opt/metaphotor/app/watch',
-                           'FFMPEG_PATH': '/usr/bin/ffmpeg',
-                           'FFPROBE_PATH': '/usr/bin/ffprobe',
-                           'MIN_FILESIZE': 524288,
-                           'MAX_FILESIZE': 1073741824,
-                           'ITEMS_PER_PAGE': 100}
         with open(settings_file, 'w') as _f:
             _f.write(json.dumps(custom_settings))
     return custom_settings
@@ -33,6 +51,11 @@ class BaseConf:
     APP_FOLDER = APP_FOLDER
     CONFIG_FOLDER = APP_FOLDER
     SETTINGS_FILE = CUSTOM_SETTINGS_FILE
+    GEOCODE_CACHE_FILE = os.path.join(APP_FOLDER, 'persist', 'geocache.sqlite')  # results of geo lookups
+    THUMBNAIL_FOLDER = os.path.join(APP_FOLDER, 'persist', 'thumbnails')  # will be created if does not exist
+    # Internal nginx locations aliasing MEDIA_FOLDER and THUMBNAIL_FOLDER (used if MEDIA_DELIVERY is 'nginx'):
+    MEDIA_ACCEL_LOCATION = '/_protected/media/'
+    THUMBNAIL_ACCEL_LOCATION = '/_protected/thumbnails/'
     DATABASE = os.environ.get('POSTGRES_DB', 'metaphotor')
     SQLALCHEMY_DATABASE_URI = 'postgresql://%s:%s@postgresql:5432/%s' % (
                               os.environ.get('POSTGRES_USER', 'postgres'),
@@ -51,6 +74,19 @@ class BaseConf:
     MIN_FILESIZE = CUSTOM_SETTINGS['MIN_FILESIZE']  # a number of bytes
     MAX_FILESIZE = CUSTOM_SETTINGS['MAX_FILESIZE']  # a number of bytes
     ITEMS_PER_PAGE = CUSTOM_SETTINGS['ITEMS_PER_PAGE']
+    SCAN_PHOTO_WORKERS = CUSTOM_SETTINGS['SCAN_PHOTO_WORKERS']  # processes to parse photos
+    SCAN_VIDEO_WORKERS = CUSTOM_SETTINGS['SCAN_VIDEO_WORKERS']  # threads to probe videos
+    SCAN_BATCH_SIZE = CUSTOM_SETTINGS['SCAN_BATCH_SIZE']  # rows inserted into the DB at once
+    SCAN_BATCH_INTERVAL = CUSTOM_SETTINGS['SCAN_BATCH_INTERVAL']  # milliseconds between inserts
+    TRANSCODE_WORKERS = CUSTOM_SETTINGS['TRANSCODE_WORKERS']  # threads to convert videos into MP4
+    GEONAMES_FILE = CUSTOM_SETTINGS['GEONAMES_FILE']  # a GeoNames dump of cities for offline geocoding
+    NOMINATIM_FALLBACK = CUSTOM_SETTINGS['NOMINATIM_FALLBACK']  # query Nominatim if offline geocoding fails
+    GEOCODE_PRECISION = CUSTOM_SETTINGS['GEOCODE_PRECISION']  # decimal digits of coordinates in cache keys
+    GEOCODE_CACHE_TTL = CUSTOM_SETTINGS['GEOCODE_CACHE_TTL']  # days to keep cached results of geo lookups
+    PERCEPTUAL_HASH = CUSTOM_SETTINGS['PERCEPTUAL_HASH']  # compute perceptual hashes of photos during scans
+    THUMBNAIL_CACHE_SIZE = CUSTOM_SETTINGS['THUMBNAIL_CACHE_SIZE']  # megabytes of thumbnails kept on disk
+    VIDEO_SPRITES = CUSTOM_SETTINGS['VIDEO_SPRITES']  # extract sprite sheets of videos along with posters
+    MEDIA_DELIVERY = CUSTOM_SETTINGS['MEDIA_DELIVERY']  # who sends media files to clients: flask or nginx
 
 
 class DevConf(BaseConf):
@@ -0,0 +1,84 @@
+"""Tests of splicing EXIF data into JPEG files (see write_jpeg_exif() in app/metamedia.py) on small synthetic files."""
+import os
+import struct
+import shutil
+import tempfile
+import unittest
+
+try:
+    from app.metamedia import read_jpeg_exif, write_jpeg_exif
+except ImportError:  # the application dependencies (Flask, Pillow, piexif, etc.) are not installed
+    read_jpeg_exif = write_jpeg_exif = None
+
+
+def make_segment(marker, content):
+    """Return bytes of a JPEG header segment of the given marker (e.g. 0xe1 for APP1) and content."""
+    return bytes([0xff, marker]) + struct.pack('>H', len(content) + 2) + content
+
+
+SOI = b'\xff\xd8'
+APP0 = make_segment(0xe0, b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+XMP = make_segment(0xe1, b'http://ns.adobe.com/xap/1.0/\x00<x:xmpmeta/>')
+DQT = make_segment(0xdb, b'\x00' + bytes(range(1, 65)))
+# Start of scan with entropy-coded data (including stuffed 0xff bytes and a restart marker) and end of image:
+SCAN = make_segment(0xda, b'\x01\x01\x00\x00\x3f\x00') + b'\x12\xff\x00\x34' * 100 + b'\xff\xd0\x56' + b'\xff\xd9'
+OLD_EXIF = b'Exif\x00\x00' + b'MM\x00\x2a\x00\x00\x00\x08' + b'old' * 10
+NEW_EXIF = b'Exif\x00\x00' + b'II\x2a\x00\x08\x00\x00\x00' + b'new' * 50
+
+
+@unittest.skipIf(write_jpeg_exif is None, 'application dependencies are not installed')
+class WriteJpegExifTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'photo.jpg')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def create(self, *parts):
+        """Write the file of the given parts (segments) and return its bytes."""
+        with open(self.path, 'wb') as stream:
+            stream.write(b''.join(parts))
+        return b''.join(parts)
+
+    def read(self):
+        with open(self.path, 'rb') as stream:
+            return stream.read()
+
+    def test_inserted_after_jfif_segment(self):
+        self.create(SOI, APP0, DQT, SCAN)
+        write_jpeg_exif(self.path, NEW_EXIF)
+        self.assertEqual(self.read(), SOI + APP0 + make_segment(0xe1, NEW_EXIF) + DQT + SCAN)
+        self.assertEqual(read_jpeg_exif(self.path), NEW_EXIF)
+
+    def test_inserted_right_after_soi(self):
+        self.create(SOI, DQT, SCAN)
+        write_jpeg_exif(self.path, NEW_EXIF)
+        self.assertEqual(self.read(), SOI + make_segment(0xe1, NEW_EXIF) + DQT + SCAN)
+
+    def test_replaced_keeping_other_segments(self):
+        self.create(SOI, make_segment(0xe1, OLD_EXIF), XMP, DQT, SCAN)
+        os.chmod(self.path, 0o640)
+        write_jpeg_exif(self.path, NEW_EXIF)
+        content = self.read()
+        self.assertEqual(content, SOI + make_segment(0xe1, NEW_EXIF) + XMP + DQT + SCAN)
+        self.assertTrue(content.endswith(SCAN))  # image data is copied byte by byte
+        self.assertEqual(read_jpeg_exif(self.path), NEW_EXIF)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.folder), ['photo.jpg'])  # no temporary files are left
+
+    def test_invalid_input_leaves_file_unchanged(self):
+        original = self.create(SOI, APP0, DQT, SCAN)
+        with self.assertRaises(ValueError):
+            write_jpeg_exif(self.path, b'Exif\x00\x00' + b'\x00' * 0xffff)
+        self.assertEqual(self.read(), original)
+        not_jpeg = self.create(b'\x89PNG\r\n\x1a\n' + b'\x00' * 32)
+        with self.assertRaises(ValueError):
+            write_jpeg_exif(self.path, NEW_EXIF)
+        self.assertEqual(self.read(), not_jpeg)
+        self.assertEqual(os.listdir(self.folder), ['photo.jpg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
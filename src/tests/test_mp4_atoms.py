@@ -0,0 +1,172 @@
+"""Tests of writing metadata into MP4 files natively (see app/mp4_atoms.py) on small synthetic files."""
+import os
+import struct
+import shutil
+import tempfile
+import unittest
+import importlib.util
+
+# The module has no dependencies, so it is loaded by its path - without the application (Flask, DB, etc.):
+spec = importlib.util.spec_from_file_location('mp4_atoms', os.path.join(os.path.dirname(__file__), os.pardir,
+                                                                        'app', 'mp4_atoms.py'))
+mp4_atoms = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mp4_atoms)
+make_atom = mp4_atoms.make_atom
+
+FTYP = make_atom(b'ftyp', b'isom' + struct.pack('>I', 512) + b'isomiso2avc1mp41')
+MVHD = make_atom(b'mvhd', b'\x00' * 12 + struct.pack('>II', 1000, 7531) + b'\x00' * 80)  # 7.531 seconds
+TRAK = make_atom(b'trak', make_atom(b'stco', struct.pack('>III', 0, 1, 48)))  # a stand-in for track atoms
+MDAT = make_atom(b'mdat', bytes(range(256)) * 64)
+
+
+def make_moov(tags=None):
+    """Return bytes of a movie atom, with an iTunes-style 'ilst' of the given tags if any."""
+    children = MVHD + TRAK
+    if tags:
+        items = b''.join(make_atom(mp4_atoms.TAG_ATOMS[name], make_atom(b'data', struct.pack('>II', 1, 0)
+                                                                        + value.encode('utf-8')))
+                         for name, value in tags.items())
+        hdlr = make_atom(b'hdlr', b'\x00' * 8 + b'mdir' + b'appl' + b'\x00' * 9)
+        children += make_atom(b'udta', make_atom(b'meta', b'\x00' * 4 + hdlr + make_atom(b'ilst', items)))
+    return make_atom(b'moov', children)
+
+
+class WriteMp4MetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'video.mp4')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def create(self, *atoms):
+        """Write the file of the given top level atoms."""
+        with open(self.path, 'wb') as stream:
+            stream.write(b''.join(atoms))
+
+    def atoms(self):
+        """Return a list of tuples (atom_type, offset, size) of top level atoms of the file."""
+        with open(self.path, 'rb') as stream:
+            end = os.fstat(stream.fileno()).st_size
+            return [(atom_type, offset, size) for atom_type, offset, header_size, size
+                    in mp4_atoms.iter_atoms(stream, 0, end)]
+
+    def assertMediaDataUnchanged(self, offset):
+        """Check that the media data atom is still at the given offset and its bytes are unchanged."""
+        mdat = [(atom_offset, size) for atom_type, atom_offset, size in self.atoms() if atom_type == b'mdat']
+        self.assertEqual(mdat, [(offset, len(MDAT))])
+        with open(self.path, 'rb') as stream:
+            stream.seek(offset)
+            self.assertEqual(stream.read(len(MDAT)), MDAT)
+
+    def assertTags(self, expected):
+        """Check that the file is read natively and it has (at least) the expected tags."""
+        metadata = mp4_atoms.read_mp4_metadata(self.path)
+        self.assertIsNotNone(metadata)
+        self.assertEqual(metadata['format']['duration'], '7.531000')
+        tags = metadata['format']['tags']
+        self.assertEqual({name: tags.get(name) for name in expected}, expected)
+        return tags
+
+    def test_written_in_place_into_free_space(self):
+        self.create(FTYP, make_moov(), mp4_atoms.make_free(2048), MDAT)
+        size = os.path.getsize(self.path)
+        self.assertTrue(mp4_atoms.write_mp4_metadata(self.path, {'title': 'Summer', 'comment': 'At the lake'}))
+        self.assertEqual(os.path.getsize(self.path), size)
+        atoms = self.atoms()
+        self.assertEqual([atom_type for atom_type, offset, atom_size in atoms], [b'ftyp', b'moov', b'free', b'mdat'])
+        self.assertGreaterEqual(atoms[2][2], mp4_atoms.PADDING)
+        self.assertMediaDataUnchanged(size - len(MDAT))
+        self.assertTags({'title': 'Summer', 'comment': 'At the lake', 'major_brand': 'isom'})
+
+    def test_shrunk_in_place_keeping_padding(self):
+        moov = make_moov({'title': 'A long title ' * 100, 'album': 'Holidays'})
+        self.create(FTYP, moov, MDAT)
+        size = os.path.getsize(self.path)
+        self.assertTrue(mp4_atoms.write_mp4_metadata(self.path, {'title': 'Short', 'album': ''}))
+        self.assertEqual(os.path.getsize(self.path), size)
+        atoms = self.atoms()
+        self.assertEqual([atom_type for atom_type, offset, atom_size in atoms], [b'ftyp', b'moov', b'free', b'mdat'])
+        self.assertEqual(atoms[1][1], len(FTYP))
+        self.assertGreaterEqual(atoms[2][2], mp4_atoms.PADDING)
+        self.assertMediaDataUnchanged(len(FTYP) + len(moov))
+        tags = self.assertTags({'title': 'Short'})
+        self.assertNotIn('album', tags)
+
+    def test_little_free_space_appended(self):
+        moov = make_moov({'title': 'A long title ' * 20})
+        self.create(FTYP, moov, MDAT)
+        self.assertTrue(mp4_atoms.write_mp4_metadata(self.path, {'title': 'Short'}))  # it would leave no padding
+        atoms = self.atoms()
+        self.assertEqual([atom_type for atom_type, offset, size in atoms],
+                         [b'ftyp', b'free', b'mdat', b'moov', b'free'])
+        self.assertEqual(atoms[4][2], mp4_atoms.PADDING)
+        self.assertMediaDataUnchanged(len(FTYP) + len(moov))
+        self.assertTags({'title': 'Short'})
+
+    def test_little_free_space_of_last_movie_atom_extended(self):
+        moov = make_moov()
+        self.create(FTYP, MDAT, moov, mp4_atoms.make_free(64))
+        self.assertTrue(mp4_atoms.write_mp4_metadata(self.path, {'title': 'Extended'}))
+        atoms = self.atoms()
+        self.assertEqual([atom_type for atom_type, offset, size in atoms], [b'ftyp', b'mdat', b'moov', b'free'])
+        self.assertEqual(atoms[2][1], len(FTYP) + len(MDAT))
+        self.assertEqual(atoms[3][2], mp4_atoms.PADDING)
+        self.assertMediaDataUnchanged(len(FTYP))
+        self.assertTags({'title': 'Extended'})
+
+    def test_next_edits_fit_into_padding(self):
+        self.create(FTYP, make_moov(), MDAT)
+        self.assertTrue(mp4_atoms.write_mp4_metadata(self.path, {'title': 'First'}))
+        moov = self.atoms()[3]
+        self.assertTrue(mp4_atoms.write_mp4_metadata(self.path, {'title': 'Second', 'comment': 'Edited'}))
+        atoms = self.atoms()  # the movie atom is rewritten where it is, no more movie atoms are appended
+        self.assertEqual([atom_type for atom_type, offset, size in atoms],
+                         [b'ftyp', b'free', b'mdat', b'moov', b'free'])
+        self.assertEqual(atoms[3][1], moov[1])
+        self.assertEqual(atoms[4][2], mp4_atoms.PADDING)
+        self.assertMediaDataUnchanged(len(FTYP) + len(make_moov()))
+        self.assertTags({'title': 'Second', 'comment': 'Edited'})
+
+    def test_last_movie_atom_extended(self):
+        self.create(FTYP, MDAT, make_moov())
+        self.assertTrue(mp4_atoms.write_mp4_metadata(self.path, {'title': 'Extended', 'description': 'x' * 500}))
+        atoms = self.atoms()
+        self.assertEqual([atom_type for atom_type, offset, size in atoms], [b'ftyp', b'mdat', b'moov', b'free'])
+        self.assertEqual(atoms[2][1], len(FTYP) + len(MDAT))
+        self.assertEqual(atoms[3][2], mp4_atoms.PADDING)
+        self.assertMediaDataUnchanged(len(FTYP))
+        self.assertTags({'title': 'Extended', 'description': 'x' * 500})
+
+    def test_movie_atom_appended(self):
+        moov = make_moov()
+        self.create(FTYP, moov, MDAT)
+        self.assertTrue(mp4_atoms.write_mp4_metadata(self.path, {'title': 'Appended', 'date': '2019'}))
+        atoms = self.atoms()
+        self.assertEqual([atom_type for atom_type, offset, size in atoms],
+                         [b'ftyp', b'free', b'mdat', b'moov', b'free'])
+        self.assertEqual(atoms[1][1:], (len(FTYP), len(moov)))  # the old movie atom is turned into a 'free' atom
+        self.assertEqual(atoms[3][1], len(FTYP) + len(moov) + len(MDAT))
+        self.assertMediaDataUnchanged(len(FTYP) + len(moov))
+        self.assertTags({'title': 'Appended', 'date': '2019'})
+        with open(self.path, 'rb') as stream:  # track atoms are copied into the new movie atom as they are
+            self.assertIn(TRAK, stream.read()[atoms[3][1]:])
+
+    def test_unsupported_files_are_not_changed(self):
+        self.create(FTYP, make_moov(), MDAT[:8])  # the media data atom lasts until the end of the file
+        with open(self.path, 'r+b') as stream:
+            stream.seek(len(FTYP) + len(make_moov()))
+            stream.write(b'\x00' * 4)
+            stream.seek(0, os.SEEK_END)
+            stream.write(MDAT[8:])
+        with open(self.path, 'rb') as stream:
+            original = stream.read()
+        self.assertFalse(mp4_atoms.write_mp4_metadata(self.path, {'title': 'Not written ' * 10}))
+        self.assertFalse(mp4_atoms.write_mp4_metadata(self.path, {'unknown': 'tag'}))
+        with open(self.path, 'rb') as stream:
+            self.assertEqual(stream.read(), original)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Tests of the incremental re-scan (see reconcile_scan() in app/scanner.py) with the database mocked out."""
+import os
+import unittest
+from collections import namedtuple
+from unittest import mock
+
+try:
+    from app import scanner
+except ImportError:  # the application dependencies (Flask, SQLAlchemy, Pillow, etc.) are not installed
+    scanner = None
+
+Registered = namedtuple('Registered', ['id', 'size', 'mtime', 'checksum', 'phash'])
+Copy = namedtuple('Copy', ['id', 'path', 'size', 'mtime', 'mediafile_id'])
+APP_CONFIG = {'MEDIA_FOLDER': '/media', 'PERCEPTUAL_HASH': False}
+
+
+@unittest.skipIf(scanner is None, 'application dependencies are not installed')
+class ReconcileScanTest(unittest.TestCase):
+
+    def reconcile(self, found, registered, copies, copies_of):
+        """
+        Run reconcile_scan() over the given found files with the database (and parsing of files) mocked out.
+
+        :param found: a list of tuples (path, size, mtime) of files found on disk.
+        :param registered: a dictionary of entries in 'mediafiles' table by paths.
+        :param copies: a list of entries in 'duplicate_files' table.
+        :param copies_of: a list of entries in 'duplicate_files' table returned for vanished media files.
+        :return: a tuple (counts, mocked db_queries module).
+        """
+        stats = [(path, os.stat_result((0o100644, 0, 0, 1, 0, 0, size, mtime, mtime, mtime)))
+                 for path, size, mtime in found]
+        engine = mock.Mock(video_workers=1, photo_workers=1)
+        engine.sink.moved, engine.sink.duplicates = set(), 0
+        engine.run.side_effect = lambda media_files, changed: list(media_files)
+        with mock.patch.object(scanner, 'db_queries') as db_queries, \
+                mock.patch.object(scanner.helpers, 'iter_media_files', return_value=iter(stats)), \
+                mock.patch.object(scanner, 'ScanEngine', return_value=engine), \
+                mock.patch.object(scanner, 'hash_files', return_value=0), \
+                mock.patch.object(scanner, 'perceptual_hash_files', return_value=0):
+            db_queries.get_registered_files.return_value = dict(registered)
+            db_queries.get_duplicate_files.return_value = {copy.path: copy for copy in copies}
+            db_queries.find_duplicate_files_of.return_value = copies_of
+            db_queries.remove_mediafiles.side_effect = len
+            counts = scanner.reconcile_scan(APP_CONFIG, 0, mock.Mock())
+        return counts, db_queries
+
+    def test_original_deleted_copy_kept(self):
+        copy = Copy(7, '/media/copy.jpg', 10, 2.0, 1)
+        counts, db_queries = self.reconcile([('/media/copy.jpg', 10, 2.0)],
+                                            {'/media/original.jpg': Registered(1, 10, 1.0, 'c' * 32, 1)},
+                                            [copy], [copy])
+        db_queries.find_duplicate_files_of.assert_called_once_with([1])
+        values = db_queries.update_mediafiles_values.call_args_list[0][0][0]
+        self.assertEqual([{key: value for key, value in item.items() if key != 'updated'} for item in values],
+                         [{'id': 1, 'path': '/media/copy.jpg', 'size': 10, 'mtime': 2.0}])
+        db_queries.remove_duplicate_files.assert_any_call([7])
+        db_queries.remove_mediafiles.assert_called_once_with([])
+        self.assertEqual((counts['removed'], counts['moved'], counts['duplicates']), (0, 1, 1))
+
+    def test_original_and_copy_deleted(self):
+        copy = Copy(7, '/media/copy.jpg', 10, 2.0, 1)
+        counts, db_queries = self.reconcile([], {'/media/original.jpg': Registered(1, 10, 1.0, 'c' * 32, 1)},
+                                            [copy], [copy])
+        db_queries.remove_mediafiles.assert_called_once_with([1])
+        db_queries.remove_duplicate_files.assert_any_call([7])
+        self.assertEqual((counts['removed'], counts['moved'], counts['duplicates']), (1, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()